@@ -1,6 +1,6 @@
 from .util import generate_random_base_64, validate_hashcash_zeros
 from .password_repository import PasswordRepository
 from .authentication_validator import AuthenticationValidator
-from .staller import Staller
+from .staller import Staller, AsyncStaller, StallerPool, StallScheduler
 from .state import StateEncryptor
 
@@ -1,65 +1,184 @@
+import asyncio
 import json
+from concurrent.futures import Executor
 from datetime import datetime
-from typing import Dict, Set, Any
+from typing import Dict, Set, Any, Optional
 
 from . import StateEncryptor, captcha, util
+from .captcha_pool import CaptchaPool
+from .difficulty import AdaptiveDifficulty
 
 
-class Preparer:
-    @staticmethod
-    def prepare_authentication(state_encryptor: StateEncryptor, configuration: Dict[str, Any]) -> Dict[str, Any]:
-        captcha_url: str
-        captcha_solution: Set[str]
+class TransactionTemplate(object):
+    """
+    The transaction details of a configuration, compiled once into pre-serialized JSON fragments, so that
+    filling them in only splices in the values of the request: the zero count and server string of the hashcash.
+    """
+    def __init__(self, configuration: Dict[str, Any]):
+        tolerance = json.dumps({"minimumAlphabetPassphrase": int(configuration["passphrase_minimum_length"])})
+        hashing = json.dumps({
+            "saltHashByUsername": True,
+            "hashCycles": int(configuration["client_hash_cycles"]),
+            "resultLength": int(configuration["client_hash_length"])
+        })
 
-        captcha_url, captcha_solutions = captcha.generate_captcha_challenge(configuration["captcha_directory"])
+        # The server instructions, cut where the zero count and the server string go
+        self.__server_instructions_head = '{"captcha": {"require": true}, "hashcash": {"require": true, "zeroCount": '
+        self.__server_instructions_middle = ', "serverString": '
+        self.__server_instructions_tail = (f'}}, "csrfToken": {{"require": true}}, "tolerance": {tolerance}, '
+                                           f'"hashing": {hashing}}}')
 
-        csrf_token = util.generate_random_base_64(configuration["csrf_token_length"])
-        hashcash_server_string = util.generate_random_base_64(configuration["hashcash_server_string_length"])
+        self.__passtext_strength = json.dumps({
+            "minimumCharactersPassword": int(configuration["password_minimum_length"])
+        })
+        self.__tolerance = tolerance
+        self.__test_mode = bool(configuration["SIGNUM_TEST_MODE"])
 
-        state = {
-            "server_time": datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
-            "captcha_solutions": list(captcha_solutions),
-            "csrf_token": csrf_token,
-            "hashcash": {
-                "server_string": hashcash_server_string,
-                "zero_count": configuration["hashcash_zero_count"]
-            }
-        }
+    def details(self, captcha_url: str, state: Dict[str, Any], encrypted_state: bytes) -> Dict[str, Any]:
+        hashcash = state["hashcash"]
 
         transaction_details: Dict[str, Any] = {
             "captcha": captcha_url,
-            "server-instructions": f"""{{
-                "captcha": {{
-                    "require": true
-                }},
-                "hashcash": {{
-                    "require": true,
-                    "zeroCount": {int(configuration["hashcash_zero_count"])},
-                    "serverString": "{hashcash_server_string}"
-                }},
-                "csrfToken": {{
-                    "require": true
-                }},
-                "tolerance": {{
-                    "minimumAlphabetPassphrase": {int(configuration["passphrase_minimum_length"])}
-                }},
-                "hashing": {{
-                    saltHashByUsername: true,
-                    hashCycles: {int(configuration["client_hash_cycles"])},
-                    resultLength: {int(configuration["client_hash_length"])}
-                }}
-            }}""",
-            "state": state_encryptor.encrypt_state(state),
-            "csrfToken": csrf_token,
-            "passtextStrength": f"""{{
-                "minimumCharactersPassword": {int(configuration["password_minimum_length"])}
-            }}""",
-            "tolerance": f"""{{
-                "minimumAlphabetPassphrase": {int(configuration["passphrase_minimum_length"])}
-            }}"""
+            "server-instructions": "".join([self.__server_instructions_head, str(int(hashcash["zero_count"])),
+                                            self.__server_instructions_middle,
+                                            json.dumps(hashcash["server_string"]),
+                                            self.__server_instructions_tail]),
+            "state": encrypted_state,
+            "csrfToken": state["csrf_token"],
+            "passtextStrength": self.__passtext_strength,
+            "tolerance": self.__tolerance
         }
 
-        if configuration["SIGNUM_TEST_MODE"]:
+        if self.__test_mode:
             transaction_details["unencrypted_state"] = state
 
         return transaction_details
+
+
+class Preparer:
+    """
+    Prepares authentication transactions. An instance compiles the configuration once into a transaction
+    template. The static methods compile the configuration on every call.
+    :param difficulty: if given, chooses the hashcash zero count by the load observed from the remote address,
+        instead of the configured one
+    """
+    def __init__(self, state_encryptor: StateEncryptor, configuration: Dict[str, Any],
+                 captcha_pool: Optional[CaptchaPool] = None, difficulty: Optional[AdaptiveDifficulty] = None):
+        self.state_encryptor = state_encryptor
+        self.configuration = configuration
+        self.captcha_pool = captcha_pool
+        self.difficulty = difficulty
+        self.template = TransactionTemplate(configuration)
+
+    def prepare(self, remote_address: Optional[str] = None) -> Dict[str, Any]:
+        captcha_url, captcha_solutions = Preparer.generate_captcha(self.configuration, self.captcha_pool)
+
+        state = Preparer.create_state(captcha_solutions, self.configuration,
+                                      Preparer.choose_zero_count(self.configuration, self.difficulty, remote_address))
+
+        return self.transaction_details(captcha_url, state, self.state_encryptor.encrypt_state(state))
+
+    async def aprepare(self, remote_address: Optional[str] = None, captcha_executor: Optional[Executor] = None,
+                       crypto_executor: Optional[Executor] = None) -> Dict[str, Any]:
+        """
+        The asynchronous counterpart of prepare. Captcha generation and state encryption run on the given
+        executors (the loop's default executor if not given), so the event loop is never blocked.
+        """
+        loop = asyncio.get_running_loop()
+
+        captcha_url, captcha_solutions = await loop.run_in_executor(captcha_executor, Preparer.generate_captcha,
+                                                                    self.configuration, self.captcha_pool)
+
+        state = Preparer.create_state(captcha_solutions, self.configuration,
+                                      Preparer.choose_zero_count(self.configuration, self.difficulty, remote_address))
+
+        encrypted_state = await loop.run_in_executor(crypto_executor, self.state_encryptor.encrypt_state, state)
+
+        return self.transaction_details(captcha_url, state, encrypted_state)
+
+    def transaction_details(self, captcha_url: str, state: Dict[str, Any], encrypted_state: bytes) \
+            -> Dict[str, Any]:
+        return self.template.details(captcha_url, state, encrypted_state)
+
+    @staticmethod
+    def serialize_transaction(transaction_details: Dict[str, Any]) -> bytes:
+        """
+        Serializes a transaction to a JSON response body in a single pass. The JSON fragments of the transaction
+        are embedded as objects rather than strings.
+        """
+        parts = [b'{"captcha": ', json.dumps(transaction_details["captcha"]).encode(),
+                 b', "server-instructions": ', transaction_details["server-instructions"].encode(),
+                 # Encrypted states are URL-safe base64 and need no escaping
+                 b', "state": "', transaction_details["state"], b'"',
+                 b', "csrfToken": ', json.dumps(transaction_details["csrfToken"]).encode(),
+                 b', "passtextStrength": ', transaction_details["passtextStrength"].encode(),
+                 b', "tolerance": ', transaction_details["tolerance"].encode()]
+
+        if "unencrypted_state" in transaction_details:
+            parts += [b', "unencrypted_state": ', json.dumps(transaction_details["unencrypted_state"]).encode()]
+
+        parts.append(b"}")
+
+        return b"".join(parts)
+
+    @staticmethod
+    def prepare_authentication(state_encryptor: StateEncryptor, configuration: Dict[str, Any],
+                               captcha_pool: Optional[CaptchaPool] = None,
+                               difficulty: Optional[AdaptiveDifficulty] = None,
+                               remote_address: Optional[str] = None) -> Dict[str, Any]:
+        """
+        :param difficulty: if given along with remote_address, chooses the hashcash zero count by the load
+            observed from the remote address, instead of the configured one
+        """
+        return Preparer(state_encryptor, configuration, captcha_pool, difficulty).prepare(remote_address)
+
+    @staticmethod
+    async def aprepare_authentication(state_encryptor: StateEncryptor, configuration: Dict[str, Any],
+                                      captcha_pool: Optional[CaptchaPool] = None,
+                                      captcha_executor: Optional[Executor] = None,
+                                      crypto_executor: Optional[Executor] = None,
+                                      difficulty: Optional[AdaptiveDifficulty] = None,
+                                      remote_address: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The asynchronous counterpart of prepare_authentication. Captcha generation and state encryption run on
+        the given executors (the loop's default executor if not given), so the event loop is never blocked.
+        """
+        return await Preparer(state_encryptor, configuration, captcha_pool, difficulty).aprepare(
+            remote_address, captcha_executor, crypto_executor)
+
+    @staticmethod
+    def generate_captcha(configuration: Dict[str, Any], captcha_pool: Optional[CaptchaPool] = None) \
+            -> (str, Set[str]):
+        if captcha_pool is not None:
+            return captcha_pool.get()
+
+        return captcha.generate_captcha_challenge(configuration["captcha_directory"])
+
+    @staticmethod
+    def choose_zero_count(configuration: Dict[str, Any], difficulty: Optional[AdaptiveDifficulty] = None,
+                          remote_address: Optional[str] = None) -> int:
+        if difficulty is None or not remote_address:
+            return configuration["hashcash_zero_count"]
+
+        return difficulty.issue(remote_address)
+
+    @staticmethod
+    def create_state(captcha_solutions: Set[str], configuration: Dict[str, Any],
+                     zero_count: Optional[int] = None) -> Dict[str, Any]:
+        if zero_count is None:
+            zero_count = configuration["hashcash_zero_count"]
+
+        return {
+            "server_time": datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+            "captcha_solutions": list(captcha_solutions),
+            "csrf_token": util.generate_random_base_64(configuration["csrf_token_length"]),
+            "hashcash": {
+                "server_string": util.generate_random_base_64(configuration["hashcash_server_string_length"]),
+                "zero_count": zero_count
+            }
+        }
+
+    @staticmethod
+    def create_transaction_details(captcha_url: str, state: Dict[str, Any], encrypted_state: bytes,
+                                   configuration: Dict[str, Any]) -> Dict[str, Any]:
+        return TransactionTemplate(configuration).details(captcha_url, state, encrypted_state)
@@ -1,147 +1,63 @@
-import datetime
-import json
-from json import JSONDecodeError
-from typing import Tuple, Dict, List, Union
-
+import asyncio
+import functools
+import logging
+from concurrent.futures import Executor
+from typing import Tuple, Dict, List, Union, Optional
+
+from . import metrics
+from .difficulty import AdaptiveDifficulty
+from .spent_stamps import SpentStampStore
 from .state import StateEncryptor
 from .util import validate_hashcash_zeros
+from .validation_pipeline import ValidationPipeline, ValidationContext
 
 
 class AuthenticationValidator:
+    # The stages run when validate is not given a pipeline of its own
+    pipeline = ValidationPipeline()
+
     @classmethod
     def validate(cls, request_details: Dict[str, str], headers: Dict[str, str], state_encryptor: StateEncryptor,
                  # password_database: PasswordRepository,
-                 configuration: Dict[str, Union[str, List[str]]]) -> \
+                 configuration: Dict[str, Union[str, List[str]]],
+                 spent_stamp_store: Optional[SpentStampStore] = None,
+                 difficulty: Optional[AdaptiveDifficulty] = None,
+                 pipeline: Optional[ValidationPipeline] = None) -> \
             Tuple[bool, object]:
-        try:
-            # ### Early tests - fast failure ### #
-
-            # No referrer? A legitimate browser would have sent it. Fail.
-            if not request_details.get("referrer"):
-                return cls.failure("referrer", "not provided")
-
-            # To validate the referrer, we need the host
-            if not request_details.get("host"):
-                return cls.failure("host", "not provided")
-
-            # For the sake of the project, we support only http hosts
-            acceptable_referrer = 'http://%s/' % request_details["host"]
-
-            # The referrer should be a page on the same host
-            if not request_details["referrer"].startswith(acceptable_referrer):
-                return cls.failure("referrer", "doesn't match")
-
-            requested_with = headers.get("X-Requested-With")
-
-            # We require X-Requested-With: XmlHttpRequest
-            if not requested_with:
-                return cls.failure("requested_with", "not provided")
-
-            if not requested_with == "XmlHttpRequest":
-                return cls.failure("requested_with", "not XmlHttpRequest")
-
-            remote_address = request_details.get("remote_addr")
-
-            # Fail on missing remote address
-            if not remote_address:
-                return cls.failure("remote_address", "not provided")
-
-            body = request_details.get("body")
-
-            # Fail on missing body
-            if not body:
-                return cls.failure("body", "not provided")
-
-            csrf = headers.get("X-Csrf-Token")
-
-            # Fail on missing csrf token
-            if not csrf:
-                return cls.failure("csrf", "not provided")
-
-            captcha = headers.get("X-Captcha")
+        """
+        :param difficulty: if given, failures are reported to it, so that the remote address and its subnet are
+            issued harder hashcash challenges. Stamps claiming fewer zeros than it issues to calm sources are rejected
+        :param pipeline: the validation stages to run, the class pipeline if not given
+        """
+        result = cls.__validate(request_details, headers, state_encryptor, configuration, spent_stamp_store,
+                                difficulty, cls.pipeline if pipeline is None else pipeline)
 
-            # Fail on missing captcha answer
-            if not captcha:
-                return cls.failure("captcha", "not provided")
+        passed, response = result
 
-            hashcash = headers.get("X-Hashcash")
+        if passed:
+            metrics.increment("validations_passed_total")
+        else:
+            metrics.increment("validation_failures_total", stage=response["security_details"]["failure_stage"])
 
-            # Fail on missing hashcash
-            if not hashcash:
-                return cls.failure("hashcash", "not provided")
+        remote_address = request_details.get("remote_addr")
 
-            # ### Hashcash validation ### #
-            # Split hashcash into elements (the last two parts were calculated by the client to
-            # achieve the zeros goal, so we ignore them
-            try:
-                zeros, timestamp, ip, server_string, _, _ = hashcash.split(":")
-            except ValueError:
-                return cls.failure("hashcash", "illegal structure")
+        if difficulty is not None and remote_address and not passed:
+            difficulty.record_failure(remote_address)
 
-            now = datetime.datetime.utcnow()
-            # Convert timestamp to datetime object
-            timestamp_object = datetime.datetime.strptime(timestamp, "%Y%m%d-%H%M%S")
+        return result
 
-            # Measure the age in seconds
-            diff_in_seconds = (now - timestamp_object).total_seconds()
-
-            submit_timeout = configuration.get("submit_timeout")
-            assert submit_timeout, "Missing configuration item: submit_timeout"
-
-            # Fail if timeout has been reached since the user has generated the hashcash
-            if not 0 < diff_in_seconds <= float(submit_timeout):
-                return cls.failure("hashcash", "hashcash timestamp exceeds timeout")
-
-            self_ip_addresses = configuration.get("self_ip_addresses")
-            assert self_ip_addresses is not None, "Missing configuration item: self_ip_addresses"
-
-            if remote_address not in [ip] + self_ip_addresses:
-                return cls.failure("hashcash", "ip address doesn't match: "+remote_address)
-
-            if not cls.validate_hashcash(bytes(hashcash, "utf-8"), int(zeros)):
-                return cls.failure("hashcash", "zeros not validated")
-
-            try:
-                data = json.loads(body)
-                encrypted_state = data["state"]
-                state = state_encryptor.decrypt_state(encrypted_state.encode())
-            except JSONDecodeError:
-                return cls.failure("body", "bad format")
-            except (KeyError, AttributeError):
-                return cls.failure("state", "not provided")
-            except ValueError as e:
-                return cls.failure("state", str(e))
-
-            # Get server timestamp from state
-            server_time = datetime.datetime.strptime(state["server_time"], "%Y%m%d-%H%M%S")
-
-            # Measure login form age in seconds
-            diff_in_seconds = (now - server_time).total_seconds()
-
-            login_form_timeout = configuration.get("login_form_timeout")
-            assert login_form_timeout, "Missing configuration item: login_form_timeout"
-
-            # Fail if timeout has been reached since login form was generated
-            if not 0 < diff_in_seconds <= float(login_form_timeout):
-                return cls.failure("state", "login form age exceeds timeout")
-
-            # Verify number of zeros in hashcash matches state
-            if int(zeros) != int(state["hashcash"]["zero_count"]):
-                return cls.failure("hashcash", "zeros don't match state")
-
-            # Verify server string in hashcash matches state
-            if server_string != state["hashcash"]["server_string"]:
-                return cls.failure("hashcash", "server string doesn't match state")
-
-            # Verify csrf token in hashcash matches state
-            if csrf != state["csrf_token"]:
-                return cls.failure("csrf", "csrf token doesn't match state")
+    @classmethod
+    def __validate(cls, request_details: Dict[str, str], headers: Dict[str, str], state_encryptor: StateEncryptor,
+                   configuration: Dict[str, Union[str, List[str]]], spent_stamp_store: Optional[SpentStampStore],
+                   difficulty: Optional[AdaptiveDifficulty], pipeline: ValidationPipeline) -> Tuple[bool, object]:
+        try:
+            context = ValidationContext(request_details, headers, state_encryptor, configuration,
+                                        cls.validate_hashcash, spent_stamp_store, difficulty)
 
-            captcha_solutions = set(state["captcha_solutions"])
+            failure = pipeline.run(context)
 
-            # Verify captcha
-            if captcha not in captcha_solutions:
-                return cls.failure("captcha", f"captcha solution isn't in {captcha_solutions}")
+            if failure is not None:
+                return cls.failure(*failure)
 
             return True, {
                 "visible_response": {
@@ -150,9 +66,29 @@ class AuthenticationValidator:
             }
 
         except Exception as e:
-            print(repr(e))
+            # Clients can trigger this at will: no traceback, so that they cannot flood the log
+            logging.debug("Validation error: %r", e)
+            metrics.increment("validation_errors_total", error=type(e).__name__)
             return cls.failure("general", str(e))
 
+    @classmethod
+    async def avalidate(cls, request_details: Dict[str, str], headers: Dict[str, str],
+                        state_encryptor: StateEncryptor, configuration: Dict[str, Union[str, List[str]]],
+                        spent_stamp_store: Optional[SpentStampStore] = None,
+                        difficulty: Optional[AdaptiveDifficulty] = None,
+                        pipeline: Optional[ValidationPipeline] = None,
+                        executor: Optional[Executor] = None) -> Tuple[bool, object]:
+        """
+        The asynchronous counterpart of validate. Validation is CPU-bound (hashcash hashing, state decryption),
+        so it runs on the given executor, or on the loop's default executor if none is given.
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(executor, functools.partial(
+            cls.validate, request_details=request_details, headers=headers, state_encryptor=state_encryptor,
+            configuration=configuration, spent_stamp_store=spent_stamp_store, difficulty=difficulty,
+            pipeline=pipeline))
+
     @staticmethod
     def validate_hashcash(hashcash: bytes, zero_count: int):
         return validate_hashcash_zeros(hashcash, zero_count)
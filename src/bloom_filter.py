@@ -0,0 +1,65 @@
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter. Membership tests may return false positives at about the configured rate once
+    the expected number of items was added, but never false negatives.
+    :param capacity: the number of items the filter is sized for
+    :param false_positive_rate: the acceptable false positive rate at capacity
+    """
+    def __init__(self, capacity: int, false_positive_rate: float = 0.001):
+        if capacity <= 0:
+            raise ValueError("Bad capacity")
+
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("Bad false_positive_rate")
+
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+
+        self.bit_count = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.count = 0
+
+        self.__bits = bytearray((self.bit_count + 7) // 8)
+
+    def __positions(self, item: bytes):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+
+        # Double hashing: k positions out of two independent 64 bit hashes
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return [(first + index * second) % self.bit_count for index in range(self.hash_count)]
+
+    def add(self, item: bytes) -> bool:
+        """
+        Adds an item
+        :return: True if the item may have been in the filter already
+        """
+        present = True
+
+        for position in self.__positions(item):
+            mask = 1 << (position & 7)
+
+            if not self.__bits[position >> 3] & mask:
+                present = False
+                self.__bits[position >> 3] |= mask
+
+        if not present:
+            self.count += 1
+
+        return present
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(self.__bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(item))
+
+    def clear(self) -> None:
+        self.__bits = bytearray(len(self.__bits))
+        self.count = 0
+
+    @property
+    def size_in_bytes(self) -> int:
+        return len(self.__bits)
@@ -0,0 +1,230 @@
+import collections
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, Future
+from typing import Iterable, Iterator, Tuple, List, Optional, Callable, Deque, Union
+
+from .password_hashing import PasswordHasher
+from .password_repository import PasswordRepository
+
+DEFAULT_CHUNK_SIZE = 1000
+
+Credentials = Tuple[str, str]
+
+
+class MalformedRecord(object):
+    """Stands for a record of the input that holds no credentials, so that it is rejected in order"""
+    def __init__(self, error: str):
+        self.error = error
+
+
+Record = Union[Credentials, MalformedRecord]
+
+
+def read_csv(path: str, username_field: str = "username", password_field: str = "password") \
+        -> Iterator[Credentials]:
+    """Streams credentials out of a CSV file with a header row"""
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row.get(username_field), row.get(password_field)
+
+
+def read_jsonl(path: str, username_field: str = "username", password_field: str = "password") \
+        -> Iterator[Record]:
+    """Streams credentials out of a file of JSON objects, one per line. Malformed lines are rejected alone."""
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield MalformedRecord(f"Line {line_number}: {e}")
+                continue
+
+            if not isinstance(record, dict):
+                yield MalformedRecord(f"Line {line_number}: not a JSON object")
+                continue
+
+            username, password = record.get(username_field), record.get(password_field)
+
+            if not isinstance(username, str) or not isinstance(password, str):
+                yield MalformedRecord(f"Line {line_number}: {username_field} and {password_field} must be strings")
+                continue
+
+            yield username, password
+
+
+def read_credentials(path: str, username_field: str = "username", password_field: str = "password") \
+        -> Iterator[Record]:
+    """Streams credentials out of a .csv or a .jsonl file"""
+    if path.endswith(".csv"):
+        return read_csv(path, username_field, password_field)
+
+    if path.endswith(".jsonl"):
+        return read_jsonl(path, username_field, password_field)
+
+    raise ValueError(f"Unsupported credentials file: {path}")
+
+
+def hash_chunk(username_hash_salt: str, hasher: PasswordHasher, chunk: List[Record]) \
+        -> Tuple[List[Credentials], List[str]]:
+    """
+    Hashes a chunk of credentials the way PasswordRepository.save_password does. Runs in a worker process.
+    :return: the hashed (username, password) pairs, and the errors of the records that were rejected
+    """
+    hashed, errors = [], []
+
+    for record in chunk:
+        if isinstance(record, MalformedRecord):
+            errors.append(record.error)
+            continue
+
+        username, password = record
+
+        try:
+            hashed.append(PasswordRepository._hash_credentials(username, password, username_hash_salt, hasher.hash))
+        except (ValueError, TypeError, AttributeError) as e:
+            # Records of other sources may lack a field, or hold something else than a string
+            errors.append(str(e))
+
+    return hashed, errors
+
+
+class ImportReport(object):
+    def __init__(self, resumed_from: int = 0):
+        self.resumed_from = resumed_from
+        self.imported = 0
+        self.rejected = 0
+        self.errors: List[str] = []
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    @property
+    def processed(self) -> int:
+        return self.resumed_from + self.imported + self.rejected
+
+    @property
+    def rate(self) -> float:
+        """Credentials processed per second by this run"""
+        return (self.imported + self.rejected) / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (f"ImportReport(imported={self.imported}, rejected={self.rejected}, "
+                f"resumed_from={self.resumed_from}, seconds={self.seconds:.1f}, rate={self.rate:.1f}/s)")
+
+
+class BulkImporter(object):
+    """
+    Imports credentials into a repository in a streaming fashion: chunks are hashed in parallel worker
+    processes, and written to the repository one batch per chunk, in input order. At most a few chunks per
+    worker are in flight, so memory stays constant whatever the size of the input.
+    With a checkpoint file, the number of credentials written is recorded after every chunk, and an interrupted
+    import resumes after them when run again on the same input.
+    :param workers: number of worker processes, the number of CPUs if not given
+    :param checkpoint_path: file recording the progress, removed once the import completes
+    :param executor: an executor to hash on, instead of a process pool of its own
+    :param max_errors: number of rejection messages kept in the report
+    """
+    def __init__(self, repository: PasswordRepository, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 workers: Optional[int] = None, checkpoint_path: Optional[str] = None,
+                 executor: Optional[Executor] = None, max_errors: int = 100):
+        if chunk_size <= 0:
+            raise ValueError("Bad chunk_size")
+
+        if workers is not None and workers <= 0:
+            raise ValueError("Bad workers")
+
+        self.repository = repository
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.checkpoint_path = checkpoint_path
+        self.executor = executor
+        self.max_errors = max_errors
+
+    def run(self, credentials: Iterable[Record],
+            progress: Optional[Callable[[ImportReport], None]] = None) -> ImportReport:
+        """
+        :param progress: called with the report after every chunk written
+        """
+        report = ImportReport(self.__load_checkpoint())
+        credentials = itertools.islice(credentials, report.resumed_from, None)
+
+        executor = self.executor or ProcessPoolExecutor(self.workers)
+
+        try:
+            self.__run(executor, credentials, report, progress)
+        finally:
+            if self.executor is None:
+                executor.shutdown()
+
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        return report
+
+    def __run(self, executor: Executor, credentials: Iterator[Record], report: ImportReport,
+              progress: Optional[Callable[[ImportReport], None]]) -> None:
+        in_flight: Deque[Future] = collections.deque()
+        max_in_flight = 2 * self.workers
+
+        try:
+            self.__pump(executor, credentials, report, progress, in_flight, max_in_flight)
+        except BaseException:
+            # Chunks not written yet are left for the resumed import
+            for future in in_flight:
+                future.cancel()
+
+            raise
+
+    def __pump(self, executor: Executor, credentials: Iterator[Record], report: ImportReport,
+               progress: Optional[Callable[[ImportReport], None]], in_flight: Deque[Future],
+               max_in_flight: int) -> None:
+        while True:
+            chunk = list(itertools.islice(credentials, self.chunk_size))
+
+            if chunk:
+                in_flight.append(executor.submit(hash_chunk, self.repository.username_hash_salt,
+                                                 self.repository.hasher, chunk))
+
+            # Write the oldest chunk once enough are in flight, or when the input is exhausted
+            while in_flight and (len(in_flight) >= max_in_flight or not chunk):
+                hashed, errors = in_flight.popleft().result()
+
+                self.repository._save_passwords(hashed)
+
+                report.imported += len(hashed)
+                report.rejected += len(errors)
+                report.errors.extend(errors[:self.max_errors - len(report.errors)])
+                report.seconds = time.monotonic() - report.started
+
+                self.__save_checkpoint(report.processed)
+
+                if progress is not None:
+                    progress(report)
+
+            if not chunk:
+                return
+
+    def __load_checkpoint(self) -> int:
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return 0
+
+        with open(self.checkpoint_path) as f:
+            return int(json.load(f)["processed"])
+
+    def __save_checkpoint(self, processed: int) -> None:
+        if self.checkpoint_path is None:
+            return
+
+        # Written aside and renamed, so that a crash never leaves a torn checkpoint
+        temporary_path = self.checkpoint_path + ".tmp"
+
+        with open(temporary_path, "w") as f:
+            json.dump({"processed": processed}, f)
+
+        os.replace(temporary_path, self.checkpoint_path)
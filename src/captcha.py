@@ -2,15 +2,27 @@ from __future__ import print_function
 
 import base64
 import glob
+import logging
 import os
 import secrets
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 from os.path import basename
-from typing import Dict, Set, Callable
+from typing import Dict, Set, Callable, List, Optional, Iterable
 
 import inflect as inflect
 from PIL import Image
 
+from . import metrics
+from .image_store import ImageStore
+
+IMAGE_EXTENSIONS = (".gif", ".jpg", ".jpeg", ".png", ".tiff", ".bmp")
+MINIMAL_IMAGES_PER_FOLDER = 3
+TILE_SIZE = (200, 200)
+DEFAULT_THUMBNAIL_CACHE_BYTES = 128 * 1024 * 1024
+
 
 def require_singular(folder: str) -> Set[str]:
     return {folder}
@@ -20,50 +32,126 @@ def allow_plural(folder: str) -> Set[str]:
     return {folder, inflect.engine().plural(folder)}
 
 
-def generate_captcha_challenge(image_root_folder: str = "captcha-images",
-                               solutions_for_folder: Callable[[str], Set[str]] = allow_plural) -> (str, Set[str]):
-    folders = glob.glob(image_root_folder + "/*")
+def list_images(folder: str) -> List[str]:
+    try:
+        names = sorted(os.listdir(folder))
+    except (NotADirectoryError, FileNotFoundError):
+        return []
 
-    if not folders:
-        raise ValueError("Bad or empty path: " + image_root_folder)
+    # Hidden files are skipped, the same way glob would
+    return [os.path.join(folder, name) for name in names
+            if not name.startswith(".") and name.endswith(IMAGE_EXTENSIONS)]
 
-    if len(folders) == 1:
-        raise ValueError("Root folder has only one subdirectory: " + image_root_folder)
 
-    for folder in folders:
-        file_count = 0
+def load_tile(path: str) -> Image.Image:
+    img = Image.open(os.path.expanduser(path))
+    img.thumbnail(TILE_SIZE, Image.ANTIALIAS)
+    return img
 
-        for extension in ["*.gif", "*.jpg", "*.jpeg", "*.png", "*.tiff", "*.bmp"]:
-            file_count += len(glob.glob1(folder, extension))
 
-        if file_count < 3:
-            raise ValueError("Not enough images in sub-directory " + folder)
+class ThumbnailCache(object):
+    """
+    A bounded LRU cache of decoded, thumbnailed captcha tiles, keyed by image path.
+    :param max_bytes: budget for the decoded pixel data of all cached tiles
+    """
+    def __init__(self, max_bytes: int = DEFAULT_THUMBNAIL_CACHE_BYTES):
+        if max_bytes <= 0:
+            raise ValueError("Bad max_bytes")
 
-    main_folder = secrets.choice(folders)
+        self.max_bytes = max_bytes
 
-    secondary_folder = secrets.choice(folders)
+        self.__lock = threading.Lock()
+        self.__tiles: OrderedDict = OrderedDict()
+        self.__size_in_bytes = 0
+        self.hits = 0
+        self.misses = 0
 
-    while secondary_folder == main_folder:
-        secondary_folder = secrets.choice(folders)
+    @property
+    def size_in_bytes(self) -> int:
+        return self.__size_in_bytes
 
-    images = glob.glob(main_folder + "/*")
+    def __len__(self) -> int:
+        return len(self.__tiles)
 
-    selected_images = set()
+    def __contains__(self, path: str) -> bool:
+        return path in self.__tiles
 
-    while len(selected_images) < 3:
-        selected_images.add(secrets.choice(images))
+    def get(self, path: str) -> Image.Image:
+        with self.__lock:
+            tile = self.__tiles.get(path)
+
+            if tile is not None:
+                self.__tiles.move_to_end(path)
+                self.hits += 1
+                return tile
+
+            self.misses += 1
+
+        # Decoding happens outside the lock, so a miss doesn't block other challenges
+        tile = load_tile(path)
+        self.__put(path, tile)
+
+        return tile
+
+    def warm_up(self, paths: Iterable[str]) -> int:
+        loaded = 0
+
+        for path in paths:
+            if path in self.__tiles:
+                continue
+
+            tile = load_tile(path)
+
+            if self.__size_in_bytes + self.tile_size_in_bytes(tile) > self.max_bytes:
+                break
+
+            self.__put(path, tile)
+            loaded += 1
+
+        return loaded
+
+    def discard(self, paths: Iterable[str]) -> None:
+        with self.__lock:
+            for path in paths:
+                tile = self.__tiles.pop(path, None)
+
+                if tile is not None:
+                    self.__size_in_bytes -= self.tile_size_in_bytes(tile)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__tiles.clear()
+            self.__size_in_bytes = 0
 
-    selected_images.add(secrets.choice(glob.glob(secondary_folder + "/*")))
+    @staticmethod
+    def tile_size_in_bytes(tile: Image.Image) -> int:
+        width, height = tile.size
+        return width * height * len(tile.getbands())
 
-    selected_list = list(selected_images)
-    secrets.SystemRandom().shuffle(selected_list)
+    def __put(self, path: str, tile: Image.Image) -> None:
+        size = self.tile_size_in_bytes(tile)
 
+        if size > self.max_bytes:
+            return
+
+        with self.__lock:
+            if path in self.__tiles:
+                return
+
+            self.__tiles[path] = tile
+            self.__size_in_bytes += size
+
+            while self.__size_in_bytes > self.max_bytes:
+                _, evicted = self.__tiles.popitem(last=False)
+                self.__size_in_bytes -= self.tile_size_in_bytes(evicted)
+
+
+def render_challenge_jpeg(selected_images: Iterable[str], thumbnail_cache: Optional[ThumbnailCache] = None) \
+        -> bytes:
     result = Image.new("RGB", (400, 400))
 
     for index, file in enumerate(selected_images):
-        path = os.path.expanduser(file)
-        img = Image.open(path)
-        img.thumbnail((200, 200), Image.ANTIALIAS)
+        img = thumbnail_cache.get(file) if thumbnail_cache is not None else load_tile(file)
         x = index // 2 * 200
         y = index % 2 * 200
         w, h = img.size
@@ -71,10 +159,192 @@ def generate_captcha_challenge(image_root_folder: str = "captcha-images",
 
     data = BytesIO()
     result.save(data, "JPEG")
-    data64 = base64.b64encode(data.getvalue())
 
-    data_uri = u'data:img/jpeg;base64,' + data64.decode('utf-8')
+    return data.getvalue()
+
+
+def to_data_uri(jpeg: bytes) -> str:
+    data64 = base64.b64encode(jpeg)
+
+    return u'data:img/jpeg;base64,' + data64.decode('utf-8')
+
+
+def render_challenge(selected_images: Iterable[str], thumbnail_cache: Optional[ThumbnailCache] = None) -> str:
+    return to_data_uri(render_challenge_jpeg(selected_images, thumbnail_cache))
+
+
+def select_images(folders: List[str], index: Dict[str, List[str]]) -> (Set[str], str):
+    main_folder = secrets.choice(folders)
+
+    secondary_folder = secrets.choice(folders)
+
+    while secondary_folder == main_folder:
+        secondary_folder = secrets.choice(folders)
+
+    images = index[main_folder]
+
+    selected_images = set()
+
+    while len(selected_images) < 3:
+        selected_images.add(secrets.choice(images))
+
+    selected_images.add(secrets.choice(index[secondary_folder]))
+
+    return selected_images, main_folder
+
+
+class CaptchaCatalog(object):
+    """
+    An in-memory index of category folder -> image paths, scanned and validated once. Challenges are served
+    from the index, so no file system listing happens on the request path.
+    :param image_root_folder: root folder, holding one sub-folder per category
+    :param solutions_for_folder: maps a category folder name to the accepted solutions
+    :param check_interval: if positive, every that many seconds a challenge request stats the folders and
+    rescans the tree if anything changed. Zero means the tree is only rescanned on explicit refresh()
+    :param thumbnail_cache: if given, tiles are taken from it instead of being decoded per challenge
+    :param warm_up: eagerly fill the thumbnail cache with the catalog images, up to its budget
+    :param image_store: if given, rendered images are kept there and challenges carry their url instead of an
+    inline data uri
+    """
+    def __init__(self, image_root_folder: str = "captcha-images",
+                 solutions_for_folder: Callable[[str], Set[str]] = allow_plural,
+                 check_interval: float = 0, thumbnail_cache: Optional[ThumbnailCache] = None,
+                 warm_up: bool = False, image_store: Optional[ImageStore] = None):
+        if check_interval < 0:
+            raise ValueError("Bad check_interval")
+
+        self.image_root_folder = image_root_folder
+        self.solutions_for_folder = solutions_for_folder
+        self.check_interval = check_interval
+        self.thumbnail_cache = thumbnail_cache
+        self.image_store = image_store
+
+        self.__scan_lock = threading.Lock()
+        self.__folders: List[str] = []
+        self.__index: Dict[str, List[str]] = {}
+        self.__modification_times: Dict[str, float] = {}
+        self.__last_check: float = time.monotonic()
+
+        self.refresh()
+
+        if warm_up:
+            self.warm_up()
+
+    @property
+    def folders(self) -> List[str]:
+        return list(self.__folders)
+
+    def images(self, folder: str) -> List[str]:
+        return list(self.__index[folder])
+
+    def refresh(self) -> None:
+        with self.__scan_lock:
+            folders = glob.glob(self.image_root_folder + "/*")
+
+            if not folders:
+                raise ValueError("Bad or empty path: " + self.image_root_folder)
+
+            if len(folders) == 1:
+                raise ValueError("Root folder has only one subdirectory: " + self.image_root_folder)
+
+            index: Dict[str, List[str]] = {}
+
+            for folder in folders:
+                images = list_images(folder)
+
+                if len(images) < MINIMAL_IMAGES_PER_FOLDER:
+                    raise ValueError("Not enough images in sub-directory " + folder)
+
+                index[folder] = images
+
+            modification_times = self.__stat_tree(folders)
+
+            if self.thumbnail_cache is not None:
+                # Files may have been replaced under the same path
+                self.thumbnail_cache.discard(path for images in self.__index.values() for path in images)
+
+            # Swapped together, so a concurrent challenge always sees a consistent index
+            self.__folders, self.__index = folders, index
+            self.__modification_times = modification_times
+            self.__last_check = time.monotonic()
+
+    def warm_up(self) -> int:
+        if self.thumbnail_cache is None:
+            raise ValueError("No thumbnail cache to warm up")
+
+        return self.thumbnail_cache.warm_up(path for folder in self.__folders for path in self.__index[folder])
+
+    def refresh_if_changed(self) -> bool:
+        self.__last_check = time.monotonic()
 
-    solutions = solutions_for_folder(basename(main_folder))
+        if self.__stat_tree(self.__folders) == self.__modification_times:
+            return False
 
-    return data_uri, solutions
+        self.refresh()
+        return True
+
+    def generate_challenge(self, solutions_for_folder: Optional[Callable[[str], Set[str]]] = None) \
+            -> (str, Set[str]):
+        if self.check_interval and time.monotonic() - self.__last_check >= self.check_interval:
+            try:
+                self.refresh_if_changed()
+            except ValueError:
+                # The tree is mid-update or broken: keep serving the last valid index, and retry next interval
+                logging.exception("Captcha image rescan failed")
+
+        with metrics.timer("captcha_generation_seconds"):
+            selected_images, main_folder = self.select_images()
+
+            jpeg = render_challenge_jpeg(selected_images, self.thumbnail_cache)
+
+            solutions = (solutions_for_folder or self.solutions_for_folder)(basename(main_folder))
+
+            return self.publish(jpeg), solutions
+
+    def publish(self, jpeg: bytes) -> str:
+        if self.image_store is None:
+            return to_data_uri(jpeg)
+
+        return self.image_store.url(self.image_store.store(jpeg))
+
+    def select_images(self) -> (Set[str], str):
+        return select_images(self.__folders, self.__index)
+
+    def snapshot(self) -> (List[str], Dict[str, List[str]]):
+        folders, index = self.__folders, self.__index
+        return list(folders), {folder: list(images) for folder, images in index.items()}
+
+    def __stat_tree(self, folders: List[str]) -> Dict[str, float]:
+        modification_times = {}
+
+        for path in [self.image_root_folder] + folders:
+            try:
+                modification_times[path] = os.stat(path).st_mtime
+            except OSError:
+                modification_times[path] = -1
+
+        return modification_times
+
+
+_catalogs: Dict[str, CaptchaCatalog] = {}
+_catalogs_lock = threading.Lock()
+_default_thumbnail_cache = ThumbnailCache()
+
+
+def get_catalog(image_root_folder: str = "captcha-images") -> CaptchaCatalog:
+    catalog = _catalogs.get(image_root_folder)
+
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(image_root_folder)
+
+            if catalog is None:
+                catalog = CaptchaCatalog(image_root_folder, thumbnail_cache=_default_thumbnail_cache)
+                _catalogs[image_root_folder] = catalog
+
+    return catalog
+
+
+def generate_captcha_challenge(image_root_folder: str = "captcha-images",
+                               solutions_for_folder: Callable[[str], Set[str]] = allow_plural) -> (str, Set[str]):
+    return get_catalog(image_root_folder).generate_challenge(solutions_for_folder)
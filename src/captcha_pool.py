@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+from typing import Set, Callable, Optional, List, Tuple, Union
+
+from .captcha import CaptchaCatalog
+from .captcha_renderer import ProcessCaptchaRenderer
+
+REFILL_CHECK_INTERVAL = 1
+
+
+class CaptchaPool(object):
+    """
+    A bounded queue of ready-made captcha challenges, filled by background worker threads. Every challenge is
+    handed out at most once. When the pool runs dry, a challenge is generated synchronously.
+    :param catalog: the catalog, or process renderer, challenges are generated from
+    :param size: maximal number of challenges kept ready
+    :param low_water_mark: workers are woken up to refill once the pool shrinks to that many challenges
+    :param worker_count: number of background worker threads
+    """
+    def __init__(self, catalog: Union[CaptchaCatalog, ProcessCaptchaRenderer], size: int = 64,
+                 low_water_mark: int = 16, worker_count: int = 1,
+                 solutions_for_folder: Optional[Callable[[str], Set[str]]] = None):
+        if size <= 0:
+            raise ValueError("Bad size")
+
+        if not 0 <= low_water_mark < size:
+            raise ValueError("Bad low_water_mark")
+
+        if worker_count <= 0:
+            raise ValueError("Bad worker_count")
+
+        self.catalog = catalog
+        self.size = size
+        self.low_water_mark = low_water_mark
+        self.worker_count = worker_count
+        self.solutions_for_folder = solutions_for_folder
+
+        self.served = 0
+        self.fallbacks = 0
+
+        self.__queue: queue.Queue = queue.Queue(maxsize=size)
+        self.__refill_event = threading.Event()
+        self.__thread_stop_event = threading.Event()
+        self.__threads: List[threading.Thread] = []
+
+    def __len__(self) -> int:
+        return self.__queue.qsize()
+
+    def start(self) -> None:
+        self.__thread_stop_event.clear()
+        self.__refill_event.set()
+
+        for _ in range(self.worker_count):
+            thread = threading.Thread(target=self.__run_worker, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self) -> None:
+        self.__thread_stop_event.set()
+        self.__refill_event.set()
+
+        for thread in self.__threads:
+            thread.join()
+
+        self.__threads = []
+
+    def fill(self) -> None:
+        while not self.__queue.full():
+            try:
+                self.__queue.put_nowait(self.generate())
+            except queue.Full:
+                break
+
+    def get(self) -> Tuple[str, Set[str]]:
+        try:
+            challenge = self.__queue.get_nowait()
+        except queue.Empty:
+            challenge = None
+
+        if self.__queue.qsize() <= self.low_water_mark:
+            self.__refill_event.set()
+
+        if challenge is None:
+            self.fallbacks += 1
+            challenge = self.generate()
+
+        self.served += 1
+        return challenge
+
+    def generate(self) -> Tuple[str, Set[str]]:
+        return self.catalog.generate_challenge(self.solutions_for_folder)
+
+    def __run_worker(self):
+        while not self.__thread_stop_event.is_set():
+            if not self.__refill_event.wait(REFILL_CHECK_INTERVAL):
+                continue
+
+            self.__refill_event.clear()
+
+            while not self.__thread_stop_event.is_set() and not self.__queue.full():
+                try:
+                    challenge = self.generate()
+                except Exception as e:
+                    logging.exception(e)
+                    break
+
+                try:
+                    self.__queue.put_nowait(challenge)
+                except queue.Full:
+                    break
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from os.path import basename
+from typing import Set, Callable, Optional, List, Dict, Tuple, Union
+
+from .captcha import CaptchaCatalog, ThumbnailCache, select_images, render_challenge_jpeg, to_data_uri, \
+    DEFAULT_THUMBNAIL_CACHE_BYTES
+
+# Per worker process state, set once by the pool initializer
+_worker_folders: List[str] = []
+_worker_index: Dict[str, List[str]] = {}
+_worker_thumbnail_cache: Optional[ThumbnailCache] = None
+_worker_encodes_data_uri = True
+
+
+def _initialize_worker(folders: List[str], index: Dict[str, List[str]], thumbnail_cache_bytes: int,
+                       encode_data_uri: bool) -> None:
+    global _worker_folders, _worker_index, _worker_thumbnail_cache, _worker_encodes_data_uri
+
+    _worker_folders = folders
+    _worker_index = index
+    _worker_thumbnail_cache = ThumbnailCache(thumbnail_cache_bytes) if thumbnail_cache_bytes else None
+    _worker_encodes_data_uri = encode_data_uri
+
+
+def _render_in_worker() -> Tuple[Union[str, bytes], str]:
+    selected_images, main_folder = select_images(_worker_folders, _worker_index)
+    jpeg = render_challenge_jpeg(selected_images, _worker_thumbnail_cache)
+
+    # With an image store, the raw bytes go back to the parent, which owns the store
+    return to_data_uri(jpeg) if _worker_encodes_data_uri else jpeg, main_folder
+
+
+class ProcessCaptchaRenderer(object):
+    """
+    Renders captcha challenges on a process pool, so the Pillow and encoding work doesn't serialize on the GIL.
+    The catalog index is shipped to each worker once, when it starts; a task carries no arguments.
+    :param catalog: the catalog whose index the workers render from
+    :param max_workers: number of worker processes, defaults to the number of processors
+    :param thumbnail_cache_bytes: budget of the thumbnail cache of each worker, 0 disables it
+    """
+    def __init__(self, catalog: CaptchaCatalog, max_workers: Optional[int] = None,
+                 thumbnail_cache_bytes: int = DEFAULT_THUMBNAIL_CACHE_BYTES,
+                 solutions_for_folder: Optional[Callable[[str], Set[str]]] = None):
+        if max_workers is not None and max_workers <= 0:
+            raise ValueError("Bad max_workers")
+
+        if thumbnail_cache_bytes < 0:
+            raise ValueError("Bad thumbnail_cache_bytes")
+
+        self.catalog = catalog
+        self.max_workers = max_workers
+        self.thumbnail_cache_bytes = thumbnail_cache_bytes
+        self.solutions_for_folder = solutions_for_folder or catalog.solutions_for_folder
+
+        self.__lock = threading.Lock()
+        self.__executor: ProcessPoolExecutor = self.__create_executor()
+
+    def __create_executor(self) -> ProcessPoolExecutor:
+        folders, index = self.catalog.snapshot()
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=_initialize_worker,
+                                   initargs=(folders, index, self.thumbnail_cache_bytes,
+                                             self.catalog.image_store is None))
+
+    def reload(self) -> None:
+        """Replaces the workers, so they pick up the current catalog index"""
+        with self.__lock:
+            old_executor = self.__executor
+            self.__executor = self.__create_executor()
+
+        old_executor.shutdown(wait=True)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.__executor.shutdown(wait=wait)
+
+    def submit(self, solutions_for_folder: Optional[Callable[[str], Set[str]]] = None) -> Future:
+        solutions_for_folder = solutions_for_folder or self.solutions_for_folder
+        result: Future = Future()
+
+        def on_rendered(rendering: Future):
+            try:
+                image, main_folder = rendering.result()
+                url = image if isinstance(image, str) else self.catalog.publish(image)
+                # Solutions are computed here, so the callable never has to be pickled
+                result.set_result((url, solutions_for_folder(basename(main_folder))))
+            except Exception as e:
+                result.set_exception(e)
+
+        with self.__lock:
+            rendering_future = self.__executor.submit(_render_in_worker)
+
+        rendering_future.add_done_callback(on_rendered)
+
+        return result
+
+    def generate_challenge(self, solutions_for_folder: Optional[Callable[[str], Set[str]]] = None) \
+            -> (str, Set[str]):
+        return self.submit(solutions_for_folder).result()
+
+    def generate_challenge_async(self, solutions_for_folder: Optional[Callable[[str], Set[str]]] = None) \
+            -> asyncio.Future:
+        return asyncio.wrap_future(self.submit(solutions_for_folder))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -0,0 +1,163 @@
+import ipaddress
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class SlidingWindowCounter(object):
+    """
+    Counts events per key over a sliding window, approximated by a current and a previous fixed window: the
+    previous window is weighted by the part of it still covered by the sliding window.
+    :param window: window length in seconds
+    :param max_keys: keys tracked at most; beyond that, the least recently active keys are dropped
+    """
+    def __init__(self, window: float = 60, max_keys: int = 100000):
+        if window <= 0:
+            raise ValueError("Bad window")
+
+        if max_keys <= 0:
+            raise ValueError("Bad max_keys")
+
+        self.window = window
+        self.max_keys = max_keys
+
+        self.__lock = threading.Lock()
+        # Key -> [current window start, current count, previous count], least recently active first
+        self.__counters: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__counters)
+
+    def add(self, key: str, now: Optional[float] = None, amount: int = 1) -> float:
+        now = time.time() if now is None else now
+
+        with self.__lock:
+            counter = self.__counters.get(key)
+
+            if counter is None:
+                if len(self.__counters) >= self.max_keys:
+                    self.__evict(now)
+
+                counter = self.__counters[key] = [self.__window_start(now), 0, 0]
+            else:
+                self.__slide(counter, now)
+                self.__counters.move_to_end(key)
+
+            counter[1] += amount
+
+            return self.__estimate(counter, now)
+
+    def count(self, key: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+
+        with self.__lock:
+            counter = self.__counters.get(key)
+
+            if counter is None:
+                return 0
+
+            self.__slide(counter, now)
+
+            return self.__estimate(counter, now)
+
+    def __window_start(self, now: float) -> float:
+        return now - now % self.window
+
+    def __slide(self, counter: List[float], now: float) -> None:
+        window_start = self.__window_start(now)
+
+        if window_start == counter[0]:
+            return
+
+        # The current window becomes the previous one only if they are adjacent
+        counter[2] = counter[1] if window_start - counter[0] == self.window else 0
+        counter[1] = 0
+        counter[0] = window_start
+
+    def __estimate(self, counter: List[float], now: float) -> float:
+        uncovered = (now - counter[0]) / self.window
+        return counter[1] + counter[2] * (1 - uncovered)
+
+    def __evict(self, now: float) -> None:
+        oldest_relevant = self.__window_start(now) - self.window
+
+        for key in [key for key, counter in self.__counters.items() if counter[0] < oldest_relevant]:
+            del self.__counters[key]
+
+        # Still full of active keys: drop the least recently active half, so that a spray of new sources
+        # cannot push out the busy ones
+        if len(self.__counters) >= self.max_keys:
+            for _ in range(len(self.__counters) // 2 + 1):
+                self.__counters.popitem(last=False)
+
+
+class AdaptiveDifficulty(object):
+    """
+    Chooses the hashcash zero count per source. Requests and failed validations are counted per IP address and
+    per subnet over a sliding window; reaching a threshold adds a zero bit, and so does every doubling of the
+    load beyond it - each bit doubles the expected work of the client. Difficulty relaxes by itself as the window
+    slides past the load.
+    :param base_zero_count: zero count issued to calm sources
+    :param max_zero_count: zero count never exceeded
+    :param request_threshold: requests per window from an IP address before difficulty rises
+    :param failure_threshold: failed validations per window from an IP address before difficulty rises
+    :param subnet_multiplier: thresholds of a subnet are this many times those of an IP address
+    """
+    def __init__(self, base_zero_count: int, max_zero_count: int = 24, window: float = 60,
+                 request_threshold: int = 30, failure_threshold: int = 5, subnet_multiplier: int = 8,
+                 ipv4_prefix: int = 24, ipv6_prefix: int = 64, max_tracked_sources: int = 100000):
+        if base_zero_count < 0:
+            raise ValueError("Bad base_zero_count")
+
+        if max_zero_count < base_zero_count:
+            raise ValueError("Bad max_zero_count")
+
+        if request_threshold <= 0 or failure_threshold <= 0 or subnet_multiplier <= 0:
+            raise ValueError("Bad threshold")
+
+        self.base_zero_count = base_zero_count
+        self.max_zero_count = max_zero_count
+        self.request_threshold = request_threshold
+        self.failure_threshold = failure_threshold
+        self.subnet_multiplier = subnet_multiplier
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+
+        self.requests = SlidingWindowCounter(window, max_tracked_sources)
+        self.failures = SlidingWindowCounter(window, max_tracked_sources)
+
+    def subnet(self, remote_address: str) -> str:
+        try:
+            address = ipaddress.ip_address(remote_address)
+        except ValueError:
+            return remote_address
+
+        prefix = self.ipv4_prefix if address.version == 4 else self.ipv6_prefix
+        return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+    def record_request(self, remote_address: str, now: Optional[float] = None) -> None:
+        self.requests.add(remote_address, now)
+        self.requests.add(self.subnet(remote_address), now)
+
+    def record_failure(self, remote_address: str, now: Optional[float] = None) -> None:
+        self.failures.add(remote_address, now)
+        self.failures.add(self.subnet(remote_address), now)
+
+    def zero_count(self, remote_address: str, now: Optional[float] = None) -> int:
+        subnet = self.subnet(remote_address)
+
+        pressure = max(self.requests.count(remote_address, now) / self.request_threshold,
+                       self.failures.count(remote_address, now) / self.failure_threshold,
+                       self.requests.count(subnet, now) / (self.request_threshold * self.subnet_multiplier),
+                       self.failures.count(subnet, now) / (self.failure_threshold * self.subnet_multiplier))
+
+        extra_zeros = int(math.log2(pressure)) + 1 if pressure >= 1 else 0
+
+        return min(self.max_zero_count, self.base_zero_count + extra_zeros)
+
+    def issue(self, remote_address: str, now: Optional[float] = None) -> int:
+        """Records a login form request, and returns the zero count to issue for it"""
+        self.record_request(remote_address, now)
+        return self.zero_count(remote_address, now)
@@ -0,0 +1,243 @@
+import abc
+import collections
+import mmap
+import os
+import secrets
+import threading
+import time
+from typing import Optional, Dict, Tuple, Deque
+
+IMAGE_ID_LENGTH = 24
+PURGE_FREQUENCY = 100
+
+
+class ImageStore(abc.ABC):
+    """
+    A short-lived store of rendered captcha images, addressed by unguessable ids.
+    :param time_to_live: seconds an image stays available after it was stored
+    :param url_prefix: prepended to an image id to form the url handed to the client
+    """
+    def __init__(self, time_to_live: int = 120, url_prefix: str = ""):
+        if time_to_live <= 0:
+            raise ValueError("Bad time_to_live")
+
+        self.time_to_live = time_to_live
+        self.url_prefix = url_prefix
+
+    @abc.abstractmethod
+    def _save_image(self, image_id: str, data: bytes, expiry: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _load_image(self, image_id: str, now: float) -> Optional[memoryview]:
+        pass
+
+    @abc.abstractmethod
+    def _delete_image(self, image_id: str) -> None:
+        pass
+
+    def store(self, data: bytes) -> str:
+        image_id = secrets.token_urlsafe(IMAGE_ID_LENGTH)
+        self._save_image(image_id, data, time.time() + self.time_to_live)
+        return image_id
+
+    def url(self, image_id: str) -> str:
+        return self.url_prefix + image_id
+
+    def serve(self, image_id: str) -> Optional[memoryview]:
+        """
+        Returns the raw bytes of a stored image without copying them
+        :param image_id: an id returned by store()
+        :return: a view of the image, or None if it is unknown or expired
+        """
+        if not image_id or len(image_id) > IMAGE_ID_LENGTH * 2:
+            return None
+
+        return self._load_image(image_id, time.time())
+
+    def delete(self, image_id: str) -> None:
+        self._delete_image(image_id)
+
+
+class InMemoryImageStore(ImageStore):
+    def __init__(self, time_to_live: int = 120, url_prefix: str = ""):
+        super().__init__(time_to_live, url_prefix)
+
+        self.__lock = threading.Lock()
+        self.__images: Dict[str, Tuple[float, bytes]] = {}
+        # Every image lives for the same time, so insertion order is also expiry order
+        self.__expiry_queue: Deque[Tuple[float, str]] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self.__images)
+
+    def _save_image(self, image_id: str, data: bytes, expiry: float) -> None:
+        with self.__lock:
+            self.__purge(time.time())
+            self.__images[image_id] = (expiry, bytes(data))
+            self.__expiry_queue.append((expiry, image_id))
+
+    def _load_image(self, image_id: str, now: float) -> Optional[memoryview]:
+        entry = self.__images.get(image_id)
+
+        if entry is None or entry[0] < now:
+            return None
+
+        return memoryview(entry[1])
+
+    def _delete_image(self, image_id: str) -> None:
+        with self.__lock:
+            self.__images.pop(image_id, None)
+
+    def __purge(self, now: float) -> None:
+        while self.__expiry_queue and self.__expiry_queue[0][0] < now:
+            _, image_id = self.__expiry_queue.popleft()
+            self.__images.pop(image_id, None)
+
+
+class FileSystemImageStore(ImageStore):
+    """
+    Keeps images as files in a directory, so several processes can serve each other's images.
+    Expiry is derived from the file modification time.
+    """
+    def __init__(self, directory: str, time_to_live: int = 120, url_prefix: str = ""):
+        super().__init__(time_to_live, url_prefix)
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.__saves_since_purge = 0
+
+    def _save_image(self, image_id: str, data: bytes, expiry: float) -> None:
+        path = os.path.join(self.directory, image_id)
+        temporary_path = path + ".tmp"
+
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temporary_path, path)
+
+        self.__saves_since_purge += 1
+
+        if self.__saves_since_purge >= PURGE_FREQUENCY:
+            self.__saves_since_purge = 0
+            self.purge()
+
+    def _load_image(self, image_id: str, now: float) -> Optional[memoryview]:
+        # Ids are url-safe base64, anything else might be a path traversal attempt
+        if not image_id.replace("-", "").replace("_", "").isalnum():
+            return None
+
+        path = os.path.join(self.directory, image_id)
+
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_mtime + self.time_to_live < now:
+                    return None
+
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        return memoryview(data)
+
+    def _delete_image(self, image_id: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, image_id))
+        except FileNotFoundError:
+            pass
+
+    def purge(self) -> None:
+        oldest_acceptable = time.time() - self.time_to_live
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < oldest_acceptable:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class MemoryMappedImageStore(ImageStore):
+    """
+    Writes images one after the other into a fixed-size memory-mapped ring segment. Memory use is bounded by
+    the segment size: when the segment wraps around, the oldest images are overwritten and forgotten.
+    Served views point directly into the segment, so they should be consumed before the segment wraps.
+    :param segment_size: size of the segment in bytes
+    :param path: optional file to back the segment with; anonymous memory is used otherwise
+    """
+    def __init__(self, segment_size: int = 64 * 1024 * 1024, time_to_live: int = 120, url_prefix: str = "",
+                 path: Optional[str] = None):
+        super().__init__(time_to_live, url_prefix)
+
+        if segment_size <= 0:
+            raise ValueError("Bad segment_size")
+
+        self.segment_size = segment_size
+
+        if path:
+            with open(path, "wb") as f:
+                f.truncate(segment_size)
+
+            with open(path, "r+b") as f:
+                self.__segment = mmap.mmap(f.fileno(), segment_size)
+        else:
+            self.__segment = mmap.mmap(-1, segment_size)
+
+        self.__lock = threading.Lock()
+        self.__write_position = 0
+        self.__images: Dict[str, Tuple[int, int, float]] = {}
+        # Images in write order, which is also the order in which they are overwritten
+        self.__written: Deque[Tuple[str, int, int]] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self.__images)
+
+    def _save_image(self, image_id: str, data: bytes, expiry: float) -> None:
+        length = len(data)
+
+        if length > self.segment_size:
+            raise ValueError(f"Image of {length} bytes doesn't fit in the segment")
+
+        with self.__lock:
+            start = self.__write_position
+
+            if start + length > self.segment_size:
+                # Wrapping around: the tail of the segment is left unused
+                self.__forget_overlapping(start, self.segment_size)
+                start = 0
+
+            self.__forget_overlapping(start, start + length)
+
+            self.__segment[start:start + length] = data
+            self.__write_position = start + length
+
+            self.__images[image_id] = (start, length, expiry)
+            self.__written.append((image_id, start, length))
+
+    def _load_image(self, image_id: str, now: float) -> Optional[memoryview]:
+        entry = self.__images.get(image_id)
+
+        if entry is None:
+            return None
+
+        start, length, expiry = entry
+
+        if expiry < now:
+            return None
+
+        return memoryview(self.__segment)[start:start + length]
+
+    def _delete_image(self, image_id: str) -> None:
+        with self.__lock:
+            self.__images.pop(image_id, None)
+
+    def __forget_overlapping(self, start: int, end: int) -> None:
+        while self.__written:
+            image_id, image_start, image_length = self.__written[0]
+
+            if image_start >= end or image_start + image_length <= start:
+                break
+
+            self.__written.popleft()
+            self.__images.pop(image_id, None)
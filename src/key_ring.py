@@ -0,0 +1,499 @@
+import abc
+import base64
+import collections
+import json
+import logging
+import math
+import mmap
+import os
+import secrets
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Tuple
+
+import schedule as schedule
+from cryptography.fernet import Fernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import fcntl
+except ImportError:
+    # Missing on Windows, where the key rings shared between processes are unavailable
+    fcntl = None
+
+SCHEDULER_SLEEP_TIME = 1
+KEY_ID_LENGTH = 6
+
+# Shared memory layout: magic, generation, key count, then the keys, newest first
+SHARED_MEMORY_MAGIC = b"SGKR"
+SHARED_MEMORY_HEADER = struct.Struct(">4sQH")
+SHARED_MEMORY_ENTRY = struct.Struct(">8s44sd")
+# Reads of an odd generation before suspecting the writer died, and waiting for the file lock to find out
+SHARED_MEMORY_SPINS = 1000
+
+MINIMAL_MASTER_SECRET_LENGTH = 32
+EPOCH_LENGTH = 6
+
+
+def generate_key_id() -> bytes:
+    return secrets.token_urlsafe(KEY_ID_LENGTH).encode()
+
+
+class KeySet(object):
+    """
+    An immutable generation of keys, newest first. A key was retired when the next one was created.
+    :param entries: (key id, Fernet key, creation time) tuples, newest first
+    """
+    def __init__(self, entries: List[Tuple[bytes, bytes, float]]):
+        self.entries = entries
+        self.key_ids: List[bytes] = [key_id for key_id, _, _ in entries]
+        self.keys: List[Fernet] = [Fernet(key) for _, key, _ in entries]
+        self.created_at: float = entries[0][2]
+        self.current: Tuple[bytes, Fernet] = (self.key_ids[0], self.keys[0])
+
+        retirement_times = [math.inf] + [created_at for _, _, created_at in entries[:-1]]
+        self.by_id: Dict[bytes, Tuple[Fernet, float]] = {
+            key_id: (key, retired_at) for key_id, key, retired_at in zip(self.key_ids, self.keys, retirement_times)
+        }
+
+    def renewed(self, max_keys: int, now: Optional[float] = None) -> "KeySet":
+        key_id = generate_key_id()
+
+        while key_id in self.by_id:
+            key_id = generate_key_id()
+
+        entry = (key_id, Fernet.generate_key(), time.time() if now is None else now)
+
+        return KeySet([entry] + self.entries[:max_keys - 1])
+
+    @staticmethod
+    def new(now: Optional[float] = None) -> "KeySet":
+        return KeySet([(generate_key_id(), Fernet.generate_key(), time.time() if now is None else now)])
+
+
+class KeyRing(abc.ABC):
+    """
+    Holds the state encryption keys: the current one, and the retired ones still needed for decryption.
+    A StateEncryptor binds its ring to the number of keys to keep and the renewal frequency.
+    """
+    def __init__(self):
+        self.max_keys = 1
+        self.key_renewal_frequency = 0
+
+    def bind(self, max_keys: int, key_renewal_frequency: int) -> None:
+        self.max_keys = max_keys
+        self.key_renewal_frequency = key_renewal_frequency
+        self._initialize()
+
+    @abc.abstractmethod
+    def _initialize(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _key_set(self) -> KeySet:
+        pass
+
+    @abc.abstractmethod
+    def renew(self) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    @property
+    def keys(self) -> List[Fernet]:
+        return self._key_set().keys
+
+    def current_key(self) -> Tuple[bytes, Fernet]:
+        return self._key_set().current
+
+    def find_key(self, key_id: bytes) -> Optional[Tuple[Fernet, float]]:
+        return self._key_set().by_id.get(key_id)
+
+    def _is_due(self, key_set: KeySet, now: float) -> bool:
+        return self.key_renewal_frequency > 0 and now >= key_set.created_at + self.key_renewal_frequency
+
+
+class LocalKeyRing(KeyRing):
+    """Keys live in this process only, and are renewed by a scheduler thread once started"""
+    def __init__(self):
+        super().__init__()
+        self.__key_set: Optional[KeySet] = None
+        self.__thread_stop_event = threading.Event()
+        # A scheduler of our own, so the process-wide default one isn't polluted
+        self.__scheduler = schedule.Scheduler()
+
+    def _initialize(self) -> None:
+        self.__key_set = KeySet.new()
+
+    def _key_set(self) -> KeySet:
+        return self.__key_set
+
+    def renew(self) -> None:
+        # Replaced whole, so encryption and decryption on other threads always see a consistent key ring
+        self.__key_set = self.__key_set.renewed(self.max_keys)
+        logging.debug(self.__key_set.key_ids)
+
+    def start(self):
+        self.__scheduler.every(self.key_renewal_frequency).seconds.do(self.renew)
+        thread = threading.Thread(target=self.__run_scheduler)
+        thread.start()
+
+    def stop(self):
+        self.__thread_stop_event.set()
+        self.__scheduler.clear()
+
+    def __run_scheduler(self):
+        while not self.__thread_stop_event.is_set():
+            self.__scheduler.run_pending()
+            time.sleep(SCHEDULER_SLEEP_TIME)
+
+
+class TimeBucketKeyRing(KeyRing):
+    """
+    Derives the key of every time bucket (key_renewal_frequency seconds long) from a master secret with HKDF.
+    The current key follows the clock, so there is no renewal thread, and all processes sharing the master
+    secret derive the same keys without any coordination. Derived keys are cached for the aging window.
+    """
+    def __init__(self, master_secret: bytes):
+        super().__init__()
+
+        if not master_secret or len(master_secret) < MINIMAL_MASTER_SECRET_LENGTH:
+            raise ValueError(f"Master secret must be of at least {MINIMAL_MASTER_SECRET_LENGTH} bytes")
+
+        self.__master_secret = master_secret
+        self.__lock = threading.Lock()
+        self.__derived_keys: collections.OrderedDict = collections.OrderedDict()
+
+    def _initialize(self) -> None:
+        with self.__lock:
+            self.__derived_keys.clear()
+
+    def epoch(self, now: float) -> int:
+        if self.key_renewal_frequency == 0:
+            return 0
+
+        return int(now // self.key_renewal_frequency)
+
+    def _key_set(self) -> KeySet:
+        current_epoch = self.epoch(time.time())
+        epochs = range(current_epoch, max(current_epoch - self.max_keys, -1), -1)
+
+        return KeySet([(self.__key_id(epoch), base64.urlsafe_b64encode(self.__derive(epoch)),
+                        epoch * self.key_renewal_frequency) for epoch in epochs])
+
+    def renew(self) -> None:
+        """Nothing to do: keys are renewed by the passage of time"""
+
+    def current_key(self) -> Tuple[bytes, Fernet]:
+        epoch = self.epoch(time.time())
+        return self.__key_id(epoch), self.__fernet(epoch)
+
+    def find_key(self, key_id: bytes) -> Optional[Tuple[Fernet, float]]:
+        try:
+            if len(key_id) != 8:
+                return None
+
+            epoch = int.from_bytes(base64.urlsafe_b64decode(key_id), "big")
+        except (ValueError, TypeError):
+            return None
+
+        current_epoch = self.epoch(time.time())
+
+        # One epoch ahead is tolerated, for processes whose clocks are slightly ahead
+        if not current_epoch - self.max_keys < epoch <= current_epoch + 1:
+            return None
+
+        retired_at = math.inf if epoch >= current_epoch else (epoch + 1) * self.key_renewal_frequency
+
+        return self.__fernet(epoch), retired_at
+
+    def __fernet(self, epoch: int) -> Fernet:
+        fernet = self.__derived_keys.get(epoch)
+
+        if fernet is None:
+            fernet = Fernet(base64.urlsafe_b64encode(self.__derive(epoch)))
+
+            with self.__lock:
+                self.__derived_keys[epoch] = fernet
+
+                # The window is all that can be looked up, plus the tolerated epoch ahead
+                while len(self.__derived_keys) > self.max_keys + 1:
+                    self.__derived_keys.popitem(last=False)
+
+        return fernet
+
+    def __derive(self, epoch: int) -> bytes:
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                    info=b"signum-state-key:" + epoch.to_bytes(EPOCH_LENGTH, "big"),
+                    backend=default_backend()).derive(self.__master_secret)
+
+    @staticmethod
+    def __key_id(epoch: int) -> bytes:
+        return base64.urlsafe_b64encode(epoch.to_bytes(EPOCH_LENGTH, "big"))
+
+
+def _require_file_locks(name: str) -> None:
+    if fcntl is None:
+        raise RuntimeError(f"{name} needs fcntl file locks, which this platform lacks")
+
+
+@contextmanager
+def _file_lock(path: str, blocking: bool = True):
+    with open(path, "a+b") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class SharedMemoryKeyRing(KeyRing):
+    """
+    Shares keys between the worker processes of one host through a memory-mapped file. Reading the keys is a
+    memory access: a worker only re-parses them when the generation counter in the file changes.
+    Rotation is lazy: the first worker to notice the current key is due, and to win the file lock, renews it.
+    """
+    def __init__(self, path: str):
+        _require_file_locks(type(self).__name__)
+        super().__init__()
+        self.path = path
+        self.__lock_path = path + ".lock"
+        self.__memory: Optional[mmap.mmap] = None
+        self.__generation = -1
+        self.__key_set: Optional[KeySet] = None
+
+    def _initialize(self) -> None:
+        size = SHARED_MEMORY_HEADER.size + self.max_keys * SHARED_MEMORY_ENTRY.size
+
+        with _file_lock(self.__lock_path):
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+
+                self.__memory = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+            magic, generation, count = SHARED_MEMORY_HEADER.unpack_from(self.__memory)
+
+            if magic != SHARED_MEMORY_MAGIC or count == 0:
+                self.__write(KeySet.new())
+            elif generation % 2:
+                self.__recover_abandoned_write()
+
+    def _key_set(self) -> KeySet:
+        key_set = self.__read()
+
+        if self._is_due(key_set, time.time()):
+            self.__renew_if_elected(blocking=False)
+            key_set = self.__read()
+
+        return key_set
+
+    def find_key(self, key_id: bytes) -> Optional[Tuple[Fernet, float]]:
+        # No lazy renewal on decryption: a flood of forged states must not trigger rotations
+        return self.__read().by_id.get(key_id)
+
+    def renew(self) -> None:
+        self.__renew_if_elected(blocking=True, force=True)
+
+    def __renew_if_elected(self, blocking: bool, force: bool = False) -> None:
+        with _file_lock(self.__lock_path, blocking) as elected:
+            if not elected:
+                return
+
+            key_set = self.__read(locked=True)
+
+            # Another worker may have renewed while this one waited
+            if force or self._is_due(key_set, time.time()):
+                self.__write(key_set.renewed(self.max_keys))
+
+    def __read(self, locked: bool = False) -> KeySet:
+        spins = 0
+
+        while True:
+            _, generation, _ = SHARED_MEMORY_HEADER.unpack_from(self.__memory)
+
+            if generation == self.__generation:
+                return self.__key_set
+
+            # An odd generation means a write is in progress
+            if generation % 2:
+                spins += 1
+
+                # Writers hold the file lock: once it is taken, an odd generation was left by a dead one
+                if locked:
+                    self.__recover_abandoned_write()
+                elif spins >= SHARED_MEMORY_SPINS:
+                    with _file_lock(self.__lock_path):
+                        if SHARED_MEMORY_HEADER.unpack_from(self.__memory)[1] % 2:
+                            self.__recover_abandoned_write()
+
+                    spins = 0
+                else:
+                    time.sleep(0)
+
+                continue
+
+            entries = self.__entries()
+
+            if SHARED_MEMORY_HEADER.unpack_from(self.__memory)[1] != generation:
+                continue
+
+            self.__key_set = KeySet(entries)
+            self.__generation = generation
+
+            return self.__key_set
+
+    def __entries(self) -> List[Tuple[bytes, bytes, float]]:
+        _, _, count = SHARED_MEMORY_HEADER.unpack_from(self.__memory)
+        entries = []
+
+        # Workers configured for fewer keys map a shorter file
+        for index in range(min(count, self.max_keys)):
+            key_id, key, created_at = SHARED_MEMORY_ENTRY.unpack_from(
+                self.__memory, SHARED_MEMORY_HEADER.size + index * SHARED_MEMORY_ENTRY.size)
+            entries.append((key_id, key, created_at))
+
+        return entries
+
+    def __recover_abandoned_write(self) -> None:
+        """Rewrites the keys a dead writer left half-written, under the file lock. Torn keys are replaced."""
+        try:
+            key_set = KeySet(self.__entries())
+        except (ValueError, IndexError):
+            key_set = KeySet.new()
+
+        self.__write(key_set)
+
+    def __write(self, key_set: KeySet) -> None:
+        magic, generation, _ = SHARED_MEMORY_HEADER.unpack_from(self.__memory)
+
+        if magic != SHARED_MEMORY_MAGIC:
+            generation = 0
+
+        # Left odd by an abandoned write
+        generation += generation % 2
+
+        entries = key_set.entries[:self.max_keys]
+
+        SHARED_MEMORY_HEADER.pack_into(self.__memory, 0, SHARED_MEMORY_MAGIC, generation + 1, len(entries))
+
+        for index, entry in enumerate(entries):
+            SHARED_MEMORY_ENTRY.pack_into(self.__memory,
+                                          SHARED_MEMORY_HEADER.size + index * SHARED_MEMORY_ENTRY.size, *entry)
+
+        SHARED_MEMORY_HEADER.pack_into(self.__memory, 0, SHARED_MEMORY_MAGIC, generation + 2, len(entries))
+
+
+class DirectoryKeyRing(KeyRing):
+    """
+    Shares keys between nodes through a directory on a shared file system, coordinated by a lock file.
+    A worker only reads the key file when its current key is due for renewal, so there is no per-request I/O.
+    An unknown key id triggers a reload at most every reload_interval seconds.
+    """
+    KEY_FILE_NAME = "keys.json"
+    LOCK_FILE_NAME = "keys.lock"
+
+    def __init__(self, directory: str, reload_interval: float = 1):
+        _require_file_locks(type(self).__name__)
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.reload_interval = reload_interval
+
+        self.__key_path = os.path.join(directory, DirectoryKeyRing.KEY_FILE_NAME)
+        self.__lock_path = os.path.join(directory, DirectoryKeyRing.LOCK_FILE_NAME)
+        self.__key_set: Optional[KeySet] = None
+        self.__last_load = 0.0
+
+    def _initialize(self) -> None:
+        with _file_lock(self.__lock_path):
+            key_set = self.__load()
+
+            if key_set is None:
+                key_set = KeySet.new()
+                self.__save(key_set)
+
+            self.__key_set = key_set
+            self.__last_load = time.monotonic()
+
+    def _key_set(self) -> KeySet:
+        key_set = self.__key_set
+
+        if self._is_due(key_set, time.time()):
+            self.__reload()
+            key_set = self.__key_set
+
+            if self._is_due(key_set, time.time()):
+                self.__renew_if_elected(force=False)
+                key_set = self.__key_set
+
+        return key_set
+
+    def find_key(self, key_id: bytes) -> Optional[Tuple[Fernet, float]]:
+        found = self.__key_set.by_id.get(key_id)
+
+        # The key may come from another node that rotated slightly earlier
+        if found is None and time.monotonic() - self.__last_load >= self.reload_interval:
+            self.__reload()
+            found = self.__key_set.by_id.get(key_id)
+
+        return found
+
+    def renew(self) -> None:
+        self.__renew_if_elected(force=True)
+
+    def __renew_if_elected(self, force: bool) -> None:
+        with _file_lock(self.__lock_path):
+            key_set = self.__load() or self.__key_set
+
+            if force or self._is_due(key_set, time.time()):
+                key_set = key_set.renewed(self.max_keys)
+                self.__save(key_set)
+
+            self.__key_set = key_set
+            self.__last_load = time.monotonic()
+
+    def __reload(self) -> None:
+        key_set = self.__load()
+
+        if key_set is not None:
+            self.__key_set = key_set
+
+        self.__last_load = time.monotonic()
+
+    def __load(self) -> Optional[KeySet]:
+        try:
+            with open(self.__key_path, "rt") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        return KeySet([(entry["id"].encode(), entry["key"].encode(), entry["created_at"]) for entry in entries])
+
+    def __save(self, key_set: KeySet) -> None:
+        temporary_path = self.__key_path + ".tmp"
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with os.fdopen(fd, "wt") as f:
+            json.dump([{"id": key_id.decode(), "key": key.decode(), "created_at": created_at}
+                       for key_id, key, created_at in key_set.entries[:self.max_keys]], f)
+
+        os.replace(temporary_path, self.__key_path)
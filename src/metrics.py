@@ -0,0 +1,249 @@
+import abc
+import logging
+import threading
+import time
+from typing import Dict, Tuple, Optional, List
+
+# Sorted (label name, label value) pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+# Histograms keep this many significant bits of every value, i.e. a relative error of about 1.5%
+HISTOGRAM_PRECISION_BITS = 6
+# Histogram values are recorded in microseconds
+HISTOGRAM_UNITS_PER_SECOND = 1000000
+
+PROMETHEUS_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class MetricsSink(abc.ABC):
+    # Instrumented code skips measuring altogether when the sink is disabled
+    enabled: bool = True
+
+    @abc.abstractmethod
+    def increment(self, name: str, amount: int, labels: Labels) -> None:
+        pass
+
+    @abc.abstractmethod
+    def observe(self, name: str, seconds: float, labels: Labels) -> None:
+        pass
+
+
+class NullMetricsSink(MetricsSink):
+    enabled = False
+
+    def increment(self, name: str, amount: int, labels: Labels) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float, labels: Labels) -> None:
+        pass
+
+
+class LoggingMetricsSink(MetricsSink):
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def increment(self, name: str, amount: int, labels: Labels) -> None:
+        self.logger.log(self.level, "%s%s += %d", name, _format_labels(labels), amount)
+
+    def observe(self, name: str, seconds: float, labels: Labels) -> None:
+        self.logger.log(self.level, "%s%s %.6fs", name, _format_labels(labels), seconds)
+
+
+class Histogram(object):
+    """
+    A log-linear histogram in the style of HdrHistogram: every value is kept in a bucket whose width is
+    proportional to the value, so memory stays small while percentiles keep a bounded relative error.
+    Values are recorded in microseconds.
+    """
+    def __init__(self, precision_bits: int = HISTOGRAM_PRECISION_BITS):
+        if precision_bits <= 0:
+            raise ValueError("Bad precision_bits")
+
+        self.precision_bits = precision_bits
+
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+        # Bucket lowest value -> bucket count
+        self.__buckets: Dict[int, int] = {}
+
+    def record(self, value: int) -> None:
+        value = max(0, int(value))
+
+        shift = max(0, value.bit_length() - self.precision_bits)
+        bucket = value >> shift << shift
+
+        self.__buckets[bucket] = self.__buckets.get(bucket, 0) + 1
+
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile: float) -> int:
+        if not 0 <= percentile <= 100:
+            raise ValueError("Bad percentile")
+
+        if self.count == 0:
+            return 0
+
+        rank = max(1, round(self.count * percentile / 100))
+        seen = 0
+
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+
+            if seen >= rank:
+                # The middle of the bucket, but never beyond the values actually recorded
+                shift = max(0, bucket.bit_length() - self.precision_bits)
+                return min(max(bucket + (1 << shift >> 1), self.min), self.max)
+
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class MetricsRegistry(MetricsSink):
+    """An in-process sink keeping counters and latency histograms, readable in the Prometheus text format"""
+    def __init__(self, precision_bits: int = HISTOGRAM_PRECISION_BITS):
+        self.precision_bits = precision_bits
+
+        self.__lock = threading.Lock()
+        self.__counters: Dict[Tuple[str, Labels], int] = {}
+        self.__histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def increment(self, name: str, amount: int, labels: Labels) -> None:
+        key = (name, labels)
+
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, labels: Labels) -> None:
+        key = (name, labels)
+
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram(self.precision_bits)
+
+            histogram.record(seconds * HISTOGRAM_UNITS_PER_SECOND)
+
+    def counter(self, name: str, **labels: str) -> int:
+        with self.__lock:
+            return self.__counters.get((name, _labels(labels)), 0)
+
+    def histogram(self, name: str, **labels: str) -> Optional[Histogram]:
+        with self.__lock:
+            return self.__histograms.get((name, _labels(labels)))
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    def exposition(self) -> str:
+        """The content of the registry in the Prometheus text exposition format, histograms as summaries"""
+        lines: List[str] = []
+
+        with self.__lock:
+            for name in sorted({name for name, _ in self.__counters}):
+                lines.append(f"# TYPE {name} counter")
+
+                for (counter_name, labels), value in sorted(self.__counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.__histograms}):
+                lines.append(f"# TYPE {name} summary")
+
+                for (histogram_name, labels), histogram in sorted(self.__histograms.items(), key=lambda i: i[0]):
+                    if histogram_name != name:
+                        continue
+
+                    for quantile in PROMETHEUS_QUANTILES:
+                        value = histogram.percentile(quantile * 100) / HISTOGRAM_UNITS_PER_SECOND
+                        quantile_labels = labels + (("quantile", str(quantile)),)
+                        lines.append(f"{name}{_format_labels(quantile_labels)} {value}")
+
+                    lines.append(f"{name}_sum{_format_labels(labels)} "
+                                 f"{histogram.total / HISTOGRAM_UNITS_PER_SECOND}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class _Timer(object):
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: Labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _sink.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+_sink: MetricsSink = NullMetricsSink()
+
+
+def set_sink(sink: Optional[MetricsSink]) -> None:
+    """Sets the sink all instrumented code reports to; None disables metrics"""
+    global _sink
+    _sink = NullMetricsSink() if sink is None else sink
+
+
+def get_sink() -> MetricsSink:
+    return _sink
+
+
+def increment(name: str, amount: int = 1, **labels: str) -> None:
+    if _sink.enabled:
+        _sink.increment(name, amount, _labels(labels))
+
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    if _sink.enabled:
+        _sink.observe(name, seconds, _labels(labels))
+
+
+def timer(name: str, **labels: str):
+    """A context manager reporting the time spent in its block, on the monotonic clock"""
+    if not _sink.enabled:
+        return _NULL_TIMER
+
+    return _Timer(name, _labels(labels))
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+               for _, value in labels)
+
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
@@ -0,0 +1,322 @@
+import math
+import mmap
+import os
+import queue
+import re
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, List, Tuple, Iterator
+
+from .password_hashing import PasswordHasher, HashingPool
+from .password_repository import PasswordRepository
+
+try:
+    import fcntl
+except ImportError:
+    # Missing on Windows, where the memory-mapped backend is unavailable
+    fcntl = None
+
+DEFAULT_CONNECTION_POOL_SIZE = 8
+
+# Hash table file layout: header, then fixed-size slots addressed by the hashed username
+HASH_TABLE_MAGIC = b"SGPT"
+# magic, slot count, used slots, generation (odd while a write is in progress), value size
+HASH_TABLE_HEADER = struct.Struct(">4sIIQH")
+# used flag, hashed username (raw SHA-256), value length; the value follows
+HASH_TABLE_SLOT = struct.Struct(">B32sH")
+HASH_TABLE_MAX_LOAD = 0.75
+DEFAULT_VALUE_SIZE = 128
+DEFAULT_CAPACITY = 10000
+
+SLOT_USED = 1
+
+
+class SqlitePasswordRepository(PasswordRepository):
+    """
+    Keeps passwords in a SQLite database in WAL mode, so that readers never wait for writers. Connections are
+    pooled and statements are cached by each connection. Bulk saves run in a single transaction.
+    :param path: database file; ":memory:" keeps a private database on a single connection
+    :param pool_size: maximal number of open connections
+    """
+    def __init__(self, path: str, username_hash_salt: str, hasher: Optional[PasswordHasher] = None,
+                 hashing_pool: Optional[HashingPool] = None, pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
+                 table: str = "passwords"):
+        super().__init__(username_hash_salt, hasher, hashing_pool)
+
+        if pool_size <= 0:
+            raise ValueError("Bad pool_size")
+
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table):
+            raise ValueError("Bad table")
+
+        self.path = path
+        # Every connection to :memory: would open a database of its own
+        self.pool_size = 1 if path == ":memory:" else pool_size
+
+        self.__select = f"SELECT password FROM {table} WHERE username = ?"
+        self.__select_usernames = f"SELECT username FROM {table}"
+        self.__upsert = f"INSERT OR REPLACE INTO {table} (username, password) VALUES (?, ?)"
+
+        self.__connections: queue.Queue = queue.Queue()
+        self.__open_connections = 0
+        self.__lock = threading.Lock()
+
+        with self._connection() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                               f"(username TEXT PRIMARY KEY, password TEXT NOT NULL) WITHOUT ROWID")
+
+    @contextmanager
+    def _connection(self):
+        try:
+            connection = self.__connections.get_nowait()
+        except queue.Empty:
+            connection = self.__open_or_wait()
+
+        try:
+            yield connection
+        finally:
+            self.__connections.put(connection)
+
+    def __open_or_wait(self) -> sqlite3.Connection:
+        with self.__lock:
+            can_open = self.__open_connections < self.pool_size
+
+            if can_open:
+                self.__open_connections += 1
+
+        if not can_open:
+            return self.__connections.get()
+
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        return connection
+
+    def _save_password(self, username: str, password: str) -> None:
+        with self._connection() as connection:
+            connection.execute(self.__upsert, (username, password))
+
+    def _save_passwords(self, hashed_credentials: List[Tuple[str, str]]) -> None:
+        with self._connection() as connection:
+            connection.execute("BEGIN")
+
+            try:
+                connection.executemany(self.__upsert, hashed_credentials)
+                connection.execute("COMMIT")
+            except BaseException:
+                # A failed COMMIT leaves the transaction open, and the connection must go back to the pool clean
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+    def _load_password(self, username: str) -> Optional[str]:
+        with self._connection() as connection:
+            row = connection.execute(self.__select, (username,)).fetchone()
+
+        return row[0] if row else None
+
+    def _iterate_usernames(self) -> Iterator[str]:
+        with self._connection() as connection:
+            for row in connection.execute(self.__select_usernames):
+                yield row[0]
+
+    def close(self) -> None:
+        with self.__lock:
+            while True:
+                try:
+                    self.__connections.get_nowait().close()
+                except queue.Empty:
+                    break
+
+                self.__open_connections -= 1
+
+
+class MemoryMappedPasswordRepository(PasswordRepository):
+    """
+    A read-mostly open-addressing hash table in a memory-mapped file, keyed by the hashed username. Lookups
+    are lock-free memory reads, shared by all the processes mapping the file: readers retry if the generation
+    counter shows a write happened meanwhile. Writes are serialized by a lock on the file.
+    The table does not grow: size it for the number of users up front. The file holds capacity / 0.75 slots,
+    rounded up to a power of 2, of 35 + value_size bytes each: about 340MB for a million users by default.
+    :param path: the table file, created if missing; an existing file keeps its own dimensions
+    :param capacity: number of users the table can hold
+    :param value_size: maximal length of an encoded password hash
+    """
+    def __init__(self, path: str, username_hash_salt: str, capacity: int = DEFAULT_CAPACITY,
+                 value_size: int = DEFAULT_VALUE_SIZE, hasher: Optional[PasswordHasher] = None,
+                 hashing_pool: Optional[HashingPool] = None):
+        super().__init__(username_hash_salt, hasher, hashing_pool)
+
+        if fcntl is None:
+            raise RuntimeError("MemoryMappedPasswordRepository needs fcntl file locks, which this platform lacks")
+
+        if capacity <= 0:
+            raise ValueError("Bad capacity")
+
+        if not 0 < value_size < 65536:
+            raise ValueError("Bad value_size")
+
+        self.path = path
+        self.__lock = threading.Lock()
+
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        with self.__write_lock():
+            if os.fstat(self.__fd).st_size == 0:
+                # The smallest power of 2 keeping the load factor for the capacity
+                slot_count = 1 << (math.ceil(capacity / HASH_TABLE_MAX_LOAD) - 1).bit_length()
+                os.ftruncate(self.__fd, HASH_TABLE_HEADER.size + slot_count * (HASH_TABLE_SLOT.size + value_size))
+                self.__memory = mmap.mmap(self.__fd, 0)
+                HASH_TABLE_HEADER.pack_into(self.__memory, 0, HASH_TABLE_MAGIC, slot_count, 0, 0, value_size)
+            else:
+                self.__memory = mmap.mmap(self.__fd, 0)
+
+            is_table = len(self.__memory) >= HASH_TABLE_HEADER.size and self.__memory[:4] == HASH_TABLE_MAGIC
+
+            if is_table:
+                _, self.slot_count, count, generation, self.value_size = HASH_TABLE_HEADER.unpack_from(self.__memory)
+
+                # Left odd by a writer that died mid-write
+                if generation % 2:
+                    HASH_TABLE_HEADER.pack_into(self.__memory, 0, HASH_TABLE_MAGIC, self.slot_count, count,
+                                                generation + 1, self.value_size)
+
+        if not is_table:
+            self.__memory.close()
+            os.close(self.__fd)
+            raise ValueError(f"{path} is not a password table")
+
+        self.__view = memoryview(self.__memory)
+        self.__slot_size = HASH_TABLE_SLOT.size + self.value_size
+
+    def __len__(self) -> int:
+        return HASH_TABLE_HEADER.unpack_from(self.__memory)[2]
+
+    @contextmanager
+    def __write_lock(self):
+        # flock excludes other processes; threads of this one share the descriptor, hence the thread lock
+        with self.__lock:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+    def __recover_abandoned_write(self) -> None:
+        """A writer that died mid-write leaves the generation odd; whoever can take the lock evens it out"""
+        if not self.__lock.acquire(blocking=False):
+            return
+
+        try:
+            try:
+                fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                magic, slot_count, count, generation, value_size = HASH_TABLE_HEADER.unpack_from(self.__memory)
+
+                if generation % 2:
+                    HASH_TABLE_HEADER.pack_into(self.__memory, 0, magic, slot_count, count, generation + 1,
+                                                value_size)
+            finally:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+        finally:
+            self.__lock.release()
+
+    def __find_slot(self, key: bytes) -> Tuple[int, bool]:
+        """The offset of the slot holding the key, or of the empty slot it would take, and whether it is used"""
+        mask = self.slot_count - 1
+        index = int.from_bytes(key[:8], "big") & mask
+
+        while True:
+            offset = HASH_TABLE_HEADER.size + index * self.__slot_size
+
+            if self.__memory[offset] != SLOT_USED:
+                return offset, False
+
+            # Compared in place, without copying the key out of the map
+            if self.__view[offset + 1:offset + 33] == key:
+                return offset, True
+
+            index = (index + 1) & mask
+
+    def _load_password(self, username: str) -> Optional[str]:
+        key = bytes.fromhex(username)
+
+        while True:
+            generation = HASH_TABLE_HEADER.unpack_from(self.__memory)[3]
+
+            # An odd generation means a write is in progress
+            if generation % 2:
+                self.__recover_abandoned_write()
+                time.sleep(0)
+                continue
+
+            offset, used = self.__find_slot(key)
+            value = None
+
+            if used:
+                _, _, length = HASH_TABLE_SLOT.unpack_from(self.__memory, offset)
+                start = offset + HASH_TABLE_SLOT.size
+                value = bytes(self.__view[start:start + min(length, self.value_size)])
+
+            if HASH_TABLE_HEADER.unpack_from(self.__memory)[3] == generation:
+                return value.decode() if value is not None else None
+
+    def _iterate_usernames(self) -> Iterator[str]:
+        for index in range(self.slot_count):
+            offset = HASH_TABLE_HEADER.size + index * self.__slot_size
+
+            if self.__memory[offset] == SLOT_USED:
+                yield self.__memory[offset + 1:offset + 33].hex()
+
+    def _save_password(self, username: str, password: str) -> None:
+        self._save_passwords([(username, password)])
+
+    def _save_passwords(self, hashed_credentials: List[Tuple[str, str]]) -> None:
+        entries = []
+
+        for username, password in hashed_credentials:
+            value = password.encode()
+
+            if len(value) > self.value_size:
+                raise ValueError(f"Password hash longer than {self.value_size} bytes")
+
+            entries.append((bytes.fromhex(username), value))
+
+        with self.__write_lock():
+            magic, slot_count, count, generation, value_size = HASH_TABLE_HEADER.unpack_from(self.__memory)
+
+            HASH_TABLE_HEADER.pack_into(self.__memory, 0, magic, slot_count, count, generation + 1, value_size)
+
+            try:
+                for key, value in entries:
+                    offset, used = self.__find_slot(key)
+
+                    if not used:
+                        if count + 1 > self.slot_count * HASH_TABLE_MAX_LOAD:
+                            raise RuntimeError("Password table is full")
+
+                        count += 1
+
+                    # A new slot is flagged used last, so that a crashed write leaves it empty
+                    HASH_TABLE_SLOT.pack_into(self.__memory, offset, SLOT_USED if used else 0, key, len(value))
+                    self.__memory[offset + HASH_TABLE_SLOT.size:offset + HASH_TABLE_SLOT.size + len(value)] = value
+                    self.__memory[offset] = SLOT_USED
+            finally:
+                HASH_TABLE_HEADER.pack_into(self.__memory, 0, magic, slot_count, count, generation + 2,
+                                            value_size)
+
+    def flush(self) -> None:
+        self.__memory.flush()
+
+    def close(self) -> None:
+        self.__view.release()
+        self.__memory.close()
+        os.close(self.__fd)
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import OrderedDict, Counter
+from typing import Optional, Tuple, List, Iterator
+
+from .bloom_filter import BloomFilter
+from .password_repository import PasswordRepository
+
+
+class LookupCache(object):
+    """
+    A bounded LRU cache of password lookups, each valid for time_to_live seconds.
+    :param capacity: number of entries kept at most
+    :param time_to_live: seconds an entry is trusted; bounds how stale a change made elsewhere can be
+    """
+    def __init__(self, capacity: int = 10000, time_to_live: float = 60):
+        if capacity <= 0:
+            raise ValueError("Bad capacity")
+
+        if time_to_live <= 0:
+            raise ValueError("Bad time_to_live")
+
+        self.capacity = capacity
+        self.time_to_live = time_to_live
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        self.__entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: str) -> Optional[str]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self.__entries[key]
+
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key: str, value: str) -> None:
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + self.time_to_live)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+
+class CachedPasswordRepository(PasswordRepository):
+    """
+    Fronts a repository with a Bloom filter of its hashed usernames and a cache of recent lookups. Usernames
+    the filter has never seen are answered as not found without touching the backend, so a flood of unknown
+    usernames costs no I/O; known usernames are served from the cache while fresh.
+    The filter is built from the backend when created, and kept up to date by saves made through this
+    repository. Users saved by other processes are only seen after rebuild_filter().
+    :param repository: the backend; must be able to list its usernames
+    :param expected_users: number of users the filter is sized for
+    """
+    def __init__(self, repository: PasswordRepository, expected_users: int = 1000000,
+                 false_positive_rate: float = 0.001, lookup_cache: Optional[LookupCache] = None):
+        super().__init__(repository.username_hash_salt, repository.hasher, repository.hashing_pool)
+
+        self.repository = repository
+        self.expected_users = expected_users
+        self.false_positive_rate = false_positive_rate
+        self.lookup_cache = lookup_cache if lookup_cache is not None else LookupCache()
+
+        self.filtered = 0
+
+        self.__filter_lock = threading.Lock()
+        self.__rebuild_lock = threading.Lock()
+        # Usernames being saved, and those a running rebuild must add to the filter it builds
+        self.__saving: "Counter[str]" = Counter()
+        self.__saved_during_rebuild: Optional[List[str]] = None
+
+        self.__filter: BloomFilter = self.__build_filter()
+
+    @property
+    def username_filter(self) -> BloomFilter:
+        return self.__filter
+
+    def rebuild_filter(self) -> None:
+        """Builds a fresh filter from the backend, picking up users saved elsewhere"""
+        with self.__rebuild_lock:
+            # Saves in progress, and those to come, may reach the backend after the listing passes them by
+            with self.__filter_lock:
+                self.__saved_during_rebuild = list(self.__saving)
+
+            try:
+                username_filter = self.__build_filter()
+            except BaseException:
+                with self.__filter_lock:
+                    self.__saved_during_rebuild = None
+                raise
+
+            with self.__filter_lock:
+                for username in self.__saved_during_rebuild:
+                    username_filter.add(username.encode())
+
+                self.__saved_during_rebuild = None
+                self.__filter = username_filter
+
+    def __build_filter(self) -> BloomFilter:
+        username_filter = BloomFilter(self.expected_users, self.false_positive_rate)
+
+        for username in self.repository._iterate_usernames():
+            username_filter.add(username.encode())
+
+        return username_filter
+
+    def _load_password(self, username: str) -> Optional[str]:
+        if username.encode() not in self.__filter:
+            self.filtered += 1
+            return None
+
+        password = self.lookup_cache.get(username)
+
+        if password is None:
+            password = self.repository._load_password(username)
+
+            if password:
+                self.lookup_cache.put(username, password)
+
+        return password
+
+    def _save_password(self, username: str, password: str) -> None:
+        self._save_passwords([(username, password)])
+
+    def _save_passwords(self, hashed_credentials: List[Tuple[str, str]]) -> None:
+        usernames = [username for username, _ in hashed_credentials]
+
+        # The filter learns the users first: a concurrent lookup may hit the backend in vain, but never miss
+        with self.__filter_lock:
+            for username in usernames:
+                self.__filter.add(username.encode())
+
+            self.__saving.update(usernames)
+
+            if self.__saved_during_rebuild is not None:
+                self.__saved_during_rebuild.extend(usernames)
+
+        try:
+            for username in usernames:
+                self.lookup_cache.invalidate(username)
+
+            self.repository._save_passwords(hashed_credentials)
+
+            for username in usernames:
+                self.lookup_cache.invalidate(username)
+        finally:
+            with self.__filter_lock:
+                for username in usernames:
+                    self.__saving[username] -= 1
+
+                    if not self.__saving[username]:
+                        del self.__saving[username]
+
+    def _iterate_usernames(self) -> Iterator[str]:
+        return self.repository._iterate_usernames()
@@ -0,0 +1,287 @@
+import abc
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, Executor
+from typing import Dict, Optional, Callable, TypeVar, Any, Type
+
+from .staller import PoolSaturatedError
+
+T = TypeVar('T')
+
+# Encoded hashes look like $<algorithm>$<parameters>$<salt>$<hash>, with base64 salt and hash
+ENCODING_SEPARATOR = "$"
+
+DEFAULT_SALT_LENGTH = 16
+DEFAULT_HASH_LENGTH = 32
+
+# The largest maxmem OpenSSL accepts for scrypt
+SCRYPT_MAX_MEMORY = 2 ** 31 - 1
+
+
+def _encode_bytes(value: bytes) -> str:
+    return base64.b64encode(value).decode()
+
+
+def _decode_bytes(value: str) -> bytes:
+    return base64.b64decode(value.encode(), validate=True)
+
+
+def _parse_parameters(parameters: str) -> Dict[str, int]:
+    try:
+        return {name: int(value) for name, _, value in (item.partition("=") for item in parameters.split(","))}
+    except ValueError:
+        raise ValueError("Bad hash parameters")
+
+
+class PasswordHasher(abc.ABC):
+    """
+    Hashes passwords into self-describing encodings, so that a hash can be verified by the parameters it was
+    created with, and recognized as due for an upgrade when the configured parameters change.
+    """
+    algorithm: str
+
+    @abc.abstractmethod
+    def hash(self, password: str, hashed_username: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def verify(self, password: str, encoded: str, hashed_username: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def needs_rehash(self, encoded: str) -> bool:
+        pass
+
+    def identifies(self, encoded: str) -> bool:
+        return encoded.startswith(ENCODING_SEPARATOR + self.algorithm + ENCODING_SEPARATOR)
+
+
+class LegacySha256Hasher(PasswordHasher):
+    """The original scheme: a hex SHA-256 of the password salted by the hashed username. Fast, hence weak."""
+    algorithm = "sha256"
+
+    def hash(self, password: str, hashed_username: str) -> str:
+        return hashlib.sha256(hashed_username.encode() + password.encode()).hexdigest()
+
+    def verify(self, password: str, encoded: str, hashed_username: str) -> bool:
+        try:
+            expected = bytes.fromhex(encoded)
+        except ValueError:
+            raise ValueError("Bad encoded hash")
+
+        return hmac.compare_digest(hashlib.sha256(hashed_username.encode() + password.encode()).digest(), expected)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        return not self.identifies(encoded)
+
+    def identifies(self, encoded: str) -> bool:
+        return not encoded.startswith(ENCODING_SEPARATOR)
+
+
+class _SaltedHasher(PasswordHasher):
+    """A hasher of $<algorithm>$<parameters>$<salt>$<hash> encodings, with a random salt per hash"""
+    def __init__(self, salt_length: int, hash_length: int):
+        if salt_length < 8:
+            raise ValueError("Bad salt_length")
+
+        if hash_length < 16:
+            raise ValueError("Bad hash_length")
+
+        self.salt_length = salt_length
+        self.hash_length = hash_length
+
+    @property
+    @abc.abstractmethod
+    def parameters(self) -> Dict[str, int]:
+        pass
+
+    @abc.abstractmethod
+    def _derive(self, password: bytes, salt: bytes, parameters: Dict[str, int], length: int) -> bytes:
+        pass
+
+    def hash(self, password: str, hashed_username: str) -> str:
+        salt = os.urandom(self.salt_length)
+        derived = self._derive(password.encode(), salt, self.parameters, self.hash_length)
+
+        encoded_parameters = ",".join(f"{name}={value}" for name, value in self.parameters.items())
+
+        return ENCODING_SEPARATOR.join(["", self.algorithm, encoded_parameters, _encode_bytes(salt),
+                                        _encode_bytes(derived)])
+
+    def verify(self, password: str, encoded: str, hashed_username: str) -> bool:
+        parameters, salt, expected = self.decode(encoded)
+        derived = self._derive(password.encode(), salt, parameters, len(expected))
+        return hmac.compare_digest(derived, expected)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        if not self.identifies(encoded):
+            return True
+
+        parameters, salt, expected = self.decode(encoded)
+
+        return parameters != self.parameters or len(salt) < self.salt_length or len(expected) < self.hash_length
+
+    def decode(self, encoded: str) -> (Dict[str, int], bytes, bytes):
+        try:
+            _, algorithm, parameters, salt, expected = encoded.split(ENCODING_SEPARATOR)
+            salt, expected = _decode_bytes(salt), _decode_bytes(expected)
+        except ValueError:
+            raise ValueError("Bad encoded hash")
+
+        if algorithm != self.algorithm:
+            raise ValueError(f"Not a {self.algorithm} hash")
+
+        parameters = _parse_parameters(parameters)
+
+        if parameters.keys() != self.parameters.keys():
+            raise ValueError("Bad hash parameters")
+
+        return parameters, salt, expected
+
+
+class ScryptHasher(_SaltedHasher):
+    """
+    Memory-hard hashing with scrypt. Every hash takes about 128 * n * r bytes of memory (16MiB by default), at
+    most 2GiB.
+    :param n: CPU/memory cost, a power of 2
+    :param r: block size
+    :param p: parallelization
+    """
+    algorithm = "scrypt"
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, salt_length: int = DEFAULT_SALT_LENGTH,
+                 hash_length: int = DEFAULT_HASH_LENGTH):
+        super().__init__(salt_length, hash_length)
+
+        if n < 2 or n & (n - 1):
+            raise ValueError("Bad n")
+
+        if r <= 0 or p <= 0:
+            raise ValueError("Bad r or p")
+
+        if ScryptHasher.memory(n, r, p) > SCRYPT_MAX_MEMORY:
+            raise ValueError("Bad n or r: scrypt would need more than 2GiB")
+
+        self.n = n
+        self.r = r
+        self.p = p
+
+    @property
+    def parameters(self) -> Dict[str, int]:
+        return {"n": self.n, "r": self.r, "p": self.p}
+
+    @staticmethod
+    def memory(n: int, r: int, p: int) -> int:
+        """Bytes of memory scrypt needs: the n blocks of the ROMix, and the p blocks of its input"""
+        return 128 * n * r + 128 * r * p
+
+    def _derive(self, password: bytes, salt: bytes, parameters: Dict[str, int], length: int) -> bytes:
+        n, r, p = parameters["n"], parameters["r"], parameters["p"]
+
+        if n < 2 or r <= 0 or p <= 0 or ScryptHasher.memory(n, r, p) > SCRYPT_MAX_MEMORY:
+            raise ValueError("Bad hash parameters")
+
+        # Some room above what scrypt needs, within what OpenSSL accepts
+        maxmem = min(2 * ScryptHasher.memory(n, r, p), SCRYPT_MAX_MEMORY)
+
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=length)
+
+
+class Pbkdf2Hasher(_SaltedHasher):
+    """
+    PBKDF2 with HMAC-SHA256, for deployments that need a FIPS-approved function.
+    :param iterations: number of HMAC iterations
+    """
+    algorithm = "pbkdf2-sha256"
+
+    def __init__(self, iterations: int = 600000, salt_length: int = DEFAULT_SALT_LENGTH,
+                 hash_length: int = DEFAULT_HASH_LENGTH):
+        super().__init__(salt_length, hash_length)
+
+        if iterations <= 0:
+            raise ValueError("Bad iterations")
+
+        self.iterations = iterations
+
+    @property
+    def parameters(self) -> Dict[str, int]:
+        return {"i": self.iterations}
+
+    def _derive(self, password: bytes, salt: bytes, parameters: Dict[str, int], length: int) -> bytes:
+        return hashlib.pbkdf2_hmac("sha256", password, salt, parameters["i"], length)
+
+
+HASHER_TYPES: Dict[str, Type[PasswordHasher]] = {
+    hasher_type.algorithm: hasher_type for hasher_type in [LegacySha256Hasher, ScryptHasher, Pbkdf2Hasher]
+}
+
+
+def identify_hasher(encoded: str) -> PasswordHasher:
+    """A hasher able to verify the encoded hash, whatever the algorithm it was created with"""
+    if LegacySha256Hasher().identifies(encoded):
+        return LegacySha256Hasher()
+
+    algorithm = encoded.split(ENCODING_SEPARATOR)[1] if encoded.count(ENCODING_SEPARATOR) >= 2 else None
+    hasher_type = HASHER_TYPES.get(algorithm)
+
+    if hasher_type is None:
+        raise ValueError("Unknown hash algorithm")
+
+    # Verification reads the cost parameters from the encoding, the defaults never apply
+    return hasher_type()
+
+
+def verify_password(password: str, encoded: str, hashed_username: str) -> bool:
+    return identify_hasher(encoded).verify(password, encoded, hashed_username)
+
+
+class HashingPool(object):
+    """
+    Runs password hashing on a process pool, with at most max_concurrency hashes running or waiting at once,
+    so that expensive hashing cannot starve the threads serving requests.
+    :param max_workers: number of worker processes, the number of CPUs if not given
+    :param max_concurrency: hashes admitted at once; twice the number of workers if not given
+    :param wait_timeout: seconds to wait for admission before raising PoolSaturatedError; None waits forever
+    :param executor: an executor to use instead of a process pool of its own
+    """
+    def __init__(self, max_workers: Optional[int] = None, max_concurrency: Optional[int] = None,
+                 wait_timeout: Optional[float] = None, executor: Optional[Executor] = None):
+        if max_workers is not None and max_workers <= 0:
+            raise ValueError("Bad max_workers")
+
+        max_workers = max_workers or os.cpu_count() or 1
+
+        if max_concurrency is not None and max_concurrency <= 0:
+            raise ValueError("Bad max_concurrency")
+
+        self.max_concurrency = max_concurrency or 2 * max_workers
+        self.wait_timeout = wait_timeout
+
+        self.__executor = executor or ProcessPoolExecutor(max_workers)
+        self.__owns_executor = executor is None
+        self.__admission = threading.BoundedSemaphore(self.max_concurrency)
+
+        self.rejected = 0
+
+    def run(self, function: Callable[..., T], *args: Any) -> T:
+        if not self.__admission.acquire(timeout=self.wait_timeout if self.wait_timeout is not None else -1):
+            self.rejected += 1
+            raise PoolSaturatedError("Too many passwords being hashed")
+
+        try:
+            return self.__executor.submit(function, *args).result()
+        finally:
+            self.__admission.release()
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self.__owns_executor:
+            self.__executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
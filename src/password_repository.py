@@ -1,15 +1,37 @@
 import abc
+import functools
 import hashlib
-from typing import Tuple
+import os
+from typing import Tuple, Optional, Iterable, List, Iterator, Callable
+
+from .password_hashing import PasswordHasher, LegacySha256Hasher, HashingPool, verify_password
 
 MINIMAL_LENGTH_OF_SECURITY_STRING = 3
 
 
 class PasswordRepository(abc.ABC):
-    def __init__(self, username_hash_salt: str):
+    """
+    :param hasher: hashes saved passwords. Passwords hashed otherwise still validate, and are rehashed by this
+        hasher on a successful validation. The legacy SHA-256 scheme by default, for compatibility.
+    :param hashing_pool: if given, password hashing runs on it rather than on the calling thread
+    """
+    def __init__(self, username_hash_salt: str, hasher: Optional[PasswordHasher] = None,
+                 hashing_pool: Optional[HashingPool] = None):
         PasswordRepository.verify_security_string_length(username_hash_salt, MINIMAL_LENGTH_OF_SECURITY_STRING,
                                                          "Username salt")
         self.username_hash_salt = username_hash_salt
+        self.hashing_pool = hashing_pool
+        self.hasher = hasher or LegacySha256Hasher()
+
+    @property
+    def hasher(self) -> PasswordHasher:
+        return self.__hasher
+
+    @hasher.setter
+    def hasher(self, hasher: PasswordHasher) -> None:
+        # Made now rather than on the first unknown username, which would otherwise take longer than the others
+        self.__dummy_hash = self.__run_hashing(hasher.hash, os.urandom(16).hex(), os.urandom(32).hex())
+        self.__hasher = hasher
 
     @abc.abstractmethod
     def _save_password(self, username: str, password: str) -> None:
@@ -19,32 +41,87 @@ class PasswordRepository(abc.ABC):
     def _load_password(self, username: str) -> str:
         pass
 
+    def _save_passwords(self, hashed_credentials: List[Tuple[str, str]]) -> None:
+        """Saves hashed (username, password) pairs; backends able to write them in one batch override this"""
+        for username, password in hashed_credentials:
+            self._save_password(username, password)
+
+    def _iterate_usernames(self) -> Iterator[str]:
+        """The hashed usernames of all saved passwords, for backends able to list them"""
+        raise NotImplementedError(f"{type(self).__name__} cannot list its usernames")
+
     def save_password(self, username: str, password: str) -> None:
+        self._save_password(*self.hash_credentials(username, password))
+
+    def save_passwords(self, credentials: Iterable[Tuple[str, str]]) -> int:
+        """
+        Saves many (username, password) pairs in a single batch, e.g. for a migration
+        :return: number of passwords saved
+        """
+        hashed_credentials = [self.hash_credentials(username, password) for username, password in credentials]
+
+        self._save_passwords(hashed_credentials)
+
+        return len(hashed_credentials)
+
+    def hash_credentials(self, username: str, password: str) -> Tuple[str, str]:
+        return PasswordRepository._hash_credentials(username, password, self.username_hash_salt,
+                                                    functools.partial(self.__run_hashing, self.hasher.hash))
+
+    @staticmethod
+    def _hash_credentials(username: str, password: str, username_hash_salt: str,
+                          hash_password: Callable[[str, str], str]) -> Tuple[str, str]:
+        """
+        Checks and hashes credentials, for repositories and for bulk imports alike
+        :param hash_password: hashes a password salted by the hashed username
+        :return: the hashed username and the hashed password
+        """
         PasswordRepository.verify_security_string_length(username, MINIMAL_LENGTH_OF_SECURITY_STRING,
                                                          "Username")
 
         PasswordRepository.verify_security_string_length(password, MINIMAL_LENGTH_OF_SECURITY_STRING,
                                                          "Password")
 
-        hashed_username = PasswordRepository._hash_with_salt(hashable=username, salt=self.username_hash_salt)
-
-        hashed_password = PasswordRepository._hash_with_salt(hashable=password, salt=hashed_username)
+        hashed_username = PasswordRepository._hash_with_salt(hashable=username, salt=username_hash_salt)
 
-        self._save_password(hashed_username, hashed_password)
+        return hashed_username, hash_password(password, hashed_username)
 
     def validate_password(self, username: str, password: str) -> Tuple[bool, str]:
+        """
+        Takes at least the hashing work of the configured hasher whether the user exists or not, so that the time
+        taken tells nothing about the username: the password of an unknown user is verified against a dummy hash,
+        and so is that of a user whose hash was made by another hasher or with other costs, e.g. a legacy one.
+        """
         hashed_username = PasswordRepository._hash_with_salt(hashable=username, salt=self.username_hash_salt)
 
         hashed_password = self._load_password(hashed_username)
+        found = bool(hashed_password)
+
+        matches = self.__run_hashing(verify_password, password, hashed_password if found else self.__dummy_hash,
+                                     hashed_username)
+
+        # Pads the work of a hash cheaper than the configured ones up to their cost
+        if found and self.hasher.needs_rehash(hashed_password):
+            self.__run_hashing(verify_password, password, self.__dummy_hash, hashed_username)
 
-        if hashed_password:
-            if hashed_password == self._hash_with_salt(password, hashed_username):
-                return True, "Match"
-            else:
-                return False, "No match"
-        else:
+        if not found:
             return False, "Not found"
 
+        if not matches:
+            return False, "No match"
+
+        # Upgrade the hash while the password is at hand
+        if self.hasher.needs_rehash(hashed_password):
+            self._save_password(hashed_username, self.__run_hashing(self.hasher.hash, password, hashed_username))
+
+        return True, "Match"
+
+    def __run_hashing(self, function, *args):
+        if self.hashing_pool is None:
+            return function(*args)
+
+        return self.hashing_pool.run(function, *args)
+
     @staticmethod
     def _hash_with_salt(hashable: str, salt: str) -> str:
         return hashlib.sha256(salt.encode() + hashable.encode()).hexdigest()
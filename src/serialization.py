@@ -0,0 +1,160 @@
+import abc
+import json
+import pickle
+import struct
+from typing import Optional, Any
+
+from .util import parse_timestamp, format_timestamp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Format tags, carried by the first byte of every serialization
+COMPACT_TAG = 1
+JSON_TAG = 2
+MSGPACK_TAG = 3
+PICKLE_TAG = 4
+
+# tag, server time (epoch seconds), hashcash zero count, number of captcha solutions
+COMPACT_HEADER = struct.Struct(">BqHB")
+STRING_LENGTH = struct.Struct(">H")
+
+
+class StateSerializer(abc.ABC):
+    tag: int
+
+    @abc.abstractmethod
+    def serialize(self, state: object) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def deserialize(self, serialization: bytes) -> object:
+        pass
+
+
+class JsonStateSerializer(StateSerializer):
+    tag = JSON_TAG
+
+    def serialize(self, state: object) -> bytes:
+        return bytes([self.tag]) + json.dumps(state, separators=(",", ":")).encode()
+
+    def deserialize(self, serialization: bytes) -> object:
+        return json.loads(serialization[1:].decode())
+
+
+class MsgpackStateSerializer(StateSerializer):
+    tag = MSGPACK_TAG
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+
+    def serialize(self, state: object) -> bytes:
+        return bytes([self.tag]) + msgpack.packb(state, use_bin_type=True)
+
+    def deserialize(self, serialization: bytes) -> object:
+        return msgpack.unpackb(serialization[1:], raw=False)
+
+
+class PickleStateSerializer(StateSerializer):
+    """Kept for compatibility only: unpickling is unsafe if the encryption keys ever leak"""
+    tag = PICKLE_TAG
+
+    def serialize(self, state: object) -> bytes:
+        return bytes([self.tag]) + pickle.dumps(state)
+
+    def deserialize(self, serialization: bytes) -> object:
+        return pickle.loads(serialization[1:])
+
+
+class CompactStateSerializer(StateSerializer):
+    """
+    A fixed-schema binary codec for the state built by Preparer: server time as an integer epoch, hashcash
+    zero count, captcha solutions, csrf token and hashcash server string. States of any other shape are
+    delegated to the fallback serializer.
+    """
+    tag = COMPACT_TAG
+
+    def __init__(self, fallback: Optional[StateSerializer] = None):
+        self.fallback = fallback or JsonStateSerializer()
+
+        if self.fallback.tag == self.tag:
+            raise ValueError("Fallback serializer must use another format")
+
+    def serialize(self, state: object) -> bytes:
+        if not self.__matches_schema(state):
+            return self.fallback.serialize(state)
+
+        try:
+            server_time = parse_timestamp(state["server_time"])
+        except ValueError:
+            return self.fallback.serialize(state)
+
+        parts = [COMPACT_HEADER.pack(self.tag, server_time, state["hashcash"]["zero_count"],
+                                     len(state["captcha_solutions"]))]
+
+        for string in [state["csrf_token"], state["hashcash"]["server_string"]] + state["captcha_solutions"]:
+            encoded = string.encode()
+
+            if len(encoded) > 65535:
+                return self.fallback.serialize(state)
+
+            parts.append(STRING_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+
+        return b"".join(parts)
+
+    def deserialize(self, serialization: bytes) -> object:
+        if not serialization:
+            raise ValueError("Empty state")
+
+        if serialization[0] == self.fallback.tag:
+            return self.fallback.deserialize(serialization)
+
+        if serialization[0] != self.tag:
+            raise ValueError("Unknown state format")
+
+        _, server_time, zero_count, solution_count = COMPACT_HEADER.unpack_from(serialization)
+
+        offset = COMPACT_HEADER.size
+        strings = []
+
+        for _ in range(2 + solution_count):
+            length, = STRING_LENGTH.unpack_from(serialization, offset)
+            offset += STRING_LENGTH.size
+
+            if offset + length > len(serialization):
+                raise ValueError("Truncated state")
+
+            strings.append(serialization[offset:offset + length].decode())
+            offset += length
+
+        return {
+            "server_time": format_timestamp(server_time),
+            "captcha_solutions": strings[2:],
+            "csrf_token": strings[0],
+            "hashcash": {
+                "server_string": strings[1],
+                "zero_count": zero_count
+            }
+        }
+
+    @staticmethod
+    def __matches_schema(state: Any) -> bool:
+        try:
+            return (isinstance(state, dict) and state.keys() == {"server_time", "captcha_solutions",
+                                                                  "csrf_token", "hashcash"}
+                    and isinstance(state["server_time"], str) and len(state["server_time"]) == 15
+                    and isinstance(state["csrf_token"], str)
+                    and isinstance(state["captcha_solutions"], list)
+                    and len(state["captcha_solutions"]) < 256
+                    and all(isinstance(solution, str) for solution in state["captcha_solutions"])
+                    and isinstance(state["hashcash"], dict)
+                    and state["hashcash"].keys() == {"server_string", "zero_count"}
+                    and isinstance(state["hashcash"]["server_string"], str)
+                    and type(state["hashcash"]["zero_count"]) is int
+                    and 0 <= state["hashcash"]["zero_count"] < 65536)
+        except (TypeError, AttributeError):
+            return False
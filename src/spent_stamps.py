@@ -0,0 +1,107 @@
+import abc
+import hashlib
+import math
+import threading
+import time
+from typing import Dict, Set, Optional
+
+from .bloom_filter import BloomFilter
+
+
+class SpentStampStore(abc.ABC):
+    """
+    Remembers spent hashcash stamps, so a stamp can't be replayed. A stamp needs remembering for as long as its
+    timestamp is acceptable, so time_to_live should be the submit_timeout of the validation configuration.
+    Implementations shared by several processes only need to provide _spend as an atomic check-and-set.
+    """
+    def __init__(self, time_to_live: int):
+        if time_to_live <= 0:
+            raise ValueError("Bad time_to_live")
+
+        self.time_to_live = time_to_live
+
+    @abc.abstractmethod
+    def _spend(self, stamp_digest: bytes, now: float) -> bool:
+        pass
+
+    def spend(self, stamp: bytes, now: Optional[float] = None) -> bool:
+        """
+        Marks a stamp as spent
+        :param stamp: the hashcash stamp
+        :param now: current time, in seconds since the epoch
+        :return: False if the stamp had already been spent
+        """
+        return self._spend(hashlib.blake2b(stamp, digest_size=16).digest(), time.time() if now is None else now)
+
+
+class InMemorySpentStampStore(SpentStampStore):
+    """Keeps stamp digests in sets, one per time bucket. Buckets older than the time to live are dropped whole."""
+    def __init__(self, time_to_live: int, bucket_count: int = 4):
+        super().__init__(time_to_live)
+
+        if bucket_count <= 0:
+            raise ValueError("Bad bucket_count")
+
+        self.bucket_duration = time_to_live / bucket_count
+        self.__lock = threading.Lock()
+        self.__buckets: Dict[int, Set[bytes]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.__buckets.values())
+
+    def _spend(self, stamp_digest: bytes, now: float) -> bool:
+        current_bucket = int(now // self.bucket_duration)
+        # Enough buckets to cover the time to live, whatever the position within the current bucket
+        oldest_bucket = current_bucket - int(math.ceil(self.time_to_live / self.bucket_duration))
+
+        with self.__lock:
+            for bucket in [bucket for bucket in self.__buckets if bucket < oldest_bucket]:
+                del self.__buckets[bucket]
+
+            if any(stamp_digest in bucket for bucket in self.__buckets.values()):
+                return False
+
+            self.__buckets.setdefault(current_bucket, set()).add(stamp_digest)
+
+        return True
+
+
+class BloomSpentStampStore(SpentStampStore):
+    """
+    Keeps stamp digests in two rotating Bloom filters, so memory is bounded whatever the load. Each filter
+    collects stamps for one time to live; a stamp is looked up in both. A false positive rejects a fresh
+    stamp as a replay, at about false_positive_rate while fewer than capacity stamps arrive per time to live.
+    """
+    def __init__(self, time_to_live: int, capacity: int = 1000000, false_positive_rate: float = 0.0001):
+        super().__init__(time_to_live)
+
+        self.__lock = threading.Lock()
+        self.__current = BloomFilter(capacity, false_positive_rate)
+        self.__previous = BloomFilter(capacity, false_positive_rate)
+        self.__current_started_at: Optional[float] = None
+
+    @property
+    def size_in_bytes(self) -> int:
+        return self.__current.size_in_bytes + self.__previous.size_in_bytes
+
+    def _spend(self, stamp_digest: bytes, now: float) -> bool:
+        with self.__lock:
+            if self.__current_started_at is None:
+                self.__current_started_at = now
+
+            elapsed = now - self.__current_started_at
+
+            if elapsed >= 2 * self.time_to_live:
+                self.__current.clear()
+                self.__previous.clear()
+                self.__current_started_at = now
+
+            elif elapsed >= self.time_to_live:
+                self.__previous, self.__current = self.__current, self.__previous
+                self.__current.clear()
+                self.__current_started_at = now
+
+            if stamp_digest in self.__previous:
+                return False
+
+            return not self.__current.add(stamp_digest)
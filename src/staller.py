@@ -1,17 +1,243 @@
 import abc
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import queue
+import threading
 import time
+from concurrent.futures import Executor, Future, wait
 from datetime import datetime
 from threading import Thread
-from typing import Tuple, Generic, TypeVar
+from typing import Tuple, Generic, TypeVar, Optional, Union, Callable, List
+
+from . import metrics
 
 T = TypeVar('T')
 
 
+class PoolSaturatedError(RuntimeError):
+    pass
+
+
+class StallerPool(object):
+    """
+    A bounded pool of worker threads, shared by Stallers, to run stallable work on.
+    :param size: number of worker threads
+    :param queue_depth: number of work items that may wait for a free worker
+    :param on_saturation: REJECT raises PoolSaturatedError when the queue is full; WAIT blocks the caller until
+    there is room, up to wait_timeout seconds (forever if None)
+    """
+    REJECT = "reject"
+    WAIT = "wait"
+
+    def __init__(self, size: int = 16, queue_depth: int = 64, on_saturation: str = REJECT,
+                 wait_timeout: Optional[float] = None):
+        if size <= 0:
+            raise ValueError("Bad size")
+
+        if queue_depth <= 0:
+            raise ValueError("Bad queue_depth")
+
+        if on_saturation not in (StallerPool.REJECT, StallerPool.WAIT):
+            raise ValueError("Bad on_saturation")
+
+        self.size = size
+        self.queue_depth = queue_depth
+        self.on_saturation = on_saturation
+        self.wait_timeout = wait_timeout
+
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.__abandoned = 0
+        self.__rejected = 0
+        self.__completed = 0
+
+        self.__queue: queue.Queue = queue.Queue(maxsize=queue_depth)
+        self.__threads: List[Thread] = []
+
+        for _ in range(size):
+            thread = Thread(target=self.__run_worker, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    @property
+    def active(self) -> int:
+        return self.__active
+
+    @property
+    def queued(self) -> int:
+        return self.__queue.qsize()
+
+    @property
+    def abandoned(self) -> int:
+        return self.__abandoned
+
+    @property
+    def rejected(self) -> int:
+        return self.__rejected
+
+    @property
+    def completed(self) -> int:
+        return self.__completed
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        future: Future = Future()
+        item = (future, function, args, kwargs)
+
+        try:
+            if self.on_saturation == StallerPool.REJECT:
+                self.__queue.put_nowait(item)
+            else:
+                self.__queue.put(item, timeout=self.wait_timeout)
+        except queue.Full:
+            with self.__lock:
+                self.__rejected += 1
+            raise PoolSaturatedError(f"Staller pool is saturated: {self.__active} active, "
+                                     f"{self.queued} queued")
+
+        return future
+
+    def abandon(self, future: Future) -> None:
+        """Marks a work item the caller no longer waits for. If it hasn't started yet, it never will."""
+        with self.__lock:
+            self.__abandoned += 1
+
+        future.cancel()
+
+    def shutdown(self) -> None:
+        for _ in self.__threads:
+            self.__queue.put(None)
+
+        for thread in self.__threads:
+            thread.join()
+
+        self.__threads = []
+
+    def __run_worker(self):
+        while True:
+            item = self.__queue.get()
+
+            if item is None:
+                return
+
+            future, function, args, kwargs = item
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self.__lock:
+                self.__active += 1
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                logging.exception(e)
+                future.set_exception(e)
+            finally:
+                with self.__lock:
+                    self.__active -= 1
+                    self.__completed += 1
+
+
+class StallScheduler(object):
+    """
+    Releases stalled outcomes when their time comes, from a single thread waiting on a heap of deadlines.
+    Each pending release costs a heap entry and a future, instead of a sleeping thread.
+    """
+    __default: Optional["StallScheduler"] = None
+    __default_lock = threading.Lock()
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__heap: List[Tuple[float, int, Future, object]] = []
+        self.__sequence = itertools.count()
+        self.__thread: Optional[Thread] = None
+        self.__stopped = False
+
+    @classmethod
+    def default(cls) -> "StallScheduler":
+        with cls.__default_lock:
+            if cls.__default is None:
+                cls.__default = StallScheduler()
+
+        return cls.__default
+
+    @staticmethod
+    def completed(value: object) -> Future:
+        future: Future = Future()
+        future.set_result(value)
+        return future
+
+    def __len__(self) -> int:
+        return len(self.__heap)
+
+    def release_later(self, delay_in_ms: int, value: object) -> Future:
+        future: Future = Future()
+        deadline = time.monotonic() + delay_in_ms/1000
+
+        with self.__condition:
+            if self.__stopped:
+                raise RuntimeError("Stall scheduler is stopped")
+
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+
+            heapq.heappush(self.__heap, (deadline, next(self.__sequence), future, value))
+
+            # Only an earlier deadline than the one being waited for requires waking the thread up
+            if self.__heap[0][2] is future:
+                self.__condition.notify()
+
+        return future
+
+    def stop(self) -> None:
+        """Stops the scheduler thread, releasing everything still pending immediately"""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                due: List[Tuple[Future, object]] = []
+
+                while not due:
+                    now = time.monotonic()
+
+                    while self.__heap and (self.__stopped or self.__heap[0][0] <= now):
+                        _, _, future, value = heapq.heappop(self.__heap)
+                        due.append((future, value))
+
+                    if due:
+                        break
+
+                    if self.__stopped:
+                        return
+
+                    self.__condition.wait(self.__heap[0][0] - now if self.__heap else None)
+
+            # Futures are resolved outside the lock, as they run their callbacks
+            for future, value in due:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(value)
+
+
 class Staller(Generic[T]):
-    def __init__(self, unit_time_in_ms: int, stall_if_successful: bool = False, cut_if_delayed: bool = True):
+    def __init__(self, unit_time_in_ms: int, stall_if_successful: bool = False, cut_if_delayed: bool = True,
+                 pool: Optional[StallerPool] = None, scheduler: Optional["StallScheduler"] = None):
         self.cut_if_delayed = cut_if_delayed
         self.stall_if_successful = stall_if_successful
         self.unit_time_in_ms = unit_time_in_ms
+        # Without a pool, every stall that may be cut runs its work on a thread of its own
+        self.pool = pool
+        # Without a scheduler, stall_later uses the process-wide default one
+        self.scheduler = scheduler
 
     class Stallable(abc.ABC):
         @abc.abstractmethod
@@ -31,30 +257,141 @@ class Staller(Generic[T]):
             pass
 
     def stall(self, stallable: Stallable, *args, **kwargs) -> Tuple[bool, T]:
+        with metrics.timer("stall_seconds"):
+            start_time = time.time()
+
+            if not self.__work(stallable, args, kwargs):
+                return False, None
+
+            result: T = stallable.get_result()
+
+            success: bool = stallable.was_successful()
+
+            left: int = self.__time_left(success, start_time)
+
+            if left >= 0:
+                time.sleep(left/1000)
+
+            return success, result
+
+    def stall_later(self, stallable: Stallable, *args, **kwargs) -> Future:
+        """
+        Like stall, but doesn't sleep: the outcome is released through the returned future once the unit time
+        elapses, by the stall scheduler's thread. A stalled request therefore holds no thread while it waits.
+        :return: a future of (success, result). Callbacks added to it run on the scheduler thread
+        """
         start_time = time.time()
 
-        if self.cut_if_delayed:
+        if not self.__work(stallable, args, kwargs):
+            return StallScheduler.completed((False, None))
+
+        result: T = stallable.get_result()
+
+        success: bool = stallable.was_successful()
+
+        left: int = self.__time_left(success, start_time)
+
+        if left > 0:
+            return (self.scheduler or StallScheduler.default()).release_later(left, (success, result))
+
+        return StallScheduler.completed((success, result))
+
+    def __work(self, stallable: Stallable, args, kwargs) -> bool:
+        if self.cut_if_delayed and self.pool is not None:
+            submitted_at = time.time()
+            future: Future = self.pool.submit(stallable.do_work, *args, **kwargs)
+
+            # Waiting for room in the pool counts against the unit time
+            left = self.unit_time_in_ms/1000 - (time.time() - submitted_at)
+
+            if left <= 0 or not wait([future], left).done:
+                stallable.interrupt()
+                self.pool.abandon(future)
+                return False
+
+        elif self.cut_if_delayed:
             thread: Thread = Thread(target=stallable.do_work, args=args, kwargs=kwargs)
             thread.start()
             thread.join(self.unit_time_in_ms/1000)
 
             if thread.is_alive():
                 stallable.interrupt()
-                return False, None
+                return False
 
         else:
             stallable.do_work(*args, **kwargs)
 
-        result: T = stallable.get_result()
+        return True
 
-        success: bool = stallable.was_successful()
+    def __time_left(self, success: bool, start_time: float) -> int:
+        if success and not self.stall_if_successful:
+            return -1
 
-        if not success or self.stall_if_successful:
-            elapsed: int = int((time.time() - start_time) * 1000)
+        elapsed: int = int((time.time() - start_time) * 1000)
 
-            left: int = self.unit_time_in_ms - elapsed
+        return self.unit_time_in_ms - elapsed
 
-            if left >= 0:
-                time.sleep(left/1000)
 
-        return success, result
+class AsyncStaller(Generic[T]):
+    """
+    The asyncio counterpart of Staller. Stalling awaits asyncio.sleep, so a stalled request holds no thread.
+    Stallables may be AsyncStaller.Stallable, whose work is a coroutine, or Staller.Stallable, whose blocking
+    work is run on the given executor (the loop's default executor if not given).
+    """
+    def __init__(self, unit_time_in_ms: int, stall_if_successful: bool = False, cut_if_delayed: bool = True,
+                 executor: Optional[Executor] = None):
+        self.cut_if_delayed = cut_if_delayed
+        self.stall_if_successful = stall_if_successful
+        self.unit_time_in_ms = unit_time_in_ms
+        self.executor = executor
+
+    class Stallable(abc.ABC):
+        @abc.abstractmethod
+        async def do_work(self, *args, **kwargs) -> None:
+            pass
+
+        @abc.abstractmethod
+        def get_result(self) -> T:
+            pass
+
+        @abc.abstractmethod
+        def interrupt(self):
+            pass
+
+        @abc.abstractmethod
+        def was_successful(self) -> bool:
+            pass
+
+    async def stall(self, stallable: Union[Stallable, Staller.Stallable], *args, **kwargs) -> Tuple[bool, T]:
+        with metrics.timer("stall_seconds"):
+            loop = asyncio.get_running_loop()
+            start_time = loop.time()
+
+            if isinstance(stallable, AsyncStaller.Stallable):
+                work = stallable.do_work(*args, **kwargs)
+            else:
+                work = loop.run_in_executor(self.executor, functools.partial(stallable.do_work, *args, **kwargs))
+
+            if self.cut_if_delayed:
+                try:
+                    await asyncio.wait_for(work, self.unit_time_in_ms/1000)
+                except asyncio.TimeoutError:
+                    stallable.interrupt()
+                    return False, None
+
+            else:
+                await work
+
+            result: T = stallable.get_result()
+
+            success: bool = stallable.was_successful()
+
+            if not success or self.stall_if_successful:
+                elapsed: int = int((loop.time() - start_time) * 1000)
+
+                left: int = self.unit_time_in_ms - elapsed
+
+                if left >= 0:
+                    await asyncio.sleep(left/1000)
+
+            return success, result
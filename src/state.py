@@ -1,18 +1,20 @@
-import logging
-import pickle
-import threading
+import struct
 import time
-from typing import List
+from typing import Optional
 
-import schedule as schedule
-from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.fernet import InvalidToken
+
+from . import metrics
+from .key_ring import KeyRing, LocalKeyRing
+from .serialization import StateSerializer, CompactStateSerializer
 
-SCHEDULER_SLEEP_TIME = 1
 REASONABLE_NUMBER_OF_KEYS = 500
+KEY_ID_SEPARATOR = b"."
 
 
 class StateEncryptor(object):
-    def __init__(self, state_aging_tolerance: int = 120, key_renewal_frequency: int = 30):
+    def __init__(self, state_aging_tolerance: int = 120, key_renewal_frequency: int = 30,
+                 serializer: Optional[StateSerializer] = None, key_ring: Optional[KeyRing] = None):
         if state_aging_tolerance <= 0:
             raise ValueError("Bad state_aging_tolerance")
 
@@ -21,6 +23,7 @@ class StateEncryptor(object):
 
         self.__state_aging_tolerance: int = state_aging_tolerance
         self.__key_renewal_frequency: int = key_renewal_frequency
+        self.__serializer: StateSerializer = serializer or CompactStateSerializer()
 
         self.__max_keys = 1
         if key_renewal_frequency > 0:
@@ -32,48 +35,53 @@ class StateEncryptor(object):
         if self.__max_keys >= REASONABLE_NUMBER_OF_KEYS:
             raise ValueError(f"Keeping {self.__max_keys} keys is ridiculous.")
 
-        self.__keys: List[Fernet] = []
-        self.__renew_key()
-
-        self.__encryptor: MultiFernet = MultiFernet(self.__keys)
-
-        self.__thread_stop_event = threading.Event()
-
-    def __renew_key(self):
-        self.__keys.insert(0, Fernet(Fernet.generate_key()))
-        self.__keys = self.__keys[:self.__max_keys]
-        logging.debug(self.__keys)
-        self.__encryptor = MultiFernet(self.__keys)
+        self.__key_ring: KeyRing = key_ring or LocalKeyRing()
+        self.__key_ring.bind(self.__max_keys, key_renewal_frequency)
 
     def start(self):
-        schedule.every(self.__key_renewal_frequency).seconds.do(self.__renew_key)
-        thread = threading.Thread(target=self.__run_scheduler)
-        thread.start()
+        self.__key_ring.start()
 
     def stop(self):
-        self.__thread_stop_event.set()
+        self.__key_ring.stop()
 
-    def __run_scheduler(self):
-        while not self.__thread_stop_event.is_set():
-            schedule.run_pending()
-            time.sleep(SCHEDULER_SLEEP_TIME)
+    @property
+    def key_ring(self) -> KeyRing:
+        return self.__key_ring
 
     @property
     def max_keys(self):
         return self.__max_keys
 
     def encrypt_state(self, state: object) -> bytes:
-        state_serialization = pickle.dumps(state)
-        fernet_token = self.__encryptor.encrypt(state_serialization)
-        return fernet_token
+        with metrics.timer("state_encryption_seconds"):
+            state_serialization = self.__serializer.serialize(state)
+            key_id, key = self.__key_ring.current_key()
+            fernet_token = key.encrypt(state_serialization)
+            return key_id + KEY_ID_SEPARATOR + fernet_token
 
     def decrypt_state(self, encrypted_state: bytes) -> object:
+        with metrics.timer("state_decryption_seconds"):
+            return self.__decrypt_state(encrypted_state)
+
+    def __decrypt_state(self, encrypted_state: bytes) -> object:
+        key_id, _, fernet_token = encrypted_state.partition(KEY_ID_SEPARATOR)
+
+        # Unknown and expired keys are rejected before any cryptography takes place
+        key, retired_at = self.__key_ring.find_key(key_id) or (None, 0)
+
+        if key is None or time.time() - retired_at > self.__state_aging_tolerance:
+            raise ValueError("Cannot decrypt state")
+
         try:
-            decrypted_state = self.__encryptor.decrypt(encrypted_state, self.__state_aging_tolerance)
-            state = pickle.loads(decrypted_state)
+            decrypted_state = key.decrypt(fernet_token, self.__state_aging_tolerance)
         except InvalidToken as e:
             raise ValueError("Cannot decrypt state")
 
+        try:
+            state = self.__serializer.deserialize(decrypted_state)
+        except (ValueError, struct.error):
+            raise ValueError("Cannot deserialize state")
+
         return state
 
 
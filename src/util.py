@@ -1,5 +1,19 @@
+import calendar
+import datetime
 import secrets
 import hashlib
+import logging
+from typing import Sequence, Union, List
+
+from . import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+SHA1_BITS = 160
 
 
 def generate_random_base_64(length_in_bytes: object = 20) -> str:
@@ -13,16 +27,78 @@ def generate_random_base_64(length_in_bytes: object = 20) -> str:
 
 def validate_hashcash_zeros(hashcash: bytes, zero_count: int) -> bool:
     try:
-        hashing = hashlib.sha1()
-        hashing.update(hashcash)
-
-        hash_result = hashing.hexdigest()
+        if zero_count > SHA1_BITS:
+            return False
 
-        # convert from hex to binary and keep leading zeros
-        binary_string = (bin(int(hash_result, 16))[2:]).zfill(len(hash_result) * 4)
+        digest = hashlib.sha1(hashcash).digest()
 
-        return binary_string.startswith('0' * zero_count)
+        # The leading zero_count bits are zero iff shifting out the rest leaves nothing
+        return zero_count <= 0 or int.from_bytes(digest, "big") >> (SHA1_BITS - zero_count) == 0
 
-    except Exception as e:
-        print(e)
+    except TypeError as e:
+        # Clients can send these at will: no traceback, so that they cannot flood the log
+        logging.debug("Bad hashcash: %r", e)
+        metrics.increment("hashcash_errors_total")
         return False
+
+
+def validate_hashcash_zeros_batch(hashcashes: Sequence[bytes], zero_counts: Union[int, Sequence[int]]) \
+        -> List[bool]:
+    """
+    Validates many hashcash stamps at once. Leading zeros are counted with NumPy when it is installed.
+    :param hashcashes: the stamps to validate
+    :param zero_counts: the required number of leading zero bits, for all stamps or per stamp
+    :return: a validity flag per stamp
+    """
+    if isinstance(zero_counts, int):
+        zero_counts = [zero_counts] * len(hashcashes)
+
+    if len(zero_counts) != len(hashcashes):
+        raise ValueError("Expecting a zero count per hashcash")
+
+    if numpy is None or not hashcashes:
+        return [validate_hashcash_zeros(hashcash, zero_count)
+                for hashcash, zero_count in zip(hashcashes, zero_counts)]
+
+    # Stamps and zero counts come from clients: those of the wrong types are left to the scalar check, which
+    # rejects them, and the zero counts are clamped to the range where they make a difference
+    well_typed = [isinstance(hashcash, bytes) and isinstance(zero_count, int)
+                  for hashcash, zero_count in zip(hashcashes, zero_counts)]
+
+    digests = b"".join(hashlib.sha1(hashcash).digest() if is_well_typed else bytes(SHA1_BITS // 8)
+                       for hashcash, is_well_typed in zip(hashcashes, well_typed))
+    bounded_zero_counts = [min(max(zero_count, 0), SHA1_BITS + 1) if is_well_typed else 0
+                           for zero_count, is_well_typed in zip(zero_counts, well_typed)]
+
+    bits = numpy.unpackbits(numpy.frombuffer(digests, dtype=numpy.uint8).reshape(len(hashcashes), 20), axis=1)
+
+    # The index of the first set bit is the number of leading zeros; a digest of all zeros has 160 of them
+    leading_zeros = numpy.where(bits.any(axis=1), bits.argmax(axis=1), SHA1_BITS)
+
+    valid = (leading_zeros >= numpy.asarray(bounded_zero_counts)).tolist()
+
+    return [is_valid if is_well_typed else validate_hashcash_zeros(hashcash, zero_count)
+            for is_valid, is_well_typed, hashcash, zero_count in zip(valid, well_typed, hashcashes, zero_counts)]
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """
+    Parses a YYYYmmdd-HHMMSS UTC timestamp into seconds since the epoch, without going through strptime
+    :param timestamp: the timestamp string
+    :return: seconds since the epoch
+    """
+    try:
+        if len(timestamp) != 15 or timestamp[8] != "-" or not (timestamp[:8] + timestamp[9:]).isdigit():
+            raise ValueError()
+
+        # The datetime constructor validates the ranges (month 13, February 30th etc.)
+        parsed = datetime.datetime(int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                                   int(timestamp[9:11]), int(timestamp[11:13]), int(timestamp[13:15]))
+    except (ValueError, TypeError):
+        raise ValueError(f"time data {timestamp!r} does not match format '{TIMESTAMP_FORMAT}'")
+
+    return calendar.timegm(parsed.utctimetuple())
+
+
+def format_timestamp(epoch_seconds: int) -> str:
+    return datetime.datetime.utcfromtimestamp(epoch_seconds).strftime(TIMESTAMP_FORMAT)
@@ -0,0 +1,348 @@
+import json
+import threading
+import time
+from json import JSONDecodeError
+from typing import Callable, Dict, List, Optional, Tuple, Any, Iterable
+
+from . import metrics
+from .difficulty import AdaptiveDifficulty
+from .spent_stamps import SpentStampStore
+from .state import StateEncryptor
+from .util import parse_timestamp
+
+# Relative costs of stages, to keep the cheapest rejections first
+HEADER_COST = 1
+PARSING_COST = 2
+HASHING_COST = 10
+CRYPTO_COST = 100
+
+# A failing stage returns (failure stage, failure reason); a passing stage returns None
+Failure = Tuple[str, str]
+
+
+class ValidationContext(object):
+    """The request being validated, along with whatever the stages have extracted from it so far"""
+    def __init__(self, request_details: Dict[str, str], headers: Dict[str, str], state_encryptor: StateEncryptor,
+                 configuration: Dict[str, Any], validate_hashcash: Callable[[bytes, int], bool],
+                 spent_stamp_store: Optional[SpentStampStore] = None,
+                 difficulty: Optional[AdaptiveDifficulty] = None):
+        self.request_details = request_details
+        self.headers = headers
+        self.state_encryptor = state_encryptor
+        self.configuration = configuration
+        self.validate_hashcash = validate_hashcash
+        self.spent_stamp_store = spent_stamp_store
+        self.difficulty = difficulty
+
+        self.now: float = time.time()
+
+        self.remote_address: Optional[str] = None
+        self.body: Optional[str] = None
+        self.csrf: Optional[str] = None
+        self.captcha: Optional[str] = None
+        self.hashcash: Optional[str] = None
+
+        self.zeros: Optional[str] = None
+        self.timestamp: Optional[str] = None
+        self.ip: Optional[str] = None
+        self.server_string: Optional[str] = None
+
+        self.state: Optional[Dict[str, Any]] = None
+
+
+class ValidationStage(object):
+    """
+    A named check of the validation pipeline.
+    :param check: returns a failure to reject the request, or None to pass it on to the next stage
+    :param cost: relative cost of the check, see the *_COST constants
+    """
+    def __init__(self, name: str, check: Callable[[ValidationContext], Optional[Failure]], cost: int = HEADER_COST):
+        self.name = name
+        self.check = check
+        self.cost = cost
+
+    def __repr__(self):
+        return f"ValidationStage({self.name!r}, cost={self.cost})"
+
+
+class StageStatistics(object):
+    def __init__(self):
+        self.runs = 0
+        self.rejections = 0
+        self.seconds = 0.0
+
+
+class ValidationPipeline(object):
+    """
+    Runs validation stages in order, stopping at the first failure, and keeps per-stage statistics of runs,
+    rejections and time spent. Stages can be inserted, moved or removed, to adapt the pipeline to a deployment.
+    """
+    def __init__(self, stages: Optional[Iterable[ValidationStage]] = None):
+        self.__lock = threading.Lock()
+        self.__stages: List[ValidationStage] = []
+        self.__statistics: Dict[str, StageStatistics] = {}
+
+        for stage in default_stages() if stages is None else stages:
+            self.append(stage)
+
+    @property
+    def stages(self) -> List[ValidationStage]:
+        return list(self.__stages)
+
+    @property
+    def stage_names(self) -> List[str]:
+        return [stage.name for stage in self.__stages]
+
+    def statistics(self) -> Dict[str, StageStatistics]:
+        with self.__lock:
+            return dict(self.__statistics)
+
+    def append(self, stage: ValidationStage) -> None:
+        self.insert(len(self.__stages), stage)
+
+    def insert(self, index: int, stage: ValidationStage) -> None:
+        if stage.name in self.__statistics:
+            raise ValueError(f"Stage {stage.name} already exists")
+
+        with self.__lock:
+            self.__stages.insert(index, stage)
+            self.__statistics[stage.name] = StageStatistics()
+
+    def insert_before(self, name: str, stage: ValidationStage) -> None:
+        self.insert(self.index(name), stage)
+
+    def insert_after(self, name: str, stage: ValidationStage) -> None:
+        self.insert(self.index(name) + 1, stage)
+
+    def remove(self, name: str) -> ValidationStage:
+        with self.__lock:
+            stage = self.__stages.pop(self.index(name))
+            del self.__statistics[name]
+
+        return stage
+
+    def move_before(self, name: str, other_name: str) -> None:
+        self.insert_before(other_name, self.remove(name))
+
+    def index(self, name: str) -> int:
+        for index, stage in enumerate(self.__stages):
+            if stage.name == name:
+                return index
+
+        raise ValueError(f"No stage named {name}")
+
+    def run(self, context: ValidationContext) -> Optional[Failure]:
+        for stage in self.__stages:
+            start = time.perf_counter()
+            failure = None
+
+            try:
+                failure = stage.check(context)
+            finally:
+                self.__record(stage.name, time.perf_counter() - start, failure is not None)
+
+            if failure is not None:
+                return failure
+
+        return None
+
+    def __record(self, name: str, seconds: float, rejected: bool) -> None:
+        metrics.observe("validation_stage_seconds", seconds, stage=name)
+
+        with self.__lock:
+            statistics = self.__statistics.get(name)
+
+            # The stage may have been removed while running
+            if statistics is None:
+                return
+
+            statistics.runs += 1
+            statistics.seconds += seconds
+            statistics.rejections += rejected
+
+
+def check_referrer(context: ValidationContext) -> Optional[Failure]:
+    request_details = context.request_details
+
+    # No referrer? A legitimate browser would have sent it. Fail.
+    if not request_details.get("referrer"):
+        return "referrer", "not provided"
+
+    # To validate the referrer, we need the host
+    if not request_details.get("host"):
+        return "host", "not provided"
+
+    # For the sake of the project, we support only http hosts
+    acceptable_referrer = 'http://%s/' % request_details["host"]
+
+    # The referrer should be a page on the same host
+    if not request_details["referrer"].startswith(acceptable_referrer):
+        return "referrer", "doesn't match"
+
+
+def check_requested_with(context: ValidationContext) -> Optional[Failure]:
+    requested_with = context.headers.get("X-Requested-With")
+
+    # We require X-Requested-With: XmlHttpRequest
+    if not requested_with:
+        return "requested_with", "not provided"
+
+    if not requested_with == "XmlHttpRequest":
+        return "requested_with", "not XmlHttpRequest"
+
+
+def check_required_fields(context: ValidationContext) -> Optional[Failure]:
+    context.remote_address = context.request_details.get("remote_addr")
+
+    # Fail on missing remote address
+    if not context.remote_address:
+        return "remote_address", "not provided"
+
+    context.body = context.request_details.get("body")
+
+    # Fail on missing body
+    if not context.body:
+        return "body", "not provided"
+
+    context.csrf = context.headers.get("X-Csrf-Token")
+
+    # Fail on missing csrf token
+    if not context.csrf:
+        return "csrf", "not provided"
+
+    context.captcha = context.headers.get("X-Captcha")
+
+    # Fail on missing captcha answer
+    if not context.captcha:
+        return "captcha", "not provided"
+
+    context.hashcash = context.headers.get("X-Hashcash")
+
+    # Fail on missing hashcash
+    if not context.hashcash:
+        return "hashcash", "not provided"
+
+
+def check_hashcash_structure(context: ValidationContext) -> Optional[Failure]:
+    # Split hashcash into elements (the last two parts were calculated by the client to
+    # achieve the zeros goal, so we ignore them
+    try:
+        context.zeros, context.timestamp, context.ip, context.server_string, _, _ = context.hashcash.split(":")
+    except ValueError:
+        return "hashcash", "illegal structure"
+
+
+def check_hashcash_timestamp(context: ValidationContext) -> Optional[Failure]:
+    # Measure the age in seconds
+    diff_in_seconds = context.now - parse_timestamp(context.timestamp)
+
+    submit_timeout = context.configuration.get("submit_timeout")
+    assert submit_timeout, "Missing configuration item: submit_timeout"
+
+    # Fail if timeout has been reached since the user has generated the hashcash
+    if not 0 < diff_in_seconds <= float(submit_timeout):
+        return "hashcash", "hashcash timestamp exceeds timeout"
+
+
+def check_hashcash_ip(context: ValidationContext) -> Optional[Failure]:
+    self_ip_addresses = context.configuration.get("self_ip_addresses")
+    assert self_ip_addresses is not None, "Missing configuration item: self_ip_addresses"
+
+    if context.remote_address not in [context.ip] + self_ip_addresses:
+        return "hashcash", "ip address doesn't match: " + context.remote_address
+
+
+def minimum_zero_count(context: ValidationContext) -> int:
+    """The fewest zeros ever issued: the configured count, or the calm one of adaptive difficulty if lower"""
+    hashcash_zero_count = context.configuration.get("hashcash_zero_count")
+    assert hashcash_zero_count is not None, "Missing configuration item: hashcash_zero_count"
+
+    if context.difficulty is not None:
+        return min(int(hashcash_zero_count), context.difficulty.base_zero_count)
+
+    return int(hashcash_zero_count)
+
+
+def check_hashcash_zeros(context: ValidationContext) -> Optional[Failure]:
+    # The claimed count is only matched against the state after decryption, but must not come for free before
+    if int(context.zeros) < minimum_zero_count(context):
+        return "hashcash", "too few zeros"
+
+    if not context.validate_hashcash(bytes(context.hashcash, "utf-8"), int(context.zeros)):
+        return "hashcash", "zeros not validated"
+
+
+def check_replay(context: ValidationContext) -> Optional[Failure]:
+    # Only stamps of at least the minimum zero count reach the store, and before the expensive decryption
+    if context.spent_stamp_store is not None and not context.spent_stamp_store.spend(bytes(context.hashcash,
+                                                                                           "utf-8")):
+        return "hashcash", "already spent"
+
+
+def decrypt_state(context: ValidationContext) -> Optional[Failure]:
+    try:
+        data = json.loads(context.body)
+        encrypted_state = data["state"]
+        context.state = context.state_encryptor.decrypt_state(encrypted_state.encode())
+    except JSONDecodeError:
+        return "body", "bad format"
+    except (KeyError, AttributeError):
+        return "state", "not provided"
+    except ValueError as e:
+        return "state", str(e)
+
+
+def check_state_age(context: ValidationContext) -> Optional[Failure]:
+    # Measure login form age in seconds
+    diff_in_seconds = context.now - parse_timestamp(context.state["server_time"])
+
+    login_form_timeout = context.configuration.get("login_form_timeout")
+    assert login_form_timeout, "Missing configuration item: login_form_timeout"
+
+    # Fail if timeout has been reached since login form was generated
+    if not 0 < diff_in_seconds <= float(login_form_timeout):
+        return "state", "login form age exceeds timeout"
+
+
+def check_state_match(context: ValidationContext) -> Optional[Failure]:
+    # Verify number of zeros in hashcash matches state
+    if int(context.zeros) != int(context.state["hashcash"]["zero_count"]):
+        return "hashcash", "zeros don't match state"
+
+    # Verify server string in hashcash matches state
+    if context.server_string != context.state["hashcash"]["server_string"]:
+        return "hashcash", "server string doesn't match state"
+
+    # Verify csrf token in hashcash matches state
+    if context.csrf != context.state["csrf_token"]:
+        return "csrf", "csrf token doesn't match state"
+
+
+def check_captcha(context: ValidationContext) -> Optional[Failure]:
+    captcha_solutions = set(context.state["captcha_solutions"])
+
+    # Verify captcha
+    if context.captcha not in captcha_solutions:
+        return "captcha", f"captcha solution isn't in {captcha_solutions}"
+
+
+def default_stages() -> List[ValidationStage]:
+    """
+    The stages run by default, cheapest rejections first. Stages rely on what earlier stages extracted into the
+    context, so a reordered pipeline must keep required_fields and hashcash_structure ahead of the hashcash
+    stages, and state_decryption ahead of the state stages.
+    """
+    return [
+        ValidationStage("referrer", check_referrer, HEADER_COST),
+        ValidationStage("requested_with", check_requested_with, HEADER_COST),
+        ValidationStage("required_fields", check_required_fields, HEADER_COST),
+        ValidationStage("hashcash_structure", check_hashcash_structure, PARSING_COST),
+        ValidationStage("hashcash_timestamp", check_hashcash_timestamp, PARSING_COST),
+        ValidationStage("hashcash_ip", check_hashcash_ip, HEADER_COST),
+        ValidationStage("hashcash_zeros", check_hashcash_zeros, HASHING_COST),
+        ValidationStage("replay", check_replay, HASHING_COST),
+        ValidationStage("state_decryption", decrypt_state, CRYPTO_COST),
+        ValidationStage("state_age", check_state_age, PARSING_COST),
+        ValidationStage("state_match", check_state_match, HEADER_COST),
+        ValidationStage("captcha", check_captcha, HEADER_COST),
+    ]
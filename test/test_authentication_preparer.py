@@ -1,31 +1,96 @@
+import asyncio
+import json
 import os
 from unittest import TestCase
 from unittest.mock import Mock
 
 from src import StateEncryptor
 from src.authentication_preparer import Preparer
+from src.difficulty import AdaptiveDifficulty
 
 
 class TestPreparer(TestCase):
+    configuration = {
+        "captcha_directory": os.path.dirname(os.path.realpath(__file__)) + "/test_resources/test_captcha_images",
+        "csrf_token_length": 17,
+        "hashcash_server_string_length": 13,
+        "hashcash_zero_count": 14,
+        "passphrase_minimum_length": 12,
+        "client_hash_cycles": 102,
+        "client_hash_length": 23,
+        "password_minimum_length": 16,
+        "SIGNUM_TEST_MODE": True
+    }
+
+    def setUp(self):
+        self.encryptor = Mock(spec=StateEncryptor)
+        self.encryptor.encrypt_state.return_value = b'Hello world'
+
     def test_prepare_authentication(self):
-        encryptor = Mock(spec=StateEncryptor)
-        encryptor.encrypt_state.return_value = b'Hello world'
+        self.check_result(Preparer.prepare_authentication(self.encryptor, self.configuration))
+
+    def test_aprepare_authentication(self):
+        self.check_result(asyncio.run(Preparer.aprepare_authentication(self.encryptor, self.configuration)))
+
+    def test_adaptive_difficulty(self):
+        difficulty = AdaptiveDifficulty(base_zero_count=10, request_threshold=2)
+
+        zero_counts = []
+        for _ in range(4):
+            result = Preparer.prepare_authentication(self.encryptor, self.configuration, difficulty=difficulty,
+                                                     remote_address="10.0.0.1")
+            zero_count = result["unencrypted_state"]["hashcash"]["zero_count"]
+
+            # The client is told the zero count that the state enforces
+            self.assertIn(f'"zeroCount": {zero_count},', result["server-instructions"])
+            zero_counts.append(zero_count)
+
+        self.assertEqual([10, 11, 11, 12], zero_counts)
+
+    def test_preparer_instance(self):
+        preparer = Preparer(self.encryptor, self.configuration)
+
+        self.check_result(preparer.prepare())
+        self.check_result(asyncio.run(preparer.aprepare()))
+
+    def test_fragments_are_json(self):
+        result = Preparer(self.encryptor, self.configuration).prepare()
+        state = result["unencrypted_state"]
+
+        self.assertEqual({
+            "captcha": {"require": True},
+            "hashcash": {"require": True, "zeroCount": 14, "serverString": state["hashcash"]["server_string"]},
+            "csrfToken": {"require": True},
+            "tolerance": {"minimumAlphabetPassphrase": 12},
+            "hashing": {"saltHashByUsername": True, "hashCycles": 102, "resultLength": 23}
+        }, json.loads(result["server-instructions"]))
+        self.assertEqual({"minimumCharactersPassword": 16}, json.loads(result["passtextStrength"]))
+        self.assertEqual({"minimumAlphabetPassphrase": 12}, json.loads(result["tolerance"]))
+
+        # Requests get their own hashcash server string
+        self.assertNotEqual(result["server-instructions"],
+                            Preparer.prepare_authentication(self.encryptor, self.configuration)["server-instructions"])
+
+    def test_transaction_details_without_encryptor(self):
+        state = Preparer.create_state({"cat", "cats"}, self.configuration)
+
+        self.assertEqual(Preparer(self.encryptor, self.configuration).transaction_details("url", state, b"state"),
+                         Preparer.create_transaction_details("url", state, b"state", self.configuration))
 
-        configuration = {
-            "captcha_directory": os.path.dirname(os.path.realpath(__file__)) + "/test_resources/test_captcha_images",
-            "csrf_token_length": 17,
-            "hashcash_server_string_length": 13,
-            "hashcash_zero_count": 14,
-            "passphrase_minimum_length": 12,
-            "client_hash_cycles": 102,
-            "client_hash_length": 23,
-            "password_minimum_length": 16,
-            "SIGNUM_TEST_MODE": True
+    def test_serialize_transaction(self):
+        result = Preparer(self.encryptor, self.configuration).prepare()
 
-        }
+        serialization = json.loads(Preparer.serialize_transaction(result))
 
-        result = Preparer.prepare_authentication(encryptor, configuration)
+        self.assertEqual(result["captcha"], serialization["captcha"])
+        self.assertEqual(json.loads(result["server-instructions"]), serialization["server-instructions"])
+        self.assertEqual("Hello world", serialization["state"])
+        self.assertEqual(result["csrfToken"], serialization["csrfToken"])
+        self.assertEqual({"minimumCharactersPassword": 16}, serialization["passtextStrength"])
+        self.assertEqual({"minimumAlphabetPassphrase": 12}, serialization["tolerance"])
+        self.assertEqual(result["unencrypted_state"], serialization["unencrypted_state"])
 
+    def check_result(self, result):
         self.assertTrue(result["captcha"].startswith("data:img/jpeg;base64"))
         self.assertLessEqual(17, len(result["csrfToken"]))
         self.assertEqual(b'Hello world', result["state"])
@@ -1,7 +1,10 @@
+import asyncio
 from unittest import TestCase
 from unittest.mock import Mock
 
 from src.authentication_validator import AuthenticationValidator
+from src.difficulty import AdaptiveDifficulty
+from src.spent_stamps import InMemorySpentStampStore
 from src.state import StateEncryptor
 
 
@@ -88,6 +91,12 @@ class TestAuthenticationValidator(TestCase):
         self.expect_failure("general", "invalid literal for int() with base 10: 'zeros'")
         self.headers["X-Hashcash"] = "20:20200730-153516:135.136.137.138:server_string:_:_"
 
+        self.expect_failure("general", "Missing configuration item: hashcash_zero_count")
+        self.configuration["hashcash_zero_count"] = 21
+
+        self.expect_failure("hashcash", "too few zeros")
+        self.configuration["hashcash_zero_count"] = 20
+
         self.expect_failure("hashcash", "zeros not validated")
 
         # Shushing the hashcash validator
@@ -139,3 +148,80 @@ class TestAuthenticationValidator(TestCase):
 
         self.assertTrue(passed)
         self.assertTrue(response["visible_response"]["passed"])
+
+    def test_avalidate(self):
+        success, response = asyncio.run(AuthenticationValidator.avalidate(
+            request_details=self.request_details, headers=self.headers, state_encryptor=self.state_encryptor,
+            configuration=self.configuration))
+
+        self.assertFalse(success)
+        self.assertEqual("referrer", response['security_details']['failure_stage'])
+
+    def test_replayed_hashcash(self):
+        self.request_details = {"referrer": "http://www.host1.com/aloha", "host": "www.host1.com",
+                                "remote_addr": "127.0.0.1", "body": '{"state": "sdf"}'}
+        self.headers = {"X-Requested-With": "XmlHttpRequest", "X-Csrf-Token": "csrf_token", "X-Captcha": "gremlins",
+                        "X-Hashcash": "20:20200730-153516:127.0.0.1:server_string:_:_"}
+        self.configuration = {"submit_timeout": "100000000000000", "self_ip_addresses": [],
+                              "login_form_timeout": "100000000000000", "hashcash_zero_count": 20}
+        self.state_encryptor.decrypt_state = Mock(side_effect=ValueError("Cannot decrypt state"))
+
+        spent_stamp_store = InMemorySpentStampStore(60)
+
+        def validate():
+            return TestAuthenticationValidator.TestValidator.validate(
+                request_details=self.request_details, headers=self.headers, state_encryptor=self.state_encryptor,
+                configuration=self.configuration, spent_stamp_store=spent_stamp_store)
+
+        _, response = validate()
+        self.assertEqual("Cannot decrypt state", response['security_details']['failure_reason'])
+
+        _, response = validate()
+        self.assertEqual("hashcash", response['security_details']['failure_stage'])
+        self.assertEqual("already spent", response['security_details']['failure_reason'])
+
+        # The replay was rejected before the state was decrypted
+        self.assertEqual(1, self.state_encryptor.decrypt_state.call_count)
+
+    def test_cheap_stamps_are_not_spent(self):
+        self.request_details = {"referrer": "http://www.host1.com/aloha", "host": "www.host1.com",
+                                "remote_addr": "127.0.0.1", "body": '{"state": "sdf"}'}
+        self.headers = {"X-Requested-With": "XmlHttpRequest", "X-Csrf-Token": "csrf_token", "X-Captcha": "gremlins",
+                        "X-Hashcash": "0:20200730-153516:127.0.0.1:server_string:_:_"}
+        self.configuration = {"submit_timeout": "100000000000000", "self_ip_addresses": [],
+                              "hashcash_zero_count": 20}
+
+        spent_stamp_store = InMemorySpentStampStore(60)
+        difficulty = AdaptiveDifficulty(base_zero_count=10)
+
+        # A stamp claiming no zeros is valid whatever it holds, so it costs nothing to make
+        for validate_difficulty in [None, difficulty]:
+            _, response = AuthenticationValidator.validate(
+                request_details=self.request_details, headers=self.headers, state_encryptor=self.state_encryptor,
+                configuration=self.configuration, spent_stamp_store=spent_stamp_store,
+                difficulty=validate_difficulty)
+
+            self.assertEqual("too few zeros", response['security_details']['failure_reason'])
+
+        self.assertEqual(0, len(spent_stamp_store))
+
+        # Adaptive difficulty lowers the floor to the zero count it issues to calm sources
+        self.headers["X-Hashcash"] = "10:20200730-153516:127.0.0.1:server_string:_:_"
+        _, response = TestAuthenticationValidator.TestValidator.validate(
+            request_details=self.request_details, headers=self.headers, state_encryptor=self.state_encryptor,
+            configuration=self.configuration, spent_stamp_store=spent_stamp_store, difficulty=difficulty)
+
+        self.assertNotEqual("hashcash", response['security_details']['failure_stage'])
+        self.assertEqual(1, len(spent_stamp_store))
+
+    def test_failures_raise_difficulty(self):
+        difficulty = AdaptiveDifficulty(base_zero_count=10, failure_threshold=2)
+        self.request_details = {"remote_addr": "10.0.0.1"}
+
+        for _ in range(2):
+            AuthenticationValidator.validate(request_details=self.request_details, headers=self.headers,
+                                             state_encryptor=self.state_encryptor,
+                                             configuration=self.configuration, difficulty=difficulty)
+
+        self.assertEqual(11, difficulty.zero_count("10.0.0.1"))
+        self.assertEqual(10, difficulty.zero_count("10.0.1.1"))
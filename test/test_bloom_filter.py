@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from src.bloom_filter import BloomFilter
+
+
+class TestBloomFilter(TestCase):
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            BloomFilter(0)
+        self.assertEqual("Bad capacity", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            BloomFilter(10, 1)
+        self.assertEqual("Bad false_positive_rate", str(e.exception))
+
+    def test_membership(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+
+        # Adding may collide with earlier items, at about the false positive rate
+        added = sum(not bloom_filter.add(b"item %d" % index) for index in range(1000))
+
+        self.assertLess(970, added)
+        self.assertEqual(added, bloom_filter.count)
+
+        # No false negatives
+        for index in range(1000):
+            self.assertIn(b"item %d" % index, bloom_filter)
+            self.assertTrue(bloom_filter.add(b"item %d" % index))
+
+        false_positives = sum(b"other %d" % index in bloom_filter for index in range(10000))
+        self.assertLess(false_positives, 300)
+
+        bloom_filter.clear()
+        self.assertNotIn(b"item 1", bloom_filter)
+        self.assertEqual(0, bloom_filter.count)
+
+    def test_sizing(self):
+        # About 9.6 bits per item for 1%
+        self.assertEqual(1199, BloomFilter(1000, 0.01).size_in_bytes)
+        self.assertEqual(7, BloomFilter(1000, 0.01).hash_count)
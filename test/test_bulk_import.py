@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from src.bulk_import import BulkImporter, read_credentials
+from src.password_backends import SqlitePasswordRepository
+from test.test_password_repository import InMemoryPasswordRepository
+
+
+class TestBulkImport(TestCase):
+    credentials = [(f"user{i}", f"password{i}") for i in range(250)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_import(self):
+        repository = SqlitePasswordRepository(self.directory + "/passwords.db", "username_salt")
+        reports = []
+
+        report = BulkImporter(repository, chunk_size=40, workers=2).run(iter(self.credentials), reports.append)
+
+        self.assertEqual(250, report.imported)
+        self.assertEqual(0, report.rejected)
+        self.assertEqual(7, len(reports))
+        self.assertLess(0, report.rate)
+
+        for username, password in self.credentials[::25]:
+            self.assertEqual((True, "Match"), repository.validate_password(username, password))
+
+    def test_rejected_credentials(self):
+        repository = InMemoryPasswordRepository()
+
+        report = BulkImporter(repository, chunk_size=2, executor=ThreadPoolExecutor(2)).run(
+            [("Joe", "password"), ("x", "password"), ("Moses", ""), ("Aaron", "password")])
+
+        self.assertEqual(2, report.imported)
+        self.assertEqual(2, report.rejected)
+        self.assertEqual(["Username must be of at least 3 characters", "Password must be of at least 3 characters"],
+                         report.errors)
+        self.assertEqual(2, len(repository.database))
+
+    def test_resume(self):
+        repository = InMemoryPasswordRepository()
+        checkpoint_path = self.directory + "/checkpoint"
+        importer = BulkImporter(repository, chunk_size=50, executor=ThreadPoolExecutor(1), workers=1,
+                                checkpoint_path=checkpoint_path)
+
+        def crash_after_two_chunks(report):
+            if report.processed == 100:
+                raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            importer.run(self.credentials, crash_after_two_chunks)
+
+        with open(checkpoint_path) as f:
+            self.assertEqual({"processed": 100}, json.load(f))
+
+        self.assertEqual(100, len(repository.database))
+
+        report = importer.run(self.credentials)
+
+        self.assertEqual(100, report.resumed_from)
+        self.assertEqual(150, report.imported)
+        self.assertEqual(250, report.processed)
+        self.assertEqual(250, len(repository.database))
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+    def test_read_credentials(self):
+        with open(self.directory + "/credentials.csv", "w") as f:
+            f.write("user,pass\nJoe,password\nMoses,\"pass,word\"\n")
+
+        with open(self.directory + "/credentials.jsonl", "w") as f:
+            f.write('{"user": "Joe", "pass": "password"}\n\n{"user": "Moses", "pass": "pass,word"}\n')
+
+        for extension in ["csv", "jsonl"]:
+            self.assertEqual([("Joe", "password"), ("Moses", "pass,word")],
+                             list(read_credentials(f"{self.directory}/credentials.{extension}", "user", "pass")))
+
+        with self.assertRaises(ValueError):
+            read_credentials(self.directory + "/credentials.txt")
+
+    def test_malformed_lines(self):
+        with open(self.directory + "/credentials.jsonl", "w") as f:
+            f.write('{"username": "Joe", "password": "password"}\n{"username": \n["Moses", "password"]\n'
+                    '{"username": "Aaron", "password": "password"}\n')
+
+        repository = InMemoryPasswordRepository()
+
+        report = BulkImporter(repository, chunk_size=2, executor=ThreadPoolExecutor(2)).run(
+            read_credentials(self.directory + "/credentials.jsonl"))
+
+        # Malformed lines are rejected alone, the rest of the file is imported
+        self.assertEqual(2, report.imported)
+        self.assertEqual(2, report.rejected)
+        self.assertEqual(2, len(report.errors))
+        self.assertTrue(report.errors[0].startswith("Line 2: "))
+        self.assertEqual("Line 3: not a JSON object", report.errors[1])
+        self.assertEqual((True, "Match"), repository.validate_password("Aaron", "password"))
+
+    def test_fields_of_other_types(self):
+        with open(self.directory + "/credentials.jsonl", "w") as f:
+            f.write('{"username": "Joe", "password": 123456}\n{"username": "Moses", "password": null}\n'
+                    '{"password": "password"}\n{"username": "Aaron", "password": "password"}\n')
+
+        repository = InMemoryPasswordRepository()
+
+        report = BulkImporter(repository, chunk_size=2, executor=ThreadPoolExecutor(2)).run(
+            read_credentials(self.directory + "/credentials.jsonl"))
+
+        self.assertEqual(1, report.imported)
+        self.assertEqual(3, report.rejected)
+        self.assertEqual([f"Line {n}: username and password must be strings" for n in range(1, 4)], report.errors)
+        self.assertEqual((True, "Match"), repository.validate_password("Aaron", "password"))
+
+        # Records of other sources are rejected alone as well
+        report = BulkImporter(repository, chunk_size=2, executor=ThreadPoolExecutor(2)).run(
+            [("Joe", 123456), ("Moses", None), ("Jane", ["p", "a", "s", "s"]), ("Miriam", "password")])
+
+        self.assertEqual(1, report.imported)
+        self.assertEqual(3, report.rejected)
+        self.assertEqual((True, "Match"), repository.validate_password("Miriam", "password"))
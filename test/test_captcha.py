@@ -4,9 +4,12 @@ import os
 import random
 import shutil
 import tempfile
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
-from src.captcha import generate_captcha_challenge, require_singular, allow_plural
+from src.captcha import generate_captcha_challenge, require_singular, allow_plural, CaptchaCatalog, \
+    ThumbnailCache
 
 
 class TestCaptcha(TestCase):
@@ -76,3 +79,118 @@ class TestCaptcha(TestCase):
         for _ in range(20):
             _, solution = generate_captcha_challenge(image_folder, require_singular)
             self.assertIn(next(iter(solution)), {os.path.basename(f) for f in glob.glob(image_folder + "/*")})
+
+    def test_catalog_index(self):
+        catalog = CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", require_singular)
+
+        self.assertEqual({"1", "2"}, {os.path.basename(f) for f in catalog.folders})
+
+        for folder in catalog.folders:
+            self.assertEqual(3, len(catalog.images(folder)))
+
+    def test_catalog_does_not_scan_per_challenge(self):
+        catalog = CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", require_singular)
+
+        with patch("src.captcha.glob.glob") as mocked_glob, patch("src.captcha.os.listdir") as mocked_listdir:
+            for _ in range(10):
+                url, solution = catalog.generate_challenge()
+                self.assertTrue(url.startswith("data:img/jpeg;base64"))
+                self.assertIn(next(iter(solution)), {"1", "2"})
+
+            mocked_glob.assert_not_called()
+            mocked_listdir.assert_not_called()
+
+    def test_catalog_refresh(self):
+        temp = tempfile.mkdtemp()
+        shutil.copytree(self.test_resources_folder + "/test_captcha_images", temp + "/test_captcha_images")
+
+        catalog = CaptchaCatalog(temp + "/test_captcha_images", require_singular)
+        self.assertFalse(catalog.refresh_if_changed())
+
+        shutil.copytree(temp + "/test_captcha_images/1", temp + "/test_captcha_images/3")
+
+        self.assertTrue(catalog.refresh_if_changed())
+        self.assertEqual({"1", "2", "3"}, {os.path.basename(f) for f in catalog.folders})
+
+        for suffix in range(1, 3+1):
+            os.remove(f"{temp}/test_captcha_images/3/1-{suffix}.png")
+
+        with self.assertRaises(ValueError) as context:
+            catalog.refresh()
+
+        self.assertTrue('Not enough images in sub-directory ' in str(context.exception))
+
+        # A failed rescan keeps serving the last valid index
+        self.assertEqual(3, len(catalog.folders))
+
+    def test_catalog_failed_rescan_while_serving(self):
+        temp = tempfile.mkdtemp()
+        shutil.copytree(self.test_resources_folder + "/test_captcha_images", temp + "/test_captcha_images")
+
+        catalog = CaptchaCatalog(temp + "/test_captcha_images", require_singular, check_interval=0.01)
+
+        os.mkdir(temp + "/test_captcha_images/3")
+        time.sleep(0.02)
+
+        with self.assertLogs(level="ERROR"):
+            url, solution = catalog.generate_challenge()
+
+        self.assertTrue(url.startswith("data:img/jpeg;base64"))
+        self.assertIn(next(iter(solution)), {"1", "2"})
+        self.assertEqual({"1", "2"}, {os.path.basename(f) for f in catalog.folders})
+
+    def test_catalog_bad_check_interval(self):
+        with self.assertRaises(ValueError) as context:
+            CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", check_interval=-1)
+
+        self.assertEqual("Bad check_interval", str(context.exception))
+
+    def test_thumbnail_cache(self):
+        images = sorted(glob.glob(self.test_resources_folder + "/test_captcha_images/*/*.png"))
+        cache = ThumbnailCache()
+
+        tile = cache.get(images[0])
+        self.assertLessEqual(max(tile.size), 200)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+        self.assertIs(tile, cache.get(images[0]))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        self.assertEqual(ThumbnailCache.tile_size_in_bytes(tile), cache.size_in_bytes)
+
+    def test_thumbnail_cache_eviction(self):
+        images = sorted(glob.glob(self.test_resources_folder + "/test_captcha_images/*/*.png"))
+        tile_size = ThumbnailCache.tile_size_in_bytes(ThumbnailCache().get(images[0]))
+
+        cache = ThumbnailCache(max_bytes=tile_size * 2)
+
+        cache.get(images[0])
+        cache.get(images[1])
+        cache.get(images[0])
+        cache.get(images[2])
+
+        # The least recently used tile is evicted
+        self.assertIn(images[0], cache)
+        self.assertNotIn(images[1], cache)
+        self.assertIn(images[2], cache)
+        self.assertEqual(tile_size * 2, cache.size_in_bytes)
+
+        with self.assertRaises(ValueError) as context:
+            ThumbnailCache(max_bytes=0)
+
+        self.assertEqual("Bad max_bytes", str(context.exception))
+
+    def test_catalog_warm_up(self):
+        cache = ThumbnailCache()
+        catalog = CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", require_singular,
+                                 thumbnail_cache=cache, warm_up=True)
+
+        self.assertEqual(6, len(cache))
+
+        for _ in range(20):
+            url, solution = catalog.generate_challenge()
+
+            with open(self.test_resources_folder + f"/captcha{next(iter(solution))}.data", "rt") as f:
+                self.assertIn(url, f.read().splitlines())
+
+        self.assertEqual(0, cache.misses)
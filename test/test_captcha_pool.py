@@ -0,0 +1,99 @@
+import os
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+from src import StateEncryptor
+from src.authentication_preparer import Preparer
+from src.captcha import CaptchaCatalog, require_singular
+from src.captcha_pool import CaptchaPool
+
+
+class TestCaptchaPool(TestCase):
+    test_images_folder = os.path.dirname(os.path.realpath(__file__)) + "/test_resources/test_captcha_images"
+
+    def setUp(self):
+        self.catalog = CaptchaCatalog(self.test_images_folder, require_singular)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(condition())
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            CaptchaPool(self.catalog, size=0)
+        self.assertEqual("Bad size", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            CaptchaPool(self.catalog, size=4, low_water_mark=4)
+        self.assertEqual("Bad low_water_mark", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            CaptchaPool(self.catalog, worker_count=0)
+        self.assertEqual("Bad worker_count", str(e.exception))
+
+    def test_synchronous_fallback(self):
+        pool = CaptchaPool(self.catalog, size=4, low_water_mark=1)
+
+        url, solutions = pool.get()
+
+        self.assertTrue(url.startswith("data:img/jpeg;base64"))
+        self.assertIn(next(iter(solutions)), {"1", "2"})
+        self.assertEqual(1, pool.fallbacks)
+
+    def test_challenges_are_served_once(self):
+        pool = CaptchaPool(self.catalog, size=4, low_water_mark=1)
+        pool.fill()
+
+        self.assertEqual(4, len(pool))
+
+        served = [pool.get() for _ in range(4)]
+
+        self.assertEqual(0, len(pool))
+        self.assertEqual(0, pool.fallbacks)
+        self.assertEqual(4, len({id(challenge) for challenge in served}))
+
+    def test_background_refill(self):
+        pool = CaptchaPool(self.catalog, size=8, low_water_mark=2, worker_count=2)
+
+        try:
+            pool.start()
+            self.wait_for(lambda: len(pool) == 8)
+
+            for _ in range(6):
+                pool.get()
+
+            self.wait_for(lambda: len(pool) == 8)
+            self.assertEqual(0, pool.fallbacks)
+
+        finally:
+            pool.stop()
+
+    def test_preparer_uses_pool(self):
+        pool = CaptchaPool(self.catalog, size=2, low_water_mark=0)
+        pool.fill()
+
+        encryptor = Mock(spec=StateEncryptor)
+        encryptor.encrypt_state.return_value = b'Hello world'
+
+        configuration = {
+            "captcha_directory": "bad/path",
+            "csrf_token_length": 17,
+            "hashcash_server_string_length": 13,
+            "hashcash_zero_count": 14,
+            "passphrase_minimum_length": 12,
+            "client_hash_cycles": 102,
+            "client_hash_length": 23,
+            "password_minimum_length": 16,
+            "SIGNUM_TEST_MODE": True
+        }
+
+        result = Preparer.prepare_authentication(encryptor, configuration, captcha_pool=pool)
+
+        self.assertTrue(result["captcha"].startswith("data:img/jpeg;base64"))
+        self.assertEqual(1, len(result["unencrypted_state"]["captcha_solutions"]))
+        self.assertEqual(1, len(pool))
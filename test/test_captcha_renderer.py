@@ -0,0 +1,65 @@
+import asyncio
+import os
+from unittest import TestCase
+
+from src.captcha import CaptchaCatalog, require_singular
+from src.captcha_pool import CaptchaPool
+from src.captcha_renderer import ProcessCaptchaRenderer
+from src.image_store import InMemoryImageStore
+
+
+class TestProcessCaptchaRenderer(TestCase):
+    test_resources_folder = os.path.dirname(os.path.realpath(__file__)) + "/test_resources"
+
+    def setUp(self):
+        self.catalog = CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", require_singular)
+
+    def assert_valid_challenge(self, url, solution):
+        with open(self.test_resources_folder + f"/captcha{next(iter(solution))}.data", "rt") as f:
+            self.assertIn(url, f.read().splitlines())
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            ProcessCaptchaRenderer(self.catalog, max_workers=0)
+        self.assertEqual("Bad max_workers", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            ProcessCaptchaRenderer(self.catalog, thumbnail_cache_bytes=-1)
+        self.assertEqual("Bad thumbnail_cache_bytes", str(e.exception))
+
+    def test_futures(self):
+        with ProcessCaptchaRenderer(self.catalog, max_workers=2) as renderer:
+            futures = [renderer.submit() for _ in range(10)]
+
+            for future in futures:
+                self.assert_valid_challenge(*future.result(timeout=30))
+
+    def test_awaitable(self):
+        with ProcessCaptchaRenderer(self.catalog, max_workers=2, thumbnail_cache_bytes=0) as renderer:
+            async def render_all():
+                return await asyncio.gather(*[renderer.generate_challenge_async() for _ in range(4)])
+
+            for url, solution in asyncio.run(render_all()):
+                self.assert_valid_challenge(url, solution)
+
+    def test_reload_and_pool(self):
+        with ProcessCaptchaRenderer(self.catalog, max_workers=1) as renderer:
+            renderer.reload()
+
+            pool = CaptchaPool(renderer, size=2, low_water_mark=0)
+            pool.fill()
+
+            self.assert_valid_challenge(*pool.get())
+            self.assert_valid_challenge(*pool.get())
+            self.assertEqual(0, pool.fallbacks)
+
+    def test_image_store(self):
+        store = InMemoryImageStore(url_prefix="/captcha/")
+        catalog = CaptchaCatalog(self.test_resources_folder + "/test_captcha_images", require_singular,
+                                 image_store=store)
+
+        with ProcessCaptchaRenderer(catalog, max_workers=1) as renderer:
+            url, _ = renderer.generate_challenge()
+
+        self.assertTrue(url.startswith("/captcha/"))
+        self.assertEqual(1, len(store))
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from src.difficulty import SlidingWindowCounter, AdaptiveDifficulty
+
+
+class TestSlidingWindowCounter(TestCase):
+    def test_sliding(self):
+        counter = SlidingWindowCounter(window=10)
+
+        for _ in range(10):
+            counter.add("a", now=1005)
+
+        self.assertEqual(10, counter.count("a", now=1009))
+        self.assertEqual(0, counter.count("b", now=1009))
+
+        # Half of the previous window is still covered
+        self.assertEqual(5, counter.count("a", now=1015))
+        self.assertEqual(6, counter.add("a", now=1015))
+
+        # A gap of more than a window forgets everything
+        self.assertEqual(0, counter.count("a", now=1035))
+
+    def test_bounded_keys(self):
+        counter = SlidingWindowCounter(window=10, max_keys=100)
+
+        for i in range(1000):
+            counter.add(str(i), now=1000)
+
+        self.assertLessEqual(len(counter), 100)
+        self.assertEqual(1, counter.count("999", now=1000))
+
+    def test_busy_keys_survive_a_spray(self):
+        counter = SlidingWindowCounter(window=10, max_keys=100)
+
+        # A busy source, first seen long before a spray of new sources
+        for i in range(1000):
+            counter.add("busy", now=1000)
+            counter.add(f"spray{i}", now=1000)
+
+        self.assertEqual(1000, counter.count("busy", now=1000))
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError):
+            SlidingWindowCounter(window=0)
+
+        with self.assertRaises(ValueError):
+            SlidingWindowCounter(max_keys=0)
+
+
+class TestAdaptiveDifficulty(TestCase):
+    def test_request_rate(self):
+        difficulty = AdaptiveDifficulty(base_zero_count=10, max_zero_count=13, window=60, request_threshold=4)
+
+        zero_counts = [difficulty.issue("1.2.3.4", now=1000) for _ in range(40)]
+
+        # Every doubling of the rate beyond the threshold costs another bit, up to the maximum
+        self.assertEqual([10] * 3 + [11] * 4 + [12] * 8 + [13] * 25, zero_counts)
+
+        # Difficulty relaxes as the window slides past the load
+        self.assertEqual(13, difficulty.zero_count("1.2.3.4", now=1030))
+        self.assertEqual(11, difficulty.zero_count("1.2.3.4", now=1070))
+        self.assertEqual(10, difficulty.zero_count("1.2.3.4", now=1200))
+
+    def test_failures(self):
+        difficulty = AdaptiveDifficulty(base_zero_count=10, failure_threshold=2)
+
+        difficulty.record_failure("1.2.3.4", now=1000)
+        self.assertEqual(10, difficulty.zero_count("1.2.3.4", now=1000))
+
+        difficulty.record_failure("1.2.3.4", now=1000)
+        self.assertEqual(11, difficulty.zero_count("1.2.3.4", now=1000))
+
+    def test_subnet(self):
+        difficulty = AdaptiveDifficulty(base_zero_count=10, request_threshold=100, subnet_multiplier=2)
+
+        # Each address stays below its own threshold, but the subnet does not
+        for i in range(200):
+            difficulty.record_request(f"1.2.3.{i}", now=1000)
+
+        self.assertEqual(11, difficulty.zero_count("1.2.3.250", now=1000))
+        self.assertEqual(10, difficulty.zero_count("1.2.4.1", now=1000))
+
+        self.assertEqual("1.2.3.0/24", difficulty.subnet("1.2.3.4"))
+        self.assertEqual("2001:db8::/64", difficulty.subnet("2001:db8::1"))
+        self.assertEqual("unix-socket", difficulty.subnet("unix-socket"))
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError):
+            AdaptiveDifficulty(base_zero_count=10, max_zero_count=9)
+
+        with self.assertRaises(ValueError):
+            AdaptiveDifficulty(base_zero_count=10, request_threshold=0)
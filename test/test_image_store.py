@@ -0,0 +1,104 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from src.captcha import CaptchaCatalog, require_singular
+from src.image_store import InMemoryImageStore, FileSystemImageStore, MemoryMappedImageStore
+
+
+class TestImageStore(TestCase):
+    def check_store_and_serve(self, store):
+        image_id = store.store(b"jpeg bytes")
+
+        self.assertLessEqual(32, len(image_id))
+        self.assertEqual(b"jpeg bytes", bytes(store.serve(image_id)))
+        self.assertIsInstance(store.serve(image_id), memoryview)
+
+        self.assertIsNone(store.serve("unknown"))
+        self.assertIsNone(store.serve(""))
+
+        store.delete(image_id)
+        self.assertIsNone(store.serve(image_id))
+
+    def check_expiry(self, store):
+        image_id = store.store(b"jpeg bytes")
+        time.sleep(1.1)
+
+        self.assertIsNone(store.serve(image_id))
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            InMemoryImageStore(time_to_live=0)
+        self.assertEqual("Bad time_to_live", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            MemoryMappedImageStore(segment_size=0)
+        self.assertEqual("Bad segment_size", str(e.exception))
+
+    def test_in_memory_store(self):
+        self.check_store_and_serve(InMemoryImageStore())
+        self.check_expiry(InMemoryImageStore(time_to_live=1))
+
+    def test_in_memory_purge(self):
+        store = InMemoryImageStore(time_to_live=1)
+
+        for _ in range(10):
+            store.store(b"jpeg bytes")
+
+        time.sleep(1.1)
+        store.store(b"jpeg bytes")
+
+        self.assertEqual(1, len(store))
+
+    def test_file_system_store(self):
+        directory = tempfile.mkdtemp()
+
+        self.check_store_and_serve(FileSystemImageStore(directory))
+        self.assertIsNone(FileSystemImageStore(directory).serve("../../etc/passwd"))
+
+        # Another process would see the same images
+        image_id = FileSystemImageStore(directory).store(b"shared")
+        self.assertEqual(b"shared", bytes(FileSystemImageStore(directory).serve(image_id)))
+
+        store = FileSystemImageStore(directory, time_to_live=1)
+        self.check_expiry(store)
+
+        store.purge()
+        self.assertEqual([], os.listdir(directory))
+
+    def test_memory_mapped_store(self):
+        self.check_store_and_serve(MemoryMappedImageStore(segment_size=1024))
+        self.check_expiry(MemoryMappedImageStore(segment_size=1024, time_to_live=1))
+
+        file_backed = MemoryMappedImageStore(segment_size=1024, path=tempfile.mkdtemp() + "/segment")
+        self.check_store_and_serve(file_backed)
+
+    def test_memory_mapped_wrap_around(self):
+        store = MemoryMappedImageStore(segment_size=100)
+
+        ids = [store.store(bytes([index]) * 30) for index in range(3)]
+
+        # The fourth image doesn't fit after the third, so it overwrites the first
+        ids.append(store.store(bytes([3]) * 30))
+
+        self.assertIsNone(store.serve(ids[0]))
+
+        for index in range(1, 4):
+            self.assertEqual(bytes([index]) * 30, bytes(store.serve(ids[index])))
+
+        self.assertEqual(3, len(store))
+
+        with self.assertRaises(ValueError) as e:
+            store.store(bytes(101))
+        self.assertEqual("Image of 101 bytes doesn't fit in the segment", str(e.exception))
+
+    def test_catalog_with_image_store(self):
+        store = InMemoryImageStore(url_prefix="/captcha/")
+        catalog = CaptchaCatalog(os.path.dirname(os.path.realpath(__file__)) + "/test_resources/test_captcha_images",
+                                 require_singular, image_store=store)
+
+        url, _ = catalog.generate_challenge()
+
+        self.assertTrue(url.startswith("/captcha/"))
+        self.assertEqual(b"\xff\xd8", bytes(store.serve(url[len("/captcha/"):])[:2]))
@@ -0,0 +1,216 @@
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from unittest.mock import patch
+
+import schedule
+
+from src.key_ring import LocalKeyRing, SharedMemoryKeyRing, DirectoryKeyRing, TimeBucketKeyRing
+from src.state import StateEncryptor
+
+
+def _encrypt_in_other_process(path: str, state: dict, results: multiprocessing.Queue):
+    results.put(StateEncryptor(key_ring=SharedMemoryKeyRing(path)).encrypt_state(state))
+
+
+class TestKeyRing(TestCase):
+    state = {"hello": 2, "world": True}
+
+    def check_shared_rings(self, create_ring):
+        worker1 = StateEncryptor(state_aging_tolerance=6, key_renewal_frequency=1, key_ring=create_ring())
+        worker2 = StateEncryptor(state_aging_tolerance=6, key_renewal_frequency=1, key_ring=create_ring())
+
+        # Both workers start from the same key
+        self.assertEqual(worker1.key_ring.current_key()[0], worker2.key_ring.current_key()[0])
+        self.assertEqual(self.state, worker2.decrypt_state(worker1.encrypt_state(self.state)))
+
+        encryption = worker1.encrypt_state(self.state)
+        time.sleep(1.1)
+
+        # Whichever worker notices first renews the key, and the other one follows
+        renewed_key_id = worker2.key_ring.current_key()[0]
+        self.assertNotEqual(encryption.partition(b".")[0], renewed_key_id)
+        self.assertEqual(renewed_key_id, worker1.key_ring.current_key()[0])
+        self.assertEqual(2, len(worker1.key_ring.keys))
+
+        self.assertEqual(self.state, worker1.decrypt_state(encryption))
+        self.assertEqual(self.state, worker2.decrypt_state(encryption))
+        self.assertEqual(self.state, worker1.decrypt_state(worker2.encrypt_state(self.state)))
+
+        with self.assertRaises(ValueError) as e:
+            worker2.decrypt_state(b"AAAAAAAA" + encryption[8:])
+        self.assertEqual("Cannot decrypt state", str(e.exception))
+
+        return worker1, worker2
+
+    def test_local_rings_are_not_shared(self):
+        worker1 = StateEncryptor(key_ring=LocalKeyRing())
+        worker2 = StateEncryptor(key_ring=LocalKeyRing())
+
+        with self.assertRaises(ValueError):
+            worker2.decrypt_state(worker1.encrypt_state(self.state))
+
+    def test_shared_memory_key_ring(self):
+        path = tempfile.mkdtemp() + "/keys"
+
+        worker1, worker2 = self.check_shared_rings(lambda: SharedMemoryKeyRing(path))
+
+        # An explicit renewal by one worker is seen by the other right away
+        worker1.key_ring.renew()
+        self.assertEqual(worker1.key_ring.current_key()[0], worker2.key_ring.current_key()[0])
+
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+    def test_shared_memory_key_ring_across_processes(self):
+        path = tempfile.mkdtemp() + "/keys"
+        encryptor = StateEncryptor(key_ring=SharedMemoryKeyRing(path))
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_encrypt_in_other_process, args=(path, self.state, results))
+        process.start()
+        encryption = results.get(timeout=10)
+        process.join()
+
+        self.assertEqual(self.state, encryptor.decrypt_state(encryption))
+
+    def test_shared_memory_key_ring_recovers_abandoned_write(self):
+        path = tempfile.mkdtemp() + "/keys"
+        worker = StateEncryptor(key_ring=SharedMemoryKeyRing(path))
+        other_worker = StateEncryptor(key_ring=SharedMemoryKeyRing(path))
+        encryption = worker.encrypt_state(self.state)
+
+        # A writer died mid-write, leaving an odd generation behind
+        with open(path, "r+b") as f:
+            f.seek(4)
+            generation, = struct.unpack(">Q", f.read(8))
+            f.seek(4)
+            f.write(struct.pack(">Q", generation + 1))
+
+        # Readers stop waiting for the writer, and keep the keys it left intact
+        self.assertEqual(self.state, other_worker.decrypt_state(encryption))
+
+        with open(path, "r+b") as f:
+            f.seek(4)
+            generation, = struct.unpack(">Q", f.read(8))
+            self.assertEqual(0, generation % 2)
+            f.seek(4)
+            f.write(struct.pack(">Q", generation + 1))
+            # Torn in the middle of the current key
+            f.seek(14 + 8)
+            f.write(b"!" * 44)
+
+        worker.key_ring.renew()
+        self.assertEqual(worker.key_ring.current_key()[0], other_worker.key_ring.current_key()[0])
+        self.assertEqual(self.state, other_worker.decrypt_state(worker.encrypt_state(self.state)))
+
+    def test_directory_key_ring(self):
+        directory = tempfile.mkdtemp()
+
+        self.check_shared_rings(lambda: DirectoryKeyRing(directory))
+
+        self.assertEqual(0o600, os.stat(directory + "/keys.json").st_mode & 0o777)
+
+    def test_directory_key_ring_reloads_on_unknown_key(self):
+        directory = tempfile.mkdtemp()
+
+        worker1 = StateEncryptor(key_ring=DirectoryKeyRing(directory, reload_interval=0))
+        worker2 = StateEncryptor(key_ring=DirectoryKeyRing(directory, reload_interval=0))
+
+        # Not due yet for worker2, but worker1 rotated anyway
+        worker1.key_ring.renew()
+
+        self.assertEqual(self.state, worker2.decrypt_state(worker1.encrypt_state(self.state)))
+
+    def test_local_key_ring_keeps_default_scheduler_clean(self):
+        encryptor = StateEncryptor(key_renewal_frequency=1)
+
+        try:
+            encryptor.start()
+            self.assertEqual([], schedule.jobs)
+        finally:
+            encryptor.stop()
+
+    def test_time_bucket_key_ring(self):
+        master_secret = b"m" * 32
+        now = [1600000000.5]
+
+        clock = patch("time.time", side_effect=lambda: now[0])
+        clock.start()
+        self.addCleanup(clock.stop)
+
+        worker1 = StateEncryptor(state_aging_tolerance=30, key_renewal_frequency=10,
+                                 key_ring=TimeBucketKeyRing(master_secret))
+        worker2 = StateEncryptor(state_aging_tolerance=30, key_renewal_frequency=10,
+                                 key_ring=TimeBucketKeyRing(master_secret))
+
+        # Keys are derived, so workers agree without sharing anything but the master secret
+        encryption = worker1.encrypt_state(self.state)
+        self.assertEqual(self.state, worker2.decrypt_state(encryption))
+
+        now[0] += 10
+        self.assertNotEqual(encryption.partition(b".")[0], worker1.encrypt_state(self.state).partition(b".")[0])
+        self.assertEqual(4, len(worker1.key_ring.keys))
+
+        with patch("src.key_ring.HKDF") as hkdf:
+            self.assertEqual(self.state, worker2.decrypt_state(encryption))
+            # Keys of the window are cached
+            hkdf.assert_not_called()
+
+        # Beyond the window, the key id is rejected without deriving anything
+        now[0] += 40
+
+        with patch("src.key_ring.HKDF") as hkdf:
+            with self.assertRaises(ValueError) as e:
+                worker2.decrypt_state(encryption)
+
+            self.assertEqual("Cannot decrypt state", str(e.exception))
+            hkdf.assert_not_called()
+
+        other_secret = StateEncryptor(key_ring=TimeBucketKeyRing(b"o" * 32))
+
+        with self.assertRaises(ValueError):
+            other_secret.decrypt_state(worker1.encrypt_state(self.state))
+
+    def test_time_bucket_key_ring_needs_no_thread(self):
+        thread_count = threading.active_count()
+
+        encryptor = StateEncryptor(key_renewal_frequency=1, key_ring=TimeBucketKeyRing(b"m" * 32))
+        encryptor.start()
+
+        self.assertEqual(thread_count, threading.active_count())
+
+        encryption = encryptor.encrypt_state(self.state)
+        time.sleep(1.1)
+
+        self.assertNotEqual(encryption.partition(b".")[0], encryptor.encrypt_state(self.state).partition(b".")[0])
+        self.assertEqual(self.state, encryptor.decrypt_state(encryption))
+
+    def test_time_bucket_bad_master_secret(self):
+        with self.assertRaises(ValueError) as e:
+            TimeBucketKeyRing(b"short")
+
+        self.assertEqual("Master secret must be of at least 32 bytes", str(e.exception))
+
+        encryptor = StateEncryptor(key_ring=TimeBucketKeyRing(b"m" * 32))
+
+        for forged in [b"!!!!!!!!.token", b"AAAA.token", b".token"]:
+            with self.assertRaises(ValueError):
+                encryptor.decrypt_state(forged)
+
+    def test_shared_rings_need_file_locks(self):
+        with tempfile.TemporaryDirectory() as directory, patch("src.key_ring.fcntl", None):
+            with self.assertRaises(RuntimeError) as e:
+                SharedMemoryKeyRing(os.path.join(directory, "keys"))
+            self.assertEqual("SharedMemoryKeyRing needs fcntl file locks, which this platform lacks", str(e.exception))
+
+            with self.assertRaises(RuntimeError):
+                DirectoryKeyRing(directory)
+
+            # The rest of the package works without them
+            encryptor = StateEncryptor(key_ring=LocalKeyRing())
+            self.assertEqual({"a": 1}, encryptor.decrypt_state(encryptor.encrypt_state({"a": 1})))
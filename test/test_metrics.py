@@ -0,0 +1,138 @@
+import logging
+from unittest import TestCase
+from unittest.mock import Mock
+
+from src import metrics
+from src.authentication_validator import AuthenticationValidator
+from src.metrics import Histogram, MetricsRegistry, LoggingMetricsSink, NullMetricsSink
+from src.staller import Staller
+from src.state import StateEncryptor
+from src.util import validate_hashcash_zeros
+from src.validation_pipeline import ValidationPipeline, ValidationStage
+
+
+class TestHistogram(TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+
+        for value in range(1, 10001):
+            histogram.record(value)
+
+        self.assertEqual(10000, histogram.count)
+        self.assertEqual(1, histogram.min)
+        self.assertEqual(10000, histogram.max)
+        self.assertAlmostEqual(5000.5, histogram.mean())
+
+        for percentile in [50, 90, 99, 99.9]:
+            self.assertAlmostEqual(percentile * 100, histogram.percentile(percentile),
+                                   delta=percentile * 100 * 0.02)
+
+        self.assertEqual(1, histogram.percentile(0))
+        self.assertEqual(10000, histogram.percentile(100))
+
+    def test_empty(self):
+        self.assertEqual(0, Histogram().percentile(99))
+
+        with self.assertRaises(ValueError):
+            Histogram().percentile(101)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        metrics.set_sink(self.registry)
+        self.addCleanup(metrics.set_sink, None)
+
+    def test_disabled_by_default(self):
+        metrics.set_sink(None)
+
+        self.assertIsInstance(metrics.get_sink(), NullMetricsSink)
+        self.assertIs(metrics.timer("a"), metrics.timer("b"))
+
+        with metrics.timer("a"):
+            metrics.increment("b")
+
+        self.assertEqual(0, self.registry.counter("b"))
+
+    def test_instrumentation(self):
+        encryptor = StateEncryptor()
+        encryptor.decrypt_state(encryptor.encrypt_state({"a": 1}))
+
+        self.assertEqual(1, self.registry.histogram("state_encryption_seconds").count)
+        self.assertEqual(1, self.registry.histogram("state_decryption_seconds").count)
+
+        AuthenticationValidator.validate(request_details={}, headers={}, state_encryptor=Mock(spec=StateEncryptor),
+                                         configuration={})
+
+        self.assertEqual(1, self.registry.counter("validation_failures_total", stage="referrer"))
+        self.assertEqual(1, self.registry.histogram("validation_stage_seconds", stage="referrer").count)
+        self.assertIsNone(self.registry.histogram("validation_stage_seconds", stage="requested_with"))
+
+        class Stallable(Staller.Stallable):
+            def do_work(self):
+                self.result = True
+
+            def was_successful(self):
+                return True
+
+            def get_result(self):
+                return self.result
+
+            def interrupt(self):
+                pass
+
+        Staller(10, stall_if_successful=True).stall(Stallable())
+
+        self.assertLessEqual(0.01, self.registry.histogram("stall_seconds").min / 1000000)
+
+    def test_validation_errors(self):
+        def fail(context):
+            raise ValueError("bad input")
+
+        pipeline = ValidationPipeline([ValidationStage("broken", fail)])
+
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            passed, response = AuthenticationValidator.validate(request_details={}, headers={},
+                                                                state_encryptor=Mock(spec=StateEncryptor),
+                                                                configuration={}, pipeline=pipeline)
+
+        self.assertFalse(passed)
+        self.assertEqual("general", response["security_details"]["failure_stage"])
+        self.assertEqual(1, self.registry.counter("validation_errors_total", error="ValueError"))
+
+        # Clients trigger these at will: logged quietly, without a traceback
+        self.assertEqual([logging.DEBUG], [record.levelno for record in logs.records])
+        self.assertIsNone(logs.records[0].exc_info)
+
+    def test_hashcash_errors(self):
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            # noinspection PyTypeChecker
+            self.assertFalse(validate_hashcash_zeros("not bytes", 1))
+            # noinspection PyTypeChecker
+            self.assertFalse(validate_hashcash_zeros(b"stamp", None))
+
+        self.assertEqual(2, self.registry.counter("hashcash_errors_total"))
+        self.assertEqual([logging.DEBUG] * 2, [record.levelno for record in logs.records])
+
+    def test_exposition(self):
+        metrics.increment("failures_total", stage="hash\"cash")
+        metrics.increment("failures_total", 2, stage="csrf")
+        metrics.observe("stage_seconds", 0.5, stage="csrf")
+
+        self.assertEqual('# TYPE failures_total counter\n'
+                         'failures_total{stage="csrf"} 2\n'
+                         'failures_total{stage="hash\\"cash"} 1\n'
+                         '# TYPE stage_seconds summary\n'
+                         'stage_seconds{stage="csrf",quantile="0.5"} 0.5\n'
+                         'stage_seconds{stage="csrf",quantile="0.9"} 0.5\n'
+                         'stage_seconds{stage="csrf",quantile="0.99"} 0.5\n'
+                         'stage_seconds_sum{stage="csrf"} 0.5\n'
+                         'stage_seconds_count{stage="csrf"} 1\n', self.registry.exposition())
+
+    def test_logging_sink(self):
+        metrics.set_sink(LoggingMetricsSink(level=logging.INFO))
+
+        with self.assertLogs("src.metrics", logging.INFO) as logs:
+            metrics.increment("failures_total", stage="csrf")
+
+        self.assertEqual(['INFO:src.metrics:failures_total{stage="csrf"} += 1'], logs.output)
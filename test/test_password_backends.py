@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.password_backends import SqlitePasswordRepository, MemoryMappedPasswordRepository
+from src.password_hashing import ScryptHasher
+
+
+def _validate_in_other_process(path: str, results: multiprocessing.Queue):
+    results.put(MemoryMappedPasswordRepository(path, "username_salt").validate_password("Joe", "joe12#$m"))
+
+
+class TestPasswordBackends(TestCase):
+    def check_repository(self, repository):
+        self.assertEqual((False, "Not found"), repository.validate_password("Joe", "joe12#$m"))
+
+        repository.save_password("Joe", "joe12#$m")
+
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+        self.assertEqual((False, "No match"), repository.validate_password("Joe", "password"))
+
+        # Saving again replaces the password
+        repository.save_password("Joe", "password")
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "password"))
+
+        self.assertEqual(100, repository.save_passwords((f"user{i}", f"password{i}") for i in range(100)))
+
+        for i in range(100):
+            self.assertEqual((True, "Match"), repository.validate_password(f"user{i}", f"password{i}"))
+
+        with self.assertRaises(ValueError):
+            repository.save_passwords([("user1000", "password"), ("x", "password")])
+
+        # Nothing of a failing batch is saved
+        self.assertEqual((False, "Not found"), repository.validate_password("user1000", "password"))
+
+    def test_sqlite(self):
+        path = tempfile.mkdtemp() + "/passwords.db"
+        repository = SqlitePasswordRepository(path, "username_salt", pool_size=4)
+
+        self.check_repository(repository)
+
+        with repository._connection() as connection:
+            self.assertEqual("wal", connection.execute("PRAGMA journal_mode").fetchone()[0])
+
+        # Connections are shared between threads, up to the pool size
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(repository.validate_password("Joe", "password")))
+                   for _ in range(16)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([(True, "Match")] * 16, results)
+
+        repository.close()
+
+        self.assertEqual((True, "Match"), SqlitePasswordRepository(path, "username_salt").validate_password(
+            "Joe", "password"))
+
+    def test_sqlite_in_memory(self):
+        self.check_repository(SqlitePasswordRepository(":memory:", "username_salt"))
+
+        with self.assertRaises(ValueError):
+            SqlitePasswordRepository(":memory:", "username_salt", table="passwords; DROP TABLE x")
+
+    def test_sqlite_failed_commit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/passwords.db"
+
+            # A deferred constraint fails the batch at COMMIT rather than at the inserts
+            connection = sqlite3.connect(path)
+            connection.executescript("CREATE TABLE owners (name TEXT PRIMARY KEY);"
+                                     "CREATE TABLE passwords (username TEXT PRIMARY KEY, password TEXT NOT NULL "
+                                     "REFERENCES owners (name) DEFERRABLE INITIALLY DEFERRED) WITHOUT ROWID;")
+            connection.close()
+
+            repository = SqlitePasswordRepository(path, "username_salt", pool_size=1)
+
+            with repository._connection() as connection:
+                connection.execute("PRAGMA foreign_keys=ON")
+
+            with self.assertRaises(sqlite3.IntegrityError):
+                repository.save_passwords([("Joe", "password")])
+
+            # The connection went back to the pool without the transaction
+            with repository._connection() as connection:
+                self.assertFalse(connection.in_transaction)
+
+            self.assertEqual((False, "Not found"), repository.validate_password("Joe", "password"))
+
+            repository.close()
+
+    def test_memory_mapped(self):
+        path = tempfile.mkdtemp() + "/passwords.table"
+        repository = MemoryMappedPasswordRepository(path, "username_salt", capacity=200)
+
+        self.check_repository(repository)
+
+        self.assertEqual(101, len(repository))
+        self.assertEqual(512, repository.slot_count)
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+        # Another process maps the same table
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_validate_in_other_process, args=(path, results))
+        process.start()
+        self.assertEqual((False, "No match"), results.get(timeout=10))
+        process.join()
+
+        repository.close()
+
+        reopened = MemoryMappedPasswordRepository(path, "username_salt", capacity=1)
+        self.assertEqual(512, reopened.slot_count)
+        self.assertEqual((True, "Match"), reopened.validate_password("Joe", "password"))
+
+    def test_memory_mapped_limits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_memory_mapped_limits(directory)
+
+    def check_memory_mapped_limits(self, directory: str):
+        # The default capacity keeps the file small
+        repository = MemoryMappedPasswordRepository(directory + "/default", "username_salt")
+        self.assertLess(os.path.getsize(directory + "/default"), 4 * 1024 * 1024)
+        repository.close()
+
+        repository = MemoryMappedPasswordRepository(directory + "/small", "username_salt", capacity=3)
+        repository.save_passwords([("user1", "password"), ("user2", "password"), ("user3", "password")])
+
+        with self.assertRaises(RuntimeError):
+            repository.save_password("user4", "password")
+
+        repository = MemoryMappedPasswordRepository(directory + "/short", "username_salt", value_size=64,
+                                                    hasher=ScryptHasher(n=2 ** 8))
+
+        with self.assertRaises(ValueError):
+            repository.save_password("user1", "password")
+
+        with open(directory + "/other", "wb") as f:
+            f.write(b"something else entirely")
+
+        with self.assertRaises(ValueError):
+            MemoryMappedPasswordRepository(directory + "/other", "username_salt")
+
+        with patch("src.password_backends.fcntl", None), self.assertRaises(RuntimeError):
+            MemoryMappedPasswordRepository(directory + "/unlocked", "username_salt")
+
+    def test_memory_mapped_recovers_abandoned_write(self):
+        path = tempfile.mkdtemp() + "/passwords.table"
+        repository = MemoryMappedPasswordRepository(path, "username_salt", capacity=10)
+        repository.save_password("Joe", "password")
+
+        # A writer died mid-write, leaving an odd generation behind
+        with open(path, "r+b") as f:
+            f.seek(12)
+            generation, = struct.unpack(">Q", f.read(8))
+            f.seek(12)
+            f.write(struct.pack(">Q", generation + 1))
+
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "password"))
@@ -0,0 +1,204 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from src.password_backends import SqlitePasswordRepository, MemoryMappedPasswordRepository
+from src.password_cache import LookupCache, CachedPasswordRepository
+from test.test_password_repository import InMemoryPasswordRepository
+
+
+class CountingRepository(InMemoryPasswordRepository):
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+
+    def _load_password(self, username: str) -> str:
+        self.loads += 1
+        return super()._load_password(username)
+
+
+class PausingRepository(InMemoryPasswordRepository):
+    """Pauses listing usernames or saving passwords, until told to proceed"""
+    def __init__(self):
+        super().__init__()
+        self.pause_listing = False
+        self.pause_saving = False
+        self.paused = threading.Event()
+        self.proceed = threading.Event()
+
+    def _iterate_usernames(self):
+        usernames = list(self.database)
+
+        if self.pause_listing:
+            self.paused.set()
+            self.proceed.wait(5)
+
+        yield from usernames
+
+    def _save_password(self, username: str, password: str):
+        if self.pause_saving:
+            self.paused.set()
+            self.proceed.wait(5)
+
+        super()._save_password(username, password)
+
+
+class TestLookupCache(TestCase):
+    def test_enforcement_of_parameters(self):
+        with self.assertRaises(ValueError):
+            LookupCache(capacity=0)
+
+        with self.assertRaises(ValueError):
+            LookupCache(time_to_live=0)
+
+    def test_least_recently_used_eviction(self):
+        cache = LookupCache(capacity=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+
+        self.assertEqual("1", cache.get("a"))
+
+        cache.put("c", "3")
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("1", cache.get("a"))
+        self.assertEqual("3", cache.get("c"))
+
+    def test_expiry(self):
+        cache = LookupCache(time_to_live=0.05)
+        cache.put("a", "1")
+        self.assertEqual("1", cache.get("a"))
+
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_invalidation(self):
+        cache = LookupCache()
+        cache.put("a", "1")
+        cache.put("b", "2")
+
+        cache.invalidate("a")
+        cache.invalidate("missing")
+        self.assertIsNone(cache.get("a"))
+
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+
+class TestCachedPasswordRepository(TestCase):
+    def test_unknown_usernames_skip_the_backend(self):
+        backend = CountingRepository()
+        repository = CachedPasswordRepository(backend, expected_users=1000)
+
+        for i in range(100):
+            self.assertEqual((False, "Not found"), repository.validate_password(f"unknown{i}", "password"))
+
+        # Only false positives of the filter reach the backend
+        self.assertLess(backend.loads, 5)
+        self.assertEqual(100 - backend.loads, repository.filtered)
+
+    def test_positive_lookups_are_cached(self):
+        backend = CountingRepository()
+        repository = CachedPasswordRepository(backend, expected_users=1000)
+        repository.save_password("Joe", "joe12#$m")
+
+        for _ in range(10):
+            self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+        self.assertEqual((False, "No match"), repository.validate_password("Joe", "password"))
+        self.assertEqual(1, backend.loads)
+
+        # Saving through the repository invalidates the cached password
+        repository.save_password("Joe", "password")
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "password"))
+        self.assertEqual((False, "No match"), repository.validate_password("Joe", "joe12#$m"))
+        self.assertEqual(2, backend.loads)
+
+    def test_filter_is_built_and_rebuilt_from_the_backend(self):
+        backend = InMemoryPasswordRepository()
+        backend.save_password("Joe", "joe12#$m")
+
+        repository = CachedPasswordRepository(backend, expected_users=1000)
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+        # Saved behind the repository's back: unseen until the filter is rebuilt
+        backend.save_password("Jane", "jane12#$m")
+        self.assertEqual((False, "Not found"), repository.validate_password("Jane", "jane12#$m"))
+
+        repository.rebuild_filter()
+        self.assertEqual((True, "Match"), repository.validate_password("Jane", "jane12#$m"))
+
+    def test_saves_during_a_rebuild_are_kept(self):
+        backend = PausingRepository()
+        repository = CachedPasswordRepository(backend, expected_users=1000)
+
+        # Saved once the listing of the rebuild went by
+        backend.pause_listing = True
+        rebuild = threading.Thread(target=repository.rebuild_filter)
+        rebuild.start()
+        self.assertTrue(backend.paused.wait(5))
+
+        repository.save_password("Jane", "jane12#$m")
+
+        backend.proceed.set()
+        rebuild.join()
+
+        self.assertEqual((True, "Match"), repository.validate_password("Jane", "jane12#$m"))
+
+    def test_saves_in_progress_during_a_rebuild_are_kept(self):
+        backend = PausingRepository()
+        repository = CachedPasswordRepository(backend, expected_users=1000)
+
+        # Saved before the rebuild started, but reaching the backend after it listed the usernames
+        backend.pause_saving = True
+        save = threading.Thread(target=repository.save_password, args=("Jane", "jane12#$m"))
+        save.start()
+        self.assertTrue(backend.paused.wait(5))
+
+        repository.rebuild_filter()
+
+        backend.proceed.set()
+        save.join()
+
+        self.assertEqual((True, "Match"), repository.validate_password("Jane", "jane12#$m"))
+
+    def test_stale_cache_entries_expire(self):
+        backend = InMemoryPasswordRepository()
+        repository = CachedPasswordRepository(backend, expected_users=1000,
+                                              lookup_cache=LookupCache(time_to_live=0.05))
+        repository.save_password("Joe", "joe12#$m")
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+        backend.save_password("Joe", "password")
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+        time.sleep(0.1)
+
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "password"))
+
+    def test_batches_and_backends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backends = [SqlitePasswordRepository(os.path.join(directory, "passwords.db"), "username_salt"),
+                        MemoryMappedPasswordRepository(os.path.join(directory, "passwords.table"),
+                                                       "username_salt", capacity=1000)]
+
+            for backend in backends:
+                backend.save_password("Joe", "joe12#$m")
+
+                repository = CachedPasswordRepository(backend, expected_users=1000)
+                self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+                self.assertEqual(100, repository.save_passwords((f"user{i}", f"password{i}") for i in range(100)))
+
+                for i in range(100):
+                    self.assertEqual((True, "Match"), repository.validate_password(f"user{i}", f"password{i}"))
+
+                self.assertEqual((False, "Not found"), repository.validate_password("Jane", "jane12#$m"))
+
+                backend.close()
@@ -0,0 +1,122 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.password_hashing import ScryptHasher, Pbkdf2Hasher, LegacySha256Hasher, HashingPool, identify_hasher, \
+    verify_password
+from src.staller import PoolSaturatedError
+from test.test_password_repository import InMemoryPasswordRepository
+
+HASHED_USERNAME = "6226b64239e3b4131985f643f51123e123c8acc1cc692af8d296272b3edb0519"
+
+
+class TestPasswordHashing(TestCase):
+    def test_hashers(self):
+        for hasher in [ScryptHasher(n=2 ** 8), Pbkdf2Hasher(iterations=1000), LegacySha256Hasher()]:
+            encoded = hasher.hash("password", HASHED_USERNAME)
+
+            self.assertTrue(hasher.identifies(encoded))
+            self.assertFalse(hasher.needs_rehash(encoded))
+
+            self.assertTrue(verify_password("password", encoded, HASHED_USERNAME))
+            self.assertFalse(verify_password("passwort", encoded, HASHED_USERNAME))
+
+    def test_encoding(self):
+        encoded = ScryptHasher(n=2 ** 8, r=4, p=2).hash("password", HASHED_USERNAME)
+
+        self.assertTrue(encoded.startswith("$scrypt$n=256,r=4,p=2$"))
+
+        # Random salts: the same password hashes differently every time
+        self.assertNotEqual(encoded, ScryptHasher(n=2 ** 8, r=4, p=2).hash("password", HASHED_USERNAME))
+
+        self.assertEqual("104d46c2c55d53459a01056b25597247ed2f572ff16f63dcbdb508ebbb7164ae",
+                         LegacySha256Hasher().hash("password", HASHED_USERNAME))
+
+    def test_needs_rehash(self):
+        weak = Pbkdf2Hasher(iterations=1000).hash("password", HASHED_USERNAME)
+
+        self.assertTrue(Pbkdf2Hasher(iterations=2000).needs_rehash(weak))
+        self.assertTrue(ScryptHasher().needs_rehash(weak))
+        self.assertTrue(ScryptHasher().needs_rehash(LegacySha256Hasher().hash("password", HASHED_USERNAME)))
+        self.assertTrue(LegacySha256Hasher().needs_rehash(weak))
+
+    def test_bad_encodings(self):
+        for encoded in ["$md5$x$y$z", "$scrypt$n=256$", "$scrypt$n=x,r=1,p=1$AAAA$AAAA", "$pbkdf2-sha256$i=1$!$!",
+                        # Missing or unknown parameters, and costs beyond what scrypt can be given
+                        "$scrypt$n=256$AAAA$AAAA", "$scrypt$n=256,r=8,p=1,x=1$AAAA$AAAA", "$pbkdf2-sha256$$AAAA$AAAA",
+                        "$scrypt$n=4194304,r=8,p=1$AAAA$AAAA", "$scrypt$n=1,r=8,p=1$AAAA$AAAA", "not hex"]:
+            with self.assertRaises(ValueError):
+                verify_password("password", encoded, HASHED_USERNAME)
+
+        with self.assertRaises(ValueError):
+            ScryptHasher(n=1000)
+
+        with self.assertRaises(ValueError):
+            ScryptHasher(n=2 ** 21)
+
+    def test_scrypt_memory_limit(self):
+        self.assertEqual(16 * 1024 * 1024 + 1024, ScryptHasher.memory(2 ** 14, 8, 1))
+
+        # n = 2 ** 20 needs 1GiB: twice that would exceed what OpenSSL accepts as maxmem
+        with patch("hashlib.scrypt", return_value=bytes(32)) as scrypt:
+            ScryptHasher(n=2 ** 20).hash("password", HASHED_USERNAME)
+
+        self.assertEqual(2 ** 31 - 1, scrypt.call_args[1]["maxmem"])
+
+    def test_identify_hasher(self):
+        self.assertIsInstance(identify_hasher("abcdef"), LegacySha256Hasher)
+        self.assertIsInstance(identify_hasher("$scrypt$n=256,r=8,p=1$AAAA$AAAA"), ScryptHasher)
+        self.assertIsInstance(identify_hasher("$pbkdf2-sha256$i=10$AAAA$AAAA"), Pbkdf2Hasher)
+
+    def test_rehash_on_login(self):
+        repository = InMemoryPasswordRepository()
+        repository.save_password("Joe", "joe12#$m")
+
+        legacy_hash = next(iter(repository.database.values()))
+        self.assertTrue(LegacySha256Hasher().identifies(legacy_hash))
+
+        repository.hasher = ScryptHasher(n=2 ** 8)
+
+        # A failed login leaves the hash alone
+        self.assertEqual((False, "No match"), repository.validate_password("Joe", "password"))
+        self.assertEqual(legacy_hash, next(iter(repository.database.values())))
+
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+
+        upgraded_hash = next(iter(repository.database.values()))
+        self.assertTrue(upgraded_hash.startswith("$scrypt$"))
+
+        self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+        self.assertEqual(upgraded_hash, next(iter(repository.database.values())))
+
+    def test_hashing_pool(self):
+        with HashingPool(max_workers=2) as pool:
+            repository = InMemoryPasswordRepository()
+            repository.hasher = ScryptHasher(n=2 ** 8)
+            repository.hashing_pool = pool
+
+            repository.save_password("Joe", "joe12#$m")
+
+            self.assertEqual((True, "Match"), repository.validate_password("Joe", "joe12#$m"))
+            self.assertEqual((False, "No match"), repository.validate_password("Joe", "password"))
+
+    def test_hashing_pool_saturation(self):
+        release = threading.Event()
+
+        with ThreadPoolExecutor(4) as executor:
+            pool = HashingPool(max_workers=1, max_concurrency=1, wait_timeout=0.1, executor=executor)
+
+            blocked = executor.submit(pool.run, release.wait)
+
+            with self.assertRaises(PoolSaturatedError):
+                # The wait makes sure the first run got admitted
+                release.wait(0.1)
+                pool.run(len, "abc")
+
+            self.assertEqual(1, pool.rejected)
+
+            release.set()
+            blocked.result()
+
+            self.assertEqual(3, pool.run(len, "abc"))
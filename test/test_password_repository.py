@@ -1,12 +1,15 @@
-from typing import Dict
+from typing import Dict, Iterator, List
 from unittest import TestCase
+from unittest.mock import patch
 
+from src.password_hashing import Pbkdf2Hasher, PasswordHasher, ScryptHasher, identify_hasher, verify_password
 from src.password_repository import PasswordRepository
 
 
 class InMemoryPasswordRepository(PasswordRepository):
-    def __init__(self, initial_setup: Dict[str, str] = None, username_hash_salt: str = "username_salt"):
-        super().__init__(username_hash_salt)
+    def __init__(self, initial_setup: Dict[str, str] = None, username_hash_salt: str = "username_salt",
+                 hasher: PasswordHasher = None):
+        super().__init__(username_hash_salt, hasher)
         self.database: Dict[str, str] = initial_setup or {}
 
     def _save_password(self, username: str, password: str):
@@ -15,6 +18,9 @@ class InMemoryPasswordRepository(PasswordRepository):
     def _load_password(self, username: str) -> str:
         return self.database.get(username)
 
+    def _iterate_usernames(self) -> Iterator[str]:
+        return iter(list(self.database))
+
 
 class TestPasswordRepository(TestCase):
     def test_enforcement_of_secured_config(self):
@@ -98,3 +104,44 @@ class TestPasswordRepository(TestCase):
         repository2.save_password("Joe", "joe12#$m")
 
         self.assertEqual((True, "Match"), repository2.validate_password("Joe", "joe12#$m"))
+
+    def check_verification_work(self, repository: PasswordRepository, usernames: List[str]):
+        def full_cost_verifications(username: str) -> int:
+            with patch("src.password_repository.verify_password", wraps=verify_password) as verify:
+                repository.validate_password(username, "password")
+
+            # Hashes the configured hasher wouldn't rehash cost what it costs to verify
+            return sum(not repository.hasher.needs_rehash(args[1]) for args, _ in verify.call_args_list)
+
+        # An unknown user is verified against a dummy hash: as much work as for a known one
+        self.assertEqual([1] * len(usernames), [full_cost_verifications(username) for username in usernames])
+
+    def test_timing_does_not_reveal_usernames(self):
+        repository = InMemoryPasswordRepository(hasher=Pbkdf2Hasher(iterations=1000))
+        repository.save_password("Joe", "joe12#$m")
+
+        self.check_verification_work(repository, ["Joe", "Moses"])
+
+    def test_timing_with_legacy_hashes(self):
+        repository = InMemoryPasswordRepository()
+        repository.save_password("Joe", "joe12#$m")
+        repository.save_password("Jane", "jane12#$m")
+
+        # Mid-migration: a legacy hash is much cheaper to verify than the configured one
+        repository.hasher = ScryptHasher(n=2 ** 8)
+        self.assertEqual((True, "Match"), repository.validate_password("Jane", "jane12#$m"))
+
+        self.check_verification_work(repository, ["Joe", "Jane", "Moses"])
+        self.assertEqual(["LegacySha256Hasher", "ScryptHasher"],
+                         sorted(type(identify_hasher(encoded)).__name__ for encoded in repository.database.values()))
+
+    def test_dummy_hash_is_made_with_the_hasher(self):
+        repository = InMemoryPasswordRepository()
+        hasher = Pbkdf2Hasher(iterations=1000)
+        repository.hasher = hasher
+
+        # The first unknown username costs no more than the next ones
+        with patch.object(hasher, "hash", wraps=hasher.hash) as hash_password:
+            self.assertEqual((False, "Not found"), repository.validate_password("Moses", "password"))
+
+        hash_password.assert_not_called()
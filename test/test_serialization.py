@@ -0,0 +1,87 @@
+import pickle
+from unittest import TestCase
+
+from src.serialization import CompactStateSerializer, JsonStateSerializer, PickleStateSerializer, \
+    MsgpackStateSerializer, msgpack
+from src.state import StateEncryptor
+
+
+class TestSerialization(TestCase):
+    state = {
+        "server_time": "20200730-153527",
+        "captcha_solutions": ["baby", "babies"],
+        "csrf_token": "the_csrf_token",
+        "hashcash": {
+            "server_string": "the_server_string",
+            "zero_count": 20
+        }
+    }
+
+    def test_compact_round_trip(self):
+        serializer = CompactStateSerializer()
+        serialization = serializer.serialize(self.state)
+
+        self.assertEqual(1, serialization[0])
+        self.assertEqual(self.state, serializer.deserialize(serialization))
+        self.assertLess(len(serialization), len(JsonStateSerializer().serialize(self.state)))
+        self.assertLess(len(serialization), len(pickle.dumps(self.state)))
+
+    def test_fallback_for_other_states(self):
+        serializer = CompactStateSerializer()
+
+        for state in [{"hello": 2, "world": True}, [1, 2, 3], "string",
+                      dict(self.state, server_time="not a timestamp"),
+                      dict(self.state, captcha_solutions=["baby", 3]),
+                      dict(self.state, hashcash={"server_string": "s", "zero_count": "20"}),
+                      dict(self.state, extra=1)]:
+            serialization = serializer.serialize(state)
+
+            self.assertEqual(2, serialization[0])
+            self.assertEqual(state, serializer.deserialize(serialization))
+
+    def test_bad_serializations(self):
+        serializer = CompactStateSerializer()
+
+        with self.assertRaises(ValueError) as e:
+            serializer.deserialize(b"")
+        self.assertEqual("Empty state", str(e.exception))
+
+        # Pickle is never accepted unless explicitly configured
+        with self.assertRaises(ValueError) as e:
+            serializer.deserialize(PickleStateSerializer().serialize(self.state))
+        self.assertEqual("Unknown state format", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            serializer.deserialize(serializer.serialize(self.state)[:-3])
+        self.assertEqual("Truncated state", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            CompactStateSerializer(CompactStateSerializer())
+        self.assertEqual("Fallback serializer must use another format", str(e.exception))
+
+    def test_pickle_fallback(self):
+        serializer = CompactStateSerializer(PickleStateSerializer())
+        state = {"a set": {1, 2}}
+
+        self.assertEqual(state, serializer.deserialize(serializer.serialize(state)))
+
+    def test_msgpack_fallback(self):
+        if msgpack is None:
+            with self.assertRaises(RuntimeError):
+                MsgpackStateSerializer()
+            return
+
+        serializer = CompactStateSerializer(MsgpackStateSerializer())
+        state = {"hello": 2, "world": True}
+
+        self.assertEqual(state, serializer.deserialize(serializer.serialize(state)))
+
+    def test_encryptor_serializers(self):
+        for serializer in [None, JsonStateSerializer(), PickleStateSerializer()]:
+            state_encryptor = StateEncryptor(serializer=serializer)
+            self.assertEqual(self.state, state_encryptor.decrypt_state(state_encryptor.encrypt_state(self.state)))
+
+        compact_token = StateEncryptor().encrypt_state(self.state)
+        pickle_token = StateEncryptor(serializer=PickleStateSerializer()).encrypt_state(self.state)
+
+        self.assertLess(len(compact_token), len(pickle_token))
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from src.spent_stamps import InMemorySpentStampStore, BloomSpentStampStore
+
+
+class TestSpentStampStore(TestCase):
+    def check_replays(self, store):
+        self.assertTrue(store.spend(b"stamp1", now=1000))
+        self.assertTrue(store.spend(b"stamp2", now=1000))
+        self.assertFalse(store.spend(b"stamp1", now=1001))
+
+        # Still remembered up to the time to live
+        self.assertFalse(store.spend(b"stamp1", now=1060))
+        self.assertFalse(store.spend(b"stamp2", now=1059))
+
+        # Forgotten after twice the time to live at the latest
+        self.assertTrue(store.spend(b"stamp1", now=1121))
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            InMemorySpentStampStore(0)
+        self.assertEqual("Bad time_to_live", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            InMemorySpentStampStore(60, bucket_count=0)
+        self.assertEqual("Bad bucket_count", str(e.exception))
+
+    def test_in_memory_store(self):
+        self.check_replays(InMemorySpentStampStore(60))
+
+    def test_in_memory_store_drops_old_buckets(self):
+        store = InMemorySpentStampStore(60, bucket_count=4)
+
+        for index in range(100):
+            store.spend(b"stamp %d" % index, now=1000)
+
+        self.assertEqual(100, len(store))
+
+        store.spend(b"late stamp", now=1100)
+        self.assertEqual(1, len(store))
+
+    def test_bloom_store(self):
+        self.check_replays(BloomSpentStampStore(60, capacity=1000))
+
+    def test_bloom_store_is_bounded(self):
+        store = BloomSpentStampStore(60, capacity=1000, false_positive_rate=0.01)
+        size = store.size_in_bytes
+
+        for index in range(5000):
+            store.spend(b"stamp %d" % index, now=1000 + index / 10)
+
+        self.assertEqual(size, store.size_in_bytes)
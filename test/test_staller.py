@@ -1,8 +1,10 @@
+import asyncio
+import threading
 import time
 from typing import Any, Tuple, Dict
 from unittest import TestCase
 
-from src.staller import Staller, T
+from src.staller import Staller, AsyncStaller, StallerPool, PoolSaturatedError, StallScheduler
 
 
 class TestStaller(TestCase):
@@ -121,3 +123,291 @@ class TestStaller(TestCase):
         self.assertEqual(8, stallable.result)
         self.assertEqual((1, True), stallable.args)
         self.assertEqual({'pi': 3.4}, stallable.kwargs)
+
+    def test_pool_bad_parameters(self):
+        with self.assertRaises(ValueError) as e:
+            StallerPool(size=0)
+        self.assertEqual("Bad size", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            StallerPool(queue_depth=0)
+        self.assertEqual("Bad queue_depth", str(e.exception))
+
+        with self.assertRaises(ValueError) as e:
+            StallerPool(on_saturation="drop")
+        self.assertEqual("Bad on_saturation", str(e.exception))
+
+    def test_stall_on_pool(self):
+        pool = StallerPool(size=2, queue_depth=2)
+        thread_count = threading.active_count()
+
+        try:
+            stallable = self.TestStallable(400, success=False)
+
+            start_time = time.time()
+            self.assertEqual((False, 8), Staller(1000, pool=pool).stall(stallable, 1, True, pi=3.4))
+            elapsed: int = int((time.time() - start_time) * 1000)
+
+            self.assertTrue(1000 <= elapsed < 1100)
+            self.assertEqual((1, True), stallable.args)
+            self.assertEqual({'pi': 3.4}, stallable.kwargs)
+
+            # No thread was created for the stall
+            self.assertEqual(thread_count, threading.active_count())
+            self.assertEqual(1, pool.completed)
+
+        finally:
+            pool.shutdown()
+
+    def test_cut_on_pool(self):
+        pool = StallerPool(size=1, queue_depth=1)
+
+        try:
+            stallable = self.TestStallable(1000, success=True)
+
+            self.assertEqual((False, None), Staller(400, pool=pool).stall(stallable))
+            self.assertTrue(stallable.interrupted)
+            self.assertEqual(1, pool.abandoned)
+
+        finally:
+            pool.shutdown()
+
+    def test_pool_rejects_when_saturated(self):
+        pool = StallerPool(size=1, queue_depth=1)
+        staller = Staller(300, pool=pool)
+
+        try:
+            blocking = [self.TestStallable(1000, success=True) for _ in range(2)]
+
+            # The first occupies the worker, the second waits in the queue
+            pool.submit(blocking[0].do_work)
+            time.sleep(0.1)
+            pool.submit(blocking[1].do_work)
+
+            time.sleep(0.1)
+            self.assertEqual(1, pool.active)
+            self.assertEqual(1, pool.queued)
+
+            with self.assertRaises(PoolSaturatedError):
+                staller.stall(self.TestStallable(0, success=True))
+
+            self.assertEqual(1, pool.rejected)
+
+            for stallable in blocking:
+                stallable.interrupt()
+
+        finally:
+            pool.shutdown()
+
+    def test_pool_waits_when_saturated(self):
+        pool = StallerPool(size=1, queue_depth=1, on_saturation=StallerPool.WAIT, wait_timeout=2)
+        staller = Staller(1000, pool=pool)
+
+        try:
+            pool.submit(time.sleep, 0.2)
+            time.sleep(0.1)
+            pool.submit(time.sleep, 0.2)
+
+            self.assertEqual((True, 8), staller.stall(self.TestStallable(0, success=True)))
+            self.assertEqual(0, pool.rejected)
+
+        finally:
+            pool.shutdown()
+
+    def test_waiting_for_the_pool_counts_against_the_unit_time(self):
+        pool = StallerPool(size=1, queue_depth=1, on_saturation=StallerPool.WAIT, wait_timeout=2)
+        staller = Staller(300, pool=pool)
+
+        try:
+            pool.submit(time.sleep, 0.6)
+            time.sleep(0.1)
+            pool.submit(time.sleep, 0.6)
+
+            stallable = self.TestStallable(0, success=True)
+            start_time = time.time()
+
+            # Room only frees up after the unit time, which leaves nothing to wait for the work
+            self.assertEqual((False, None), staller.stall(stallable))
+            self.assertLess(time.time() - start_time, 0.7)
+            self.assertTrue(stallable.interrupted)
+            self.assertEqual(1, pool.abandoned)
+
+        finally:
+            pool.shutdown()
+
+    def test_abandoned_queued_work_never_runs(self):
+        pool = StallerPool(size=1, queue_depth=2)
+
+        try:
+            pool.submit(time.sleep, 0.3)
+            stallable = self.TestStallable(0, success=True)
+
+            # The work waits in the queue beyond the unit time, so it is abandoned before it starts
+            self.assertEqual((False, None), Staller(100, pool=pool).stall(stallable))
+
+            time.sleep(0.4)
+            self.assertEqual(0, stallable.result)
+            self.assertEqual(1, pool.abandoned)
+
+        finally:
+            pool.shutdown()
+
+    def test_stall_later(self):
+        scheduler = StallScheduler()
+
+        try:
+            staller = Staller(1000, scheduler=scheduler)
+            stallable = self.TestStallable(400, success=False)
+
+            start_time = time.time()
+            future = staller.stall_later(stallable, 1, True, pi=3.4)
+
+            elapsed: int = int((time.time() - start_time) * 1000)
+            # Only the work itself blocked the caller
+            self.assertTrue(400 <= elapsed < 500)
+            self.assertFalse(future.done())
+
+            self.assertEqual((False, 8), future.result(timeout=2))
+
+            elapsed = int((time.time() - start_time) * 1000)
+            self.assertTrue(1000 <= elapsed < 1100)
+
+            # Successful work is released right away
+            future = staller.stall_later(self.TestStallable(0, success=True))
+            self.assertTrue(future.done())
+            self.assertEqual((True, 8), future.result())
+
+        finally:
+            scheduler.stop()
+
+    def test_stall_later_cut_on_delay(self):
+        future = Staller(400).stall_later(self.TestStallable(1000, success=True))
+
+        self.assertEqual((False, None), future.result(timeout=0))
+
+    def test_scheduler_orders_releases(self):
+        scheduler = StallScheduler()
+        thread_count = threading.active_count()
+
+        try:
+            released = []
+            futures = []
+
+            for delay in [300, 100, 200] * 300:
+                future = scheduler.release_later(delay, delay)
+                future.add_done_callback(lambda f: released.append(f.result()))
+                futures.append(future)
+
+            # A single thread waits for all of them
+            self.assertEqual(thread_count + 1, threading.active_count())
+            self.assertEqual(900, len(scheduler))
+
+            for future in futures:
+                future.result(timeout=2)
+
+            self.assertEqual([100] * 300 + [200] * 300 + [300] * 300, released)
+
+        finally:
+            scheduler.stop()
+
+    def test_scheduler_stop_releases_pending(self):
+        scheduler = StallScheduler()
+        future = scheduler.release_later(10000, "value")
+
+        scheduler.stop()
+
+        self.assertEqual("value", future.result(timeout=0))
+
+        with self.assertRaises(RuntimeError):
+            scheduler.release_later(100, "value")
+
+
+class TestAsyncStaller(TestCase):
+    class TestStallable(AsyncStaller.Stallable):
+        def __init__(self, sleep_time: int, success: bool):
+            self.args: Tuple[Any, ...] = ()
+            self.kwargs: Dict[str, Any] = {}
+            self.sleep_time: int = sleep_time
+            self.result: int = 0
+            self.interrupted = False
+            self.success = success
+
+        async def do_work(self, *args, **kwargs) -> None:
+            self.args = args
+            self.kwargs = kwargs
+
+            await asyncio.sleep(self.sleep_time/1000)
+
+            self.result = 8
+
+        def get_result(self) -> int:
+            return self.result
+
+        def interrupt(self):
+            self.interrupted = True
+
+        def was_successful(self) -> bool:
+            return self.success
+
+    def timed_stall(self, staller, stallable) -> Tuple[int, Tuple[bool, int]]:
+        start_time = time.time()
+
+        outcome = asyncio.run(staller.stall(stallable, 1, True, pi=3.4))
+
+        return int((time.time() - start_time) * 1000), outcome
+
+    def test_stall_on_success(self):
+        stallable = self.TestStallable(400, success=True)
+
+        elapsed, outcome = self.timed_stall(AsyncStaller(1000), stallable)
+
+        self.assertTrue(400 <= elapsed < 500)
+        self.assertEqual((True, 8), outcome)
+        self.assertEqual((1, True), stallable.args)
+        self.assertEqual({'pi': 3.4}, stallable.kwargs)
+
+    def test_stall_on_failure(self):
+        stallable = self.TestStallable(400, success=False)
+
+        elapsed, outcome = self.timed_stall(AsyncStaller(1000), stallable)
+
+        self.assertTrue(1000 <= elapsed < 1100)
+        self.assertEqual((False, 8), outcome)
+
+    def test_cut_on_delay(self):
+        stallable = self.TestStallable(1000, success=True)
+
+        elapsed, outcome = self.timed_stall(AsyncStaller(400), stallable)
+
+        self.assertTrue(400 <= elapsed < 500)
+        self.assertEqual((False, None), outcome)
+        self.assertTrue(stallable.interrupted)
+
+    def test_blocking_stallable(self):
+        stallable = TestStaller.TestStallable(1000, success=True)
+
+        elapsed, outcome = self.timed_stall(AsyncStaller(400), stallable)
+
+        self.assertTrue(400 <= elapsed < 500)
+        self.assertEqual((False, None), outcome)
+        self.assertEqual((1, True), stallable.args)
+
+    def test_concurrent_stalls_hold_no_threads(self):
+        staller = AsyncStaller(500)
+        thread_count = threading.active_count()
+
+        async def stall_many():
+            stalls = [staller.stall(self.TestStallable(0, success=False)) for _ in range(1000)]
+            stalling = asyncio.ensure_future(asyncio.gather(*stalls))
+
+            await asyncio.sleep(0.2)
+            self.assertEqual(thread_count, threading.active_count())
+
+            return await stalling
+
+        start_time = time.time()
+        outcomes = asyncio.run(stall_many())
+        elapsed = int((time.time() - start_time) * 1000)
+
+        self.assertTrue(500 <= elapsed < 1000)
+        self.assertEqual([(False, 8)] * 1000, outcomes)
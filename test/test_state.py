@@ -1,6 +1,9 @@
 import logging
 import time
 from unittest import TestCase
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet
 
 from src.state import StateEncryptor
 
@@ -91,7 +94,48 @@ class TestStateEncryptor(TestCase):
             self.assertEqual(state, state_encryptor.decrypt_state(encryption1))
             self.assertEqual(state, state_encryptor.decrypt_state(encryption2))
 
-            self.assertTrue(4 <= len(state_encryptor._StateEncryptor__keys) <= 5)
+            self.assertTrue(4 <= len(state_encryptor.key_ring.keys) <= 5)
 
         finally:
             state_encryptor.stop()
+
+    def test_key_id_lookup(self):
+        state_encryptor = StateEncryptor(state_aging_tolerance=6, key_renewal_frequency=1)
+
+        state = {"hello": 2, "world": True}
+        encryption = state_encryptor.encrypt_state(state)
+
+        key_id, separator, _ = encryption.partition(b".")
+        self.assertEqual(b".", separator)
+        self.assertEqual(8, len(key_id))
+
+        # Tokens encrypted with an older key are decrypted with it directly
+        state_encryptor.key_ring.renew()
+        self.assertEqual(state, state_encryptor.decrypt_state(encryption))
+        self.assertNotEqual(key_id, state_encryptor.encrypt_state(state).partition(b".")[0])
+
+    def test_unknown_key_id_rejected_before_decryption(self):
+        state_encryptor = StateEncryptor()
+        encryption = state_encryptor.encrypt_state({"hello": 2})
+
+        for forged in [b"AAAAAAAA" + encryption[8:], encryption.partition(b".")[2], b"", b"garbage"]:
+            with patch.object(Fernet, "decrypt") as decrypt:
+                with self.assertRaises(ValueError) as e:
+                    state_encryptor.decrypt_state(forged)
+
+                self.assertEqual("Cannot decrypt state", str(e.exception))
+                decrypt.assert_not_called()
+
+    def test_expired_key_rejected(self):
+        state_encryptor = StateEncryptor(state_aging_tolerance=1, key_renewal_frequency=1)
+        encryption = state_encryptor.encrypt_state({"hello": 2})
+
+        state_encryptor.key_ring.renew()
+        time.sleep(1.5)
+
+        with patch.object(Fernet, "decrypt") as decrypt:
+            with self.assertRaises(ValueError) as e:
+                state_encryptor.decrypt_state(encryption)
+
+            self.assertEqual("Cannot decrypt state", str(e.exception))
+            decrypt.assert_not_called()
@@ -1,6 +1,9 @@
+import hashlib
 from unittest import TestCase
+from unittest.mock import patch
 
-from src.util import generate_random_base_64, validate_hashcash_zeros
+from src.util import generate_random_base_64, validate_hashcash_zeros, validate_hashcash_zeros_batch, \
+    parse_timestamp, format_timestamp, numpy
 
 
 class Test(TestCase):
@@ -11,3 +14,66 @@ class Test(TestCase):
     def test_validate_hashcash_zeros(self):
         self.assertTrue(validate_hashcash_zeros(str.encode("15:20200516-184239:82.81.223.44:G5V-uz1mchswi07fqx0"
                                                            "QumL8LO0:MS4zMzczODkzNzkyNzY0MDM0ZSszMDc=:MjIwMQ=="), 15))
+
+    @staticmethod
+    def reference_validation(hashcash: bytes, zero_count: int) -> bool:
+        hash_result = hashlib.sha1(hashcash).hexdigest()
+        binary_string = (bin(int(hash_result, 16))[2:]).zfill(len(hash_result) * 4)
+        return binary_string.startswith('0' * zero_count)
+
+    def stamps(self):
+        return [f"{zeros}:20200516-184239:82.81.223.44:server:{counter}".encode()
+                for zeros in range(0, 12) for counter in range(200)]
+
+    def test_validate_hashcash_zeros_matches_reference(self):
+        for stamp in self.stamps():
+            for zero_count in [-1, 0, 1, 3, 8, 9, 160, 161]:
+                self.assertEqual(self.reference_validation(stamp, zero_count),
+                                 validate_hashcash_zeros(stamp, zero_count), stamp)
+
+        # noinspection PyTypeChecker
+        self.assertFalse(validate_hashcash_zeros("not bytes", 1))
+
+    def test_validate_hashcash_zeros_batch(self):
+        stamps = self.stamps()
+        zero_counts = [index % 10 for index in range(len(stamps))]
+        expected = [self.reference_validation(stamp, zero_count) for stamp, zero_count in zip(stamps, zero_counts)]
+
+        self.assertEqual(expected, validate_hashcash_zeros_batch(stamps, zero_counts))
+        self.assertEqual([self.reference_validation(stamp, 4) for stamp in stamps],
+                         validate_hashcash_zeros_batch(stamps, 4))
+
+        with patch("src.util.numpy", None):
+            self.assertEqual(expected, validate_hashcash_zeros_batch(stamps, zero_counts))
+
+        self.assertEqual([], validate_hashcash_zeros_batch([], 4))
+
+        with self.assertRaises(ValueError) as e:
+            validate_hashcash_zeros_batch(stamps, [1, 2])
+        self.assertEqual("Expecting a zero count per hashcash", str(e.exception))
+
+    def test_validate_hashcash_zeros_batch_bad_input(self):
+        stamp = self.stamps()[0]
+        hashcashes = [stamp, "not bytes", None, b"", 12, stamp, stamp, stamp]
+        zero_counts = [0, 1, 1, 0, 1, None, 10 ** 30, -10 ** 30]
+
+        # The same answers as the scalar check, bad items being rejected rather than raising
+        expected = [validate_hashcash_zeros(hashcash, zero_count)
+                    for hashcash, zero_count in zip(hashcashes, zero_counts)]
+        self.assertEqual([True, False, False, True, False, False, False, True], expected)
+
+        # noinspection PyTypeChecker
+        self.assertEqual(expected, validate_hashcash_zeros_batch(hashcashes, zero_counts))
+
+        with patch("src.util.numpy", None):
+            # noinspection PyTypeChecker
+            self.assertEqual(expected, validate_hashcash_zeros_batch(hashcashes, zero_counts))
+
+    def test_timestamps(self):
+        self.assertEqual(1596123316, parse_timestamp("20200730-153516"))
+        self.assertEqual("20200730-153516", format_timestamp(1596123316))
+
+        for bad in ["timestamp", "20200730153516", "20201330-153516", "2020073-1535160", "20200730-15351x"]:
+            with self.assertRaises(ValueError) as e:
+                parse_timestamp(bad)
+            self.assertEqual(f"time data {bad!r} does not match format '%Y%m%d-%H%M%S'", str(e.exception))
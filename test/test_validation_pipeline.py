@@ -0,0 +1,75 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from src.authentication_validator import AuthenticationValidator
+from src.state import StateEncryptor
+from src.validation_pipeline import ValidationPipeline, ValidationStage, ValidationContext, HEADER_COST
+
+
+class TestValidationPipeline(TestCase):
+    def setUp(self):
+        self.request_details = {"referrer": "http://www.host1.com/aloha", "host": "www.host1.com",
+                                "remote_addr": "127.0.0.1"}
+        self.headers = {"X-Requested-With": "XmlHttpRequest"}
+        self.state_encryptor = Mock(spec=StateEncryptor)
+
+    def validate(self, pipeline):
+        return AuthenticationValidator.validate(request_details=self.request_details, headers=self.headers,
+                                                state_encryptor=self.state_encryptor, configuration={},
+                                                pipeline=pipeline)
+
+    def failure_of(self, pipeline):
+        success, response = self.validate(pipeline)
+        self.assertFalse(success)
+        return response["security_details"]["failure_stage"], response["security_details"]["failure_reason"]
+
+    def test_default_stages(self):
+        self.assertEqual(["referrer", "requested_with", "required_fields", "hashcash_structure",
+                          "hashcash_timestamp", "hashcash_ip", "hashcash_zeros", "replay", "state_decryption",
+                          "state_age", "state_match", "captcha"], ValidationPipeline().stage_names)
+
+    def test_insert_stage(self):
+        pipeline = ValidationPipeline()
+        blocked = {"127.0.0.1"}
+
+        def check_block_list(context: ValidationContext):
+            if context.request_details.get("remote_addr") in blocked:
+                return "remote_address", "blocked"
+
+        pipeline.insert_before("referrer", ValidationStage("block_list", check_block_list, HEADER_COST))
+
+        self.assertEqual(("remote_address", "blocked"), self.failure_of(pipeline))
+
+        with self.assertRaises(ValueError):
+            pipeline.append(ValidationStage("block_list", check_block_list))
+
+    def test_skip_and_reorder_stages(self):
+        pipeline = ValidationPipeline()
+        self.assertEqual(("body", "not provided"), self.failure_of(pipeline))
+
+        pipeline.remove("required_fields")
+        self.request_details["referrer"] = "http://elsewhere/"
+        self.headers = {}
+
+        self.assertEqual(("referrer", "doesn't match"), self.failure_of(pipeline))
+
+        pipeline.move_before("requested_with", "referrer")
+        self.assertEqual(("requested_with", "not provided"), self.failure_of(pipeline))
+
+        with self.assertRaises(ValueError):
+            pipeline.remove("required_fields")
+
+    def test_statistics(self):
+        pipeline = ValidationPipeline()
+
+        for _ in range(3):
+            self.failure_of(pipeline)
+
+        statistics = pipeline.statistics()
+
+        self.assertEqual(3, statistics["referrer"].runs)
+        self.assertEqual(0, statistics["referrer"].rejections)
+        self.assertEqual(3, statistics["required_fields"].runs)
+        self.assertEqual(3, statistics["required_fields"].rejections)
+        self.assertEqual(0, statistics["hashcash_structure"].runs)
+        self.assertLess(0, statistics["required_fields"].seconds)
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the login hot paths.
+
+Run from the repository root, offline, against the bundled captcha-images:
+
+    python -m tools.benchmark --output results.json
+    python -m tools.benchmark --compare results.json
+
+Every benchmark reports operations per second, p50 and p99 latency and the peak RSS of the process once it
+has run. Compare mode runs the benchmarks again and exits with status 1 if any of them regressed beyond the
+threshold relative to the given results.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Dict, Any, Optional, List, Tuple, Union, ContextManager, Iterator
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from src import util
+from src.authentication_preparer import Preparer
+from src.authentication_validator import AuthenticationValidator
+from src.captcha import CaptchaCatalog, ThumbnailCache
+from src.password_repository import PasswordRepository
+from src.spent_stamps import InMemorySpentStampStore
+from src.staller import Staller, StallScheduler
+from src.state import StateEncryptor
+from src.validation_pipeline import ValidationPipeline
+
+RESULTS_FORMAT_VERSION = 1
+
+DEFAULT_CAPTCHA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                         "captcha-images")
+
+CONFIGURATION = {
+    "csrf_token_length": 20,
+    "hashcash_server_string_length": 20,
+    "hashcash_zero_count": 12,
+    "submit_timeout": 3600,
+    "login_form_timeout": 3600,
+    "self_ip_addresses": [],
+    "passphrase_minimum_length": 12,
+    "client_hash_cycles": 1000,
+    "client_hash_length": 32,
+    "password_minimum_length": 10,
+    "SIGNUM_TEST_MODE": False,
+}
+
+REMOTE_ADDRESS = "10.0.0.1"
+HOST = "www.example.com"
+
+
+def solve_hashcash(zero_count: int, timestamp: str, ip: str, server_string: str) -> str:
+    """Does the client's work: finds a stamp whose SHA-1 digest starts with zero_count zero bits"""
+    nonce = util.generate_random_base_64(8)
+    counter = 0
+
+    while True:
+        hashcash = f"{zero_count}:{timestamp}:{ip}:{server_string}:{nonce}:{counter}"
+
+        if util.validate_hashcash_zeros(hashcash.encode(), zero_count):
+            return hashcash
+
+        counter += 1
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def measure(operation: Callable[[], Any], min_time: float, max_iterations: int, warm_up: int = 3) \
+        -> Dict[str, Any]:
+    for _ in range(warm_up):
+        operation()
+
+    samples: List[int] = []
+    started = time.perf_counter()
+
+    while len(samples) < max_iterations and (not samples or time.perf_counter() - started < min_time):
+        start = time.perf_counter_ns()
+        operation()
+        samples.append(time.perf_counter_ns() - start)
+
+    samples.sort()
+
+    return {
+        "iterations": len(samples),
+        "ops_per_sec": len(samples) * 1e9 / sum(samples),
+        "p50_us": samples[len(samples) // 2] / 1000,
+        "p99_us": samples[min(len(samples) - 1, len(samples) * 99 // 100)] / 1000,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+class InMemoryPasswordRepository(PasswordRepository):
+    def __init__(self):
+        super().__init__("benchmark_salt")
+        self.database: Dict[str, str] = {}
+
+    def _save_password(self, username: str, password: str) -> None:
+        self.database[username] = password
+
+    def _load_password(self, username: str) -> str:
+        return self.database.get(username)
+
+
+class _SleepingStallable(Staller.Stallable):
+    def do_work(self):
+        self.result = True
+
+    def was_successful(self):
+        return False
+
+    def get_result(self):
+        return self.result
+
+    def interrupt(self):
+        pass
+
+
+def captcha_benchmarks(captcha_directory: str) -> Dict[str, Callable[[], Any]]:
+    cold = CaptchaCatalog(captcha_directory, thumbnail_cache=ThumbnailCache())
+    warm = CaptchaCatalog(captcha_directory, thumbnail_cache=ThumbnailCache(), warm_up=True)
+
+    def generate_cold():
+        cold.thumbnail_cache.clear()
+        cold.generate_challenge()
+
+    return {
+        "captcha_cold": generate_cold,
+        "captcha_warm": warm.generate_challenge,
+    }
+
+
+def state_benchmarks() -> Dict[str, Callable[[], Any]]:
+    benchmarks = {}
+    state = Preparer.create_state({"cat", "cats"}, CONFIGURATION)
+
+    for max_keys in [1, 4, 16]:
+        if max_keys == 1:
+            encryptor = StateEncryptor(key_renewal_frequency=0)
+        else:
+            encryptor = StateEncryptor(state_aging_tolerance=10 * (max_keys - 1), key_renewal_frequency=10)
+
+        encryption = encryptor.encrypt_state(state)
+
+        # Fill the ring, so that the state is decrypted with its oldest key
+        for _ in range(max_keys - 1):
+            encryptor.key_ring.renew()
+
+        benchmarks[f"state_encrypt_{max_keys}_keys"] = lambda e=encryptor: e.encrypt_state(state)
+        benchmarks[f"state_decrypt_{max_keys}_keys"] = lambda e=encryptor, s=encryption: e.decrypt_state(s)
+
+    return benchmarks
+
+
+def preparation_benchmarks() -> Dict[str, Callable[[], Any]]:
+    encryptor = StateEncryptor(key_renewal_frequency=0)
+    preparer = Preparer(encryptor, CONFIGURATION)
+
+    state = Preparer.create_state({"cat", "cats"}, CONFIGURATION)
+    encryption = encryptor.encrypt_state(state)
+    captcha_url = "data:img/jpeg;base64," + "A" * 8000
+    transaction = preparer.transaction_details(captcha_url, state, encryption)
+
+    return {
+        "prepare_details_static": lambda: Preparer.create_transaction_details(captcha_url, state, encryption,
+                                                                              CONFIGURATION),
+        "prepare_details_compiled": lambda: preparer.transaction_details(captcha_url, state, encryption),
+        "prepare_serialize": lambda: Preparer.serialize_transaction(transaction),
+    }
+
+
+def hashcash_benchmarks() -> Dict[str, Callable[[], Any]]:
+    stamp = solve_hashcash(12, util.format_timestamp(int(time.time())), REMOTE_ADDRESS, "server").encode()
+
+    return {
+        "hashcash_verify": lambda: util.validate_hashcash_zeros(stamp, 12),
+    }
+
+
+def build_request(encryptor: StateEncryptor, zero_count: int, state_age: int = 10) \
+        -> Tuple[Dict[str, str], Dict[str, str]]:
+    """The request details and headers of a login that passes validation, unless the state is too old"""
+    now = int(time.time())
+
+    state = Preparer.create_state({"cat", "cats"}, CONFIGURATION, zero_count)
+    state["server_time"] = util.format_timestamp(now - state_age)
+
+    hashcash = solve_hashcash(zero_count, util.format_timestamp(now - 5), REMOTE_ADDRESS,
+                              state["hashcash"]["server_string"])
+
+    request_details = {
+        "referrer": f"http://{HOST}/login",
+        "host": HOST,
+        "remote_addr": REMOTE_ADDRESS,
+        "body": json.dumps({"state": encryptor.encrypt_state(state).decode()}),
+    }
+
+    headers = {
+        "X-Requested-With": "XmlHttpRequest",
+        "X-Csrf-Token": state["csrf_token"],
+        "X-Captcha": "cats",
+        "X-Hashcash": hashcash,
+    }
+
+    return request_details, headers
+
+
+def validation_benchmarks() -> Dict[str, Callable[[], Any]]:
+    encryptor = StateEncryptor(state_aging_tolerance=3600, key_renewal_frequency=0)
+    zero_count = CONFIGURATION["hashcash_zero_count"]
+
+    request_details, headers = build_request(encryptor, zero_count)
+    forged_request_details, forged_headers = build_request(StateEncryptor(), zero_count)
+    expired_request_details, expired_headers = build_request(encryptor, zero_count,
+                                                             CONFIGURATION["login_form_timeout"] + 60)
+
+    spent_stamp_store = InMemorySpentStampStore(3600)
+    spent_stamp_store.spend(headers["X-Hashcash"].encode())
+
+    hashcash_parts = headers["X-Hashcash"].split(":")
+
+    # A stamp that did not do the work: one of a few counters surely fails
+    unworked_stamp = next(stamp for stamp in (":".join(hashcash_parts[:5] + [f"x{i}"]) for i in range(100))
+                          if not util.validate_hashcash_zeros(stamp.encode(), zero_count))
+
+    def changed(dictionary: Dict[str, str], changes: Dict[str, Optional[str]]) -> Dict[str, str]:
+        result = dict(dictionary, **changes)
+        return {key: value for key, value in result.items() if value is not None}
+
+    cases = {
+        "accepted": (request_details, headers, None),
+        "rejected_referrer": (changed(request_details, {"referrer": None}), headers, None),
+        "rejected_requested_with": (request_details, changed(headers, {"X-Requested-With": None}), None),
+        "rejected_required_fields": (changed(request_details, {"body": None}), headers, None),
+        "rejected_hashcash_structure": (request_details, changed(headers, {"X-Hashcash": "a:b"}), None),
+        "rejected_hashcash_timestamp": (request_details, changed(headers, {"X-Hashcash": ":".join(
+            hashcash_parts[:1] + ["20000101-000000"] + hashcash_parts[2:])}), None),
+        "rejected_hashcash_ip": (changed(request_details, {"remote_addr": "10.9.9.9"}), headers, None),
+        "rejected_hashcash_zeros": (request_details, changed(headers, {"X-Hashcash": unworked_stamp}), None),
+        "rejected_replay": (request_details, headers, spent_stamp_store),
+        "rejected_state_decryption": (forged_request_details, forged_headers, None),
+        "rejected_state_age": (expired_request_details, expired_headers, None),
+        "rejected_state_match": (request_details, changed(headers, {"X-Csrf-Token": "wrong"}), None),
+        "rejected_captcha": (request_details, changed(headers, {"X-Captcha": "dogs"}), None),
+    }
+
+    # Every stage of the pipeline rejects one of the cases
+    missing = set(ValidationPipeline().stage_names) - {name[len("rejected_"):] for name in cases}
+
+    if missing:
+        raise RuntimeError(f"No benchmark case for the stages {sorted(missing)}")
+
+    benchmarks = {}
+
+    for name, (case_request_details, case_headers, case_store) in cases.items():
+        def validate(d=case_request_details, h=case_headers, s=case_store, pipeline=None):
+            return AuthenticationValidator.validate(request_details=d, headers=h, state_encryptor=encryptor,
+                                                    configuration=CONFIGURATION, spent_stamp_store=s,
+                                                    pipeline=pipeline)
+
+        # A pipeline of its own, to tell which stage the case fails at
+        check_pipeline = ValidationPipeline()
+        passed, response = validate(pipeline=check_pipeline)
+        rejected_by = [stage for stage, statistics in check_pipeline.statistics().items() if statistics.rejections]
+
+        if passed != (name == "accepted") or (not passed and rejected_by != [name[len("rejected_"):]]):
+            raise RuntimeError(f"Benchmark case {name} is broken: {response}")
+
+        benchmarks[f"validate_{name}"] = validate
+
+    return benchmarks
+
+
+def password_benchmarks() -> Dict[str, Callable[[], Any]]:
+    repository = InMemoryPasswordRepository()
+    repository.save_password("username", "password")
+
+    return {
+        "password_found": lambda: repository.validate_password("username", "password"),
+        "password_not_found": lambda: repository.validate_password("nobody", "password"),
+    }
+
+
+@contextlib.contextmanager
+def staller_benchmarks(concurrency: int = 32, unit_time_in_ms: int = 5) -> Iterator[Dict[str, Callable[[], Any]]]:
+    threaded = Staller(unit_time_in_ms)
+    scheduled = Staller(unit_time_in_ms, scheduler=StallScheduler.default())
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        def stall_on_threads():
+            wait([executor.submit(threaded.stall, _SleepingStallable()) for _ in range(concurrency)])
+
+        def stall_on_scheduler():
+            wait([scheduled.stall_later(_SleepingStallable()) for _ in range(concurrency)])
+
+        yield {
+            f"staller_threads_x{concurrency}": stall_on_threads,
+            f"staller_scheduler_x{concurrency}": stall_on_scheduler,
+        }
+
+
+Benchmarks = Dict[str, Callable[[], Any]]
+
+
+def all_benchmarks(captcha_directory: str) -> Dict[str, Callable[[], Union[Benchmarks, ContextManager[Benchmarks]]]]:
+    """
+    Builders of the benchmark groups, by group name. Groups holding threads or files yield their benchmarks from a
+    context manager, which is closed once they have run.
+    """
+    return {
+        "captcha": lambda: captcha_benchmarks(captcha_directory),
+        "state": state_benchmarks,
+        "prepare": preparation_benchmarks,
+        "hashcash": hashcash_benchmarks,
+        "validate": validation_benchmarks,
+        "password": password_benchmarks,
+        "staller": staller_benchmarks,
+    }
+
+
+def run(captcha_directory: str, groups: Optional[List[str]], selection: Optional[str], min_time: float,
+        max_iterations: int) -> Dict[str, Any]:
+    results = {}
+
+    for group, build in all_benchmarks(captcha_directory).items():
+        if groups and group not in groups:
+            continue
+
+        with contextlib.ExitStack() as resources:
+            benchmarks = build()
+
+            if isinstance(benchmarks, contextlib.AbstractContextManager):
+                benchmarks = resources.enter_context(benchmarks)
+
+            for name, operation in benchmarks.items():
+                if selection and selection not in name:
+                    continue
+
+                results[name] = measure(operation, min_time, max_iterations)
+                print_result(name, results[name])
+
+    return {
+        "version": RESULTS_FORMAT_VERSION,
+        "meta": {
+            "time": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def print_result(name: str, result: Dict[str, Any]) -> None:
+    print(f"{name:40} {result['ops_per_sec']:12.1f} ops/s  p50 {result['p50_us']:10.1f}us  "
+          f"p99 {result['p99_us']:10.1f}us  rss {result['peak_rss_kb']}KB", flush=True)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """Lists the benchmarks slower than the baseline beyond the threshold, in throughput or in p99 latency"""
+    regressions = []
+
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+
+        if base is None:
+            continue
+
+        throughput_change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+        latency_change = result["p99_us"] / base["p99_us"] - 1 if base["p99_us"] else 0
+
+        print(f"{name:40} throughput {throughput_change:+7.1%}  p99 {latency_change:+7.1%}")
+
+        if throughput_change < -threshold or latency_change > threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the login hot paths")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown regarded as a regression (default: 0.1)")
+    parser.add_argument("--groups", help="comma separated groups to run: "
+                                         f"{', '.join(all_benchmarks(DEFAULT_CAPTCHA_DIRECTORY))} (default: all)")
+    parser.add_argument("--filter", help="run only benchmarks whose name contains this string")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run every benchmark")
+    parser.add_argument("--max-iterations", type=int, default=100000)
+    parser.add_argument("--captcha-directory", default=DEFAULT_CAPTCHA_DIRECTORY)
+    options = parser.parse_args(arguments)
+
+    groups = options.groups.split(",") if options.groups else None
+
+    current = run(options.captcha_directory, groups, options.filter, options.min_time, options.max_iterations)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+        if baseline.get("version") != RESULTS_FORMAT_VERSION:
+            print(f"Unsupported results format in {options.compare}")
+            return 2
+
+        regressions = compare(baseline, current, options.threshold)
+
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+A load test of the whole login flow: prepare, solve the hashcash, validate, stall.
+
+Run from the repository root:
+
+    python -m tools.load_test --clients 32 --duration 30 --mix legitimate=6,replay=2,forged=1,missing_headers=1
+
+Simulated clients drive a WSGI application standing in for a server. Legitimate users fetch the login form,
+solve the hashcash at the issued zero count and log in; attackers replay accepted logins, forge states or
+omit headers. By default clients call the application in process, each from an address of its own;
+--transport http serves it on a local port instead. The report covers throughput, tail latency per
+scenario, and the thread count and memory of the process over time. The exit status is 1 if a legitimate
+login failed or an attack got through, so the run doubles as an acceptance test.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+from socketserver import ThreadingMixIn
+from typing import Dict, Any, Optional, List, Tuple, Callable
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from src import util
+from src.authentication_preparer import Preparer
+from src.authentication_validator import AuthenticationValidator
+from src.captcha import CaptchaCatalog, ThumbnailCache
+from src.captcha_pool import CaptchaPool
+from src.difficulty import AdaptiveDifficulty
+from src.metrics import Histogram
+from src.spent_stamps import InMemorySpentStampStore
+from src.staller import Staller
+from src.state import StateEncryptor
+from tools.benchmark import solve_hashcash, InMemoryPasswordRepository, peak_rss_kb, DEFAULT_CAPTCHA_DIRECTORY
+
+SCENARIOS = ("legitimate", "replay", "forged", "missing_headers")
+
+HOST = "login.example.com"
+
+
+class _PasswordCheck(Staller.Stallable):
+    def __init__(self, repository: InMemoryPasswordRepository):
+        self.repository = repository
+        self.result: Tuple[bool, str] = (False, "Not checked")
+
+    def do_work(self, username: str, password: str) -> None:
+        self.result = self.repository.validate_password(username, password)
+
+    def get_result(self) -> Tuple[bool, str]:
+        return self.result
+
+    def interrupt(self):
+        pass
+
+    def was_successful(self) -> bool:
+        return self.result[0]
+
+
+class LoginApplication(object):
+    """
+    A WSGI application serving the login flow: GET /login prepares a login form, POST /login validates the
+    login and checks the password under a Staller. Responses are JSON. The form carries its unencrypted state
+    (test mode), standing in for the captcha a human would solve.
+    """
+    def __init__(self, configuration: Dict[str, Any], captcha_pool: CaptchaPool, staller: Staller,
+                 repository: InMemoryPasswordRepository, difficulty: Optional[AdaptiveDifficulty] = None):
+        self.configuration = configuration
+        self.captcha_pool = captcha_pool
+        self.staller = staller
+        self.repository = repository
+        self.difficulty = difficulty
+
+        self.state_encryptor = StateEncryptor(state_aging_tolerance=configuration["login_form_timeout"])
+        self.spent_stamp_store = InMemorySpentStampStore(configuration["submit_timeout"])
+        self.preparer = Preparer(self.state_encryptor, configuration, captcha_pool, difficulty)
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> List[bytes]:
+        if environ.get("PATH_INFO") != "/login":
+            return self.respond(start_response, "404 Not Found", {"error": "not found"})
+
+        if environ["REQUEST_METHOD"] == "GET":
+            return self.respond(start_response, "200 OK", self.prepare(environ))
+
+        if environ["REQUEST_METHOD"] == "POST":
+            return self.respond(start_response, "200 OK", self.login(environ))
+
+        return self.respond(start_response, "405 Method Not Allowed", {"error": "method not allowed"})
+
+    def prepare(self, environ: Dict[str, Any]) -> Dict[str, Any]:
+        transaction = self.preparer.prepare(environ.get("REMOTE_ADDR"))
+
+        return {
+            "state": transaction["state"].decode(),
+            "csrfToken": transaction["csrfToken"],
+            "unencrypted_state": transaction["unencrypted_state"],
+        }
+
+    def login(self, environ: Dict[str, Any]) -> Dict[str, Any]:
+        body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0)).decode()
+
+        request_details = {
+            "referrer": environ.get("HTTP_REFERER"),
+            "host": environ.get("HTTP_HOST"),
+            "remote_addr": environ.get("REMOTE_ADDR"),
+            "body": body,
+        }
+
+        headers = {name: environ.get("HTTP_" + name.upper().replace("-", "_"))
+                   for name in ["X-Requested-With", "X-Csrf-Token", "X-Captcha", "X-Hashcash"]}
+
+        passed, response = AuthenticationValidator.validate(request_details, headers, self.state_encryptor,
+                                                            self.configuration, self.spent_stamp_store,
+                                                            self.difficulty)
+
+        if not passed:
+            return {"passed": False, "stage": response["security_details"]["failure_stage"]}
+
+        credentials = json.loads(body)
+        success, _ = self.staller.stall(_PasswordCheck(self.repository), credentials.get("username"),
+                                        credentials.get("password"))
+
+        return {"passed": success, "stage": None if success else "password"}
+
+    @staticmethod
+    def respond(start_response: Callable, status: str, content: Dict[str, Any]) -> List[bytes]:
+        body = json.dumps(content).encode()
+        start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+
+class DirectTransport(object):
+    """Calls the application in process, as a WSGI server would"""
+    def __init__(self, application: LoginApplication):
+        self.application = application
+
+    def request(self, method: str, remote_address: str, headers: Dict[str, str], body: bytes = b"") \
+            -> Dict[str, Any]:
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": "/login",
+            "REMOTE_ADDR": remote_address,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+            "HTTP_HOST": HOST,
+        }
+
+        for name, value in headers.items():
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+        return json.loads(b"".join(self.application(environ, lambda status, response_headers: None)))
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class HttpTransport(object):
+    """Serves the application on a local port; every client comes from 127.0.0.1"""
+    def __init__(self, application: LoginApplication):
+        self.server = make_server("127.0.0.1", 0, application, _ThreadingWSGIServer, _QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def request(self, method: str, remote_address: str, headers: Dict[str, str], body: bytes = b"") \
+            -> Dict[str, Any]:
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = self.local.connection = HTTPConnection("127.0.0.1", self.server.server_port)
+
+        connection.request(method, "/login", body=body, headers=dict(headers, Host=HOST))
+        return json.loads(connection.getresponse().read())
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Client(object):
+    """A simulated client, playing a scenario drawn from the mix for each login"""
+    def __init__(self, index: int, transport, remote_address: str, mix: Dict[str, int],
+                 accepted_logins: List[Tuple[str, Dict[str, str], bytes]]):
+        self.index = index
+        self.transport = transport
+        self.remote_address = remote_address
+        self.scenarios = list(mix)
+        self.weights = [mix[scenario] for scenario in self.scenarios]
+        self.accepted_logins = accepted_logins
+        self.random = random.Random(index)
+
+    def choose_scenario(self) -> str:
+        scenario = self.random.choices(self.scenarios, self.weights)[0]
+
+        # Nothing to replay yet
+        if scenario == "replay" and not self.accepted_logins:
+            return "legitimate"
+
+        return scenario
+
+    def play(self, scenario: str) -> bool:
+        """Plays the scenario, returning whether the server accepted the login"""
+        return getattr(self, scenario)()
+
+    def login_form(self) -> Dict[str, Any]:
+        return self.transport.request("GET", self.remote_address, {})
+
+    def legitimate(self) -> bool:
+        form = self.login_form()
+        state = form["unencrypted_state"]
+
+        hashcash = solve_hashcash(state["hashcash"]["zero_count"], util.format_timestamp(int(time.time()) - 1),
+                                  self.remote_address, state["hashcash"]["server_string"])
+
+        headers = {
+            "Referer": f"http://{HOST}/login",
+            "X-Requested-With": "XmlHttpRequest",
+            "X-Csrf-Token": form["csrfToken"],
+            "X-Captcha": self.random.choice(state["captcha_solutions"]),
+            "X-Hashcash": hashcash,
+        }
+
+        body = json.dumps({"state": form["state"], "username": f"user{self.index}",
+                           "password": f"password{self.index}"}).encode()
+
+        passed = self.transport.request("POST", self.remote_address, headers, body)["passed"]
+
+        if passed:
+            self.accepted_logins.append((self.remote_address, headers, body))
+            del self.accepted_logins[:-100]
+
+        return passed
+
+    def replay(self) -> bool:
+        remote_address, headers, body = self.random.choice(self.accepted_logins)
+        return self.transport.request("POST", remote_address, headers, body)["passed"]
+
+    def forged(self) -> bool:
+        form = self.login_form()
+
+        headers = {
+            "Referer": f"http://{HOST}/login",
+            "X-Requested-With": "XmlHttpRequest",
+            "X-Csrf-Token": form["csrfToken"],
+            "X-Captcha": "guess",
+            "X-Hashcash": solve_hashcash(form["unencrypted_state"]["hashcash"]["zero_count"],
+                                         util.format_timestamp(int(time.time()) - 1), self.remote_address,
+                                         form["unencrypted_state"]["hashcash"]["server_string"]),
+        }
+
+        forged_state = form["state"][:-8] + "AAAAAAAA"
+        body = json.dumps({"state": forged_state, "username": f"user{self.index}", "password": "guess"}).encode()
+
+        return self.transport.request("POST", self.remote_address, headers, body)["passed"]
+
+    def missing_headers(self) -> bool:
+        body = json.dumps({"state": "none", "username": f"user{self.index}", "password": "guess"}).encode()
+        return self.transport.request("POST", self.remote_address, {"Referer": f"http://{HOST}/login"},
+                                      body)["passed"]
+
+
+def current_rss_kb() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_kb()
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+
+    for item in mix.split(","):
+        scenario, _, weight = item.partition("=")
+
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {scenario}, expecting one of {', '.join(SCENARIOS)}")
+
+        weights[scenario] = int(weight or 1)
+
+    return weights
+
+
+def run(clients: int, duration: float, mix: Dict[str, int], transport_name: str, zero_count: int,
+        stall_ms: int, adaptive: bool, sample_interval: float, captcha_directory: str) -> Dict[str, Any]:
+    configuration = {
+        "captcha_directory": captcha_directory,
+        "csrf_token_length": 20,
+        "hashcash_server_string_length": 20,
+        "hashcash_zero_count": zero_count,
+        "passphrase_minimum_length": 12,
+        "client_hash_cycles": 100,
+        "client_hash_length": 32,
+        "password_minimum_length": 12,
+        "submit_timeout": 60,
+        "login_form_timeout": 120,
+        "self_ip_addresses": [],
+        "SIGNUM_TEST_MODE": True,
+    }
+
+    repository = InMemoryPasswordRepository()
+    for index in range(clients):
+        repository.save_password(f"user{index}", f"password{index}")
+
+    catalog = CaptchaCatalog(captcha_directory, thumbnail_cache=ThumbnailCache())
+    captcha_pool = CaptchaPool(catalog, size=128, low_water_mark=32, worker_count=2)
+    captcha_pool.start()
+
+    difficulty = AdaptiveDifficulty(zero_count, max_zero_count=zero_count + 4) if adaptive else None
+
+    application = LoginApplication(configuration, captcha_pool, Staller(stall_ms), repository, difficulty)
+    transport = HttpTransport(application) if transport_name == "http" else DirectTransport(application)
+
+    accepted_logins: List[Tuple[str, Dict[str, str], bytes]] = []
+    lock = threading.Lock()
+    # Replays fall back to legitimate logins until there is something to replay
+    scenarios = set(mix) | {"legitimate"}
+    histograms = {scenario: Histogram() for scenario in scenarios}
+    outcomes = {scenario: {"passed": 0, "rejected": 0, "errors": 0} for scenario in scenarios}
+    timeline = []
+
+    stop = threading.Event()
+
+    def drive(client: Client):
+        while not stop.is_set():
+            scenario = client.choose_scenario()
+            start = time.perf_counter()
+
+            try:
+                outcome = "passed" if client.play(scenario) else "rejected"
+            except Exception as e:
+                outcome = "errors"
+                print(f"Client {client.index}, {scenario}: {e!r}", file=sys.stderr)
+
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                histograms[scenario].record(elapsed * 1000000)
+                outcomes[scenario][outcome] += 1
+
+    threads = []
+    for index in range(clients):
+        remote_address = "127.0.0.1" if transport_name == "http" else f"10.{index // 65536 % 256}." \
+                                                                       f"{index // 256 % 256}.{index % 256}"
+        client = Client(index, transport, remote_address, mix, accepted_logins)
+        threads.append(threading.Thread(target=drive, args=(client,), daemon=True))
+
+    started = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    while time.perf_counter() - started < duration:
+        time.sleep(sample_interval)
+
+        with lock:
+            requests = sum(histogram.count for histogram in histograms.values())
+
+        sample = {"second": round(time.perf_counter() - started, 1), "requests": requests,
+                  "threads": threading.active_count(), "rss_kb": current_rss_kb()}
+        timeline.append(sample)
+        print(f"{sample['second']:7.1f}s  {requests:8} logins  {sample['threads']:5} threads  "
+              f"{sample['rss_kb']} KB", flush=True)
+
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - started
+
+    captcha_pool.stop()
+    if transport_name == "http":
+        transport.close()
+
+    return {
+        "clients": clients,
+        "duration": elapsed,
+        "mix": mix,
+        "transport": transport_name,
+        "throughput": sum(histogram.count for histogram in histograms.values()) / elapsed,
+        "scenarios": {
+            scenario: dict(outcomes[scenario], **{
+                "p50_ms": histograms[scenario].percentile(50) / 1000,
+                "p99_ms": histograms[scenario].percentile(99) / 1000,
+                "max_ms": (histograms[scenario].max or 0) / 1000,
+            }) for scenario in SCENARIOS if scenario in scenarios
+        },
+        "captcha_pool_fallbacks": captcha_pool.fallbacks,
+        "timeline": timeline,
+    }
+
+
+def failures(report: Dict[str, Any]) -> List[str]:
+    """What went wrong for the acceptance test: legitimate logins rejected, attacks let through, errors"""
+    problems = []
+
+    for scenario, result in report["scenarios"].items():
+        if result["errors"]:
+            problems.append(f"{result['errors']} {scenario} logins failed with errors")
+
+        if scenario == "legitimate" and result["rejected"]:
+            problems.append(f"{result['rejected']} legitimate logins were rejected")
+
+        if scenario != "legitimate" and result["passed"]:
+            problems.append(f"{result['passed']} {scenario} attacks got through")
+
+    return problems
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test of the login flow")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent simulated clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--mix", default="legitimate=6,replay=2,forged=1,missing_headers=1",
+                        help="scenario weights, of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--transport", choices=["direct", "http"], default="direct")
+    parser.add_argument("--zero-count", type=int, default=10, help="hashcash zero count issued")
+    parser.add_argument("--adaptive", action="store_true", help="adapt the zero count to the load")
+    parser.add_argument("--stall-ms", type=int, default=50, help="Staller unit time")
+    parser.add_argument("--sample-interval", type=float, default=1, help="seconds between timeline samples")
+    parser.add_argument("--captcha-directory", default=DEFAULT_CAPTCHA_DIRECTORY)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    options = parser.parse_args(arguments)
+
+    report = run(options.clients, options.duration, parse_mix(options.mix), options.transport, options.zero_count,
+                 options.stall_ms, options.adaptive, options.sample_interval, options.captcha_directory)
+
+    print(f"\n{report['throughput']:.1f} logins/s over {report['duration']:.1f}s, "
+          f"{report['captcha_pool_fallbacks']} synchronous captchas")
+
+    for scenario, result in report["scenarios"].items():
+        print(f"{scenario:16} passed {result['passed']:7}  rejected {result['rejected']:7}  "
+              f"errors {result['errors']:5}  p50 {result['p50_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms")
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    problems = failures(report)
+
+    for problem in problems:
+        print(problem)
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())